@@ -15,11 +15,16 @@ from aiohttp import web
 from datetime import datetime
 from threadcomponents.database.dao import Dao, DB_POSTGRESQL, DB_SQLITE
 from threadcomponents.handlers.web_api import WebAPI
+from threadcomponents.reports.bulk_exporter import BulkExporter, EXPORT_FORMATS
 from threadcomponents.reports.report_exporter import ReportExporter
 from threadcomponents.service.data_svc import DataService
 from threadcomponents.service.ml_svc import MLService
 from threadcomponents.service.reg_svc import RegService
-from threadcomponents.service.rest_svc import RestService
+from threadcomponents.service.request_metrics import RequestMetrics
+from threadcomponents.service.rest_svc import ReportStatus, RestService
+from threadcomponents.service.startup_orchestrator import StartupOrchestrator
+from threadcomponents.service.startup_profiler import StartupProfiler
+from threadcomponents.service.static_assets import StaticAssets
 from threadcomponents.service.web_svc import WebService
 
 # If calling Thread from outside the project directory, then we need to specify
@@ -60,50 +65,78 @@ async def update_attack_data_scheduler():
     logging.info('UPDATE ATTACK DATA: END')
 
 
-async def background_tasks(taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=None):
+async def fetch_attack_data_on_startup():
+    """Function to fetch the attack data when building the database, exiting if this cannot be done."""
+    try:
+        await rest_svc.fetch_and_update_attack_data(is_startup=True)
+    except Exception as exc:
+        logging.critical('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n'
+                         'COULD NOT CONNECT TO TAXII SERVERS: {}\nPLEASE UPDATE CONFIG `taxii-local` '
+                         'FOR OFFLINE DATABASE BUILDING\n'
+                         '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'.format(exc))
+        sys.exit()
+
+
+def add_build_steps(orchestrator, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=None):
     """
-    Function to run background tasks at startup
+    Function to add the steps which build the database to the startup orchestrator
+    :param orchestrator: The StartupOrchestrator to add the steps to
     :param taxii_local: Expects 'online' or 'offline' to specify the build type.
     :param build: Defines whether or not a new database will be rebuilt
     :param json_file: Expects a path to the enterprise attack json if the 'json' build method is called.
-    :return: nil
+    :return: a dictionary of the step names other steps may need to wait for
     """
-    if build:
-        await data_svc.reload_database()
-        if taxii_local == ONLINE_BUILD_SOURCE:
-            try:
-                await rest_svc.fetch_and_update_attack_data(is_startup=True)
-            except Exception as exc:
-                logging.critical('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n'
-                                 'COULD NOT CONNECT TO TAXII SERVERS: {}\nPLEASE UPDATE CONFIG `taxii-local` '
-                                 'FOR OFFLINE DATABASE BUILDING\n'
-                                 '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'.format(exc))
-                sys.exit()
-        elif taxii_local == OFFLINE_BUILD_SOURCE and json_file:
-            await data_svc.insert_attack_json_data(json_file)
-        await data_svc.set_regions_data()
-        await data_svc.set_countries_data()
-        await data_svc.insert_category_json_data()
-        await data_svc.insert_keyword_json_data()
-
-
-async def init(host, port, app_setup_func=None):
+    if not build:
+        return dict()
+    # Everything else needs the database (re)built first; after that, the data-loading steps are independent
+    database_step = orchestrator.add_step('reload_database', data_svc.reload_database)
+    attack_step = None
+    if taxii_local == ONLINE_BUILD_SOURCE:
+        attack_step = orchestrator.add_step('fetch_and_update_attack_data', fetch_attack_data_on_startup,
+                                            after=[database_step])
+    elif taxii_local == OFFLINE_BUILD_SOURCE and json_file:
+        attack_step = orchestrator.add_step('insert_attack_json_data',
+                                            lambda: data_svc.insert_attack_json_data(json_file), after=[database_step])
+    orchestrator.add_step('set_regions_data', data_svc.set_regions_data)
+    orchestrator.add_step('set_countries_data', data_svc.set_countries_data)
+    category_step = orchestrator.add_step('insert_category_json_data', data_svc.insert_category_json_data,
+                                          after=[database_step])
+    keyword_step = orchestrator.add_step('insert_keyword_json_data', data_svc.insert_keyword_json_data,
+                                         after=[database_step])
+    return dict(database_step=database_step, attack_step=attack_step, category_step=category_step,
+                keyword_step=keyword_step)
+
+
+async def init(host, port, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=None, app_setup_func=None,
+               profiler=None):
     """
     Function to initialize the aiohttp app
 
     :param host: Address to reach webserver on
     :param port: Port to listen on
+    :param taxii_local: Expects online or offline build_source to specify the build type
+    :param build: Defines whether or not a new database will be rebuilt
+    :param json_file: Expects a path to the enterprise attack json if the 'offline' build method is called
     :param app_setup_func: Optional, a function that applies extra config to the app
+    :param profiler: Optional, a StartupProfiler to record the time taken by each startup step
     :return: nil
     """
-    # Run any required functions before the app is launched
-    await website_handler.pre_launch_init()
+    # Plan the startup steps: independent steps run concurrently and pages are served once the app is ready
+    orchestrator = StartupOrchestrator(profiler=profiler)
+    build_steps = add_build_steps(orchestrator, taxii_local=taxii_local, build=build, json_file=json_file)
+    website_handler.add_pre_launch_steps(orchestrator, **build_steps)
+    # The nltk packs are only needed when reports are analysed (which waits for this step itself)
+    orchestrator.add_step('check_nltk_packs', ml_svc.check_nltk_packs, needed_for_ready=False)
 
     logging.info('server starting: %s:%s' % (host, port))
     webapp_dir = os.path.join(dir_prefix, 'webapp')
     logging.info('webapp dir is %s' % webapp_dir)
 
-    app = web.Application(middlewares=[WebAPI.req_handler])
+    # Time every request (including those turned away while starting up) so the request metrics are complete
+    app = web.Application(middlewares=[website_handler.request_metrics.middleware, WebAPI.req_handler,
+                                       website_handler.startup_gate])
+    app.router.add_route('GET', web_svc.get_route(WebService.READY_KEY), website_handler.readiness)
+    app.router.add_route('GET', web_svc.get_route(WebService.METRICS_KEY), website_handler.metrics)
     app.router.add_route('GET', web_svc.get_route(WebService.HOME_KEY), website_handler.index)
     app.router.add_route('GET', web_svc.get_route(WebService.EDIT_KEY), website_handler.edit)
     app.router.add_route('GET', web_svc.get_route(WebService.ABOUT_KEY), website_handler.about)
@@ -111,24 +144,48 @@ async def init(host, port, app_setup_func=None):
     app.router.add_route('*', web_svc.get_route(WebService.REST_KEY), website_handler.rest_api)
     app.router.add_route('GET', web_svc.get_route(WebService.EXPORT_PDF_KEY), website_handler.pdf_export)
     app.router.add_route('GET', web_svc.get_route(WebService.EXPORT_NAV_KEY), website_handler.nav_export)
+    app.router.add_route('GET', web_svc.get_route(WebService.EXPORT_BULK_KEY), website_handler.bulk_export)
     app.router.add_route('GET', web_svc.get_route(WebService.COOKIE_KEY), website_handler.accept_cookies)
+    app.router.add_route('GET', web_svc.get_route(WebService.CATALOGUE_KEY), website_handler.catalogue)
     if not web_svc.is_local:
         app.router.add_route('GET', web_svc.get_route(WebService.WHAT_TO_SUBMIT_KEY), website_handler.what_to_submit)
-    app.router.add_static(web_svc.get_route(WebService.STATIC_KEY), os.path.join(webapp_dir, 'theme'))
+    # Static files are served from memory (fingerprinted and compressed at startup) rather than from disk
+    app.router.add_route('GET', web_svc.get_route(WebService.STATIC_KEY) + '{path:.*}',
+                         website_handler.static_assets.handler)
+    # Close the shared URL-fetching session when the app shuts down
+    app.on_cleanup.append(web_svc.close_url_sessions)
 
     # If extra app-setup is required, do this
     if callable(app_setup_func):
         app_setup_func(app)
 
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(os.path.join(webapp_dir, 'html')))
-    runner = web.AppRunner(app)
-    await runner.setup()
-    await web.TCPSite(runner, host, port).start()
+    with orchestrator.profiler.step('start_listener'):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+    # Start listening straight away (the readiness endpoint reports progress) then run the startup steps
+    orchestrator.task = asyncio.create_task(run_startup_steps(orchestrator))
+    orchestrator.task.add_done_callback(log_startup_error)
+    await orchestrator.wait_until_ready()
     # First action after app-initialisation is to resume any reports left in the queue from a previous session
     await rest_svc.check_queue()
 
 
-def start(host, port, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=None, app_setup_func=None):
+async def run_startup_steps(orchestrator):
+    """Function to run the startup steps and report how long these took."""
+    await orchestrator.run()
+    orchestrator.profiler.report()
+
+
+def log_startup_error(task):
+    """Function to log an error which stopped the startup steps task (which nothing else awaits)."""
+    if not task.cancelled() and task.exception():
+        logging.error('Running the startup steps failed', exc_info=task.exception())
+
+
+def start(host, port, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=None, app_setup_func=None,
+          profiler=None):
     """
     Main function to start app
     :param host: Address to reach webserver on
@@ -137,17 +194,18 @@ def start(host, port, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=No
     :param build: Defines whether or not a new database will be rebuilt
     :param json_file: Expects a path to the enterprise attack json if the 'offline' build method is called
     :param app_setup_func: Optional, a function that applies extra config to the app
+    :param profiler: Optional, a StartupProfiler to record the time taken by each startup step
     :return: nil
     """
     loop = asyncio.get_event_loop()
-    loop.create_task(background_tasks(taxii_local=taxii_local, build=build, json_file=json_file))
-    loop.run_until_complete(init(host, port, app_setup_func=app_setup_func))
+    loop.run_until_complete(init(host, port, taxii_local=taxii_local, build=build, json_file=json_file,
+                                 app_setup_func=app_setup_func, profiler=profiler))
     if taxii_local == ONLINE_BUILD_SOURCE:
         # Schedule the function to update the attack-data (check daily if it is time to do so)
         asyncio.ensure_future(repeat(86400, update_attack_data_scheduler))
     if not web_svc.is_local:
         # Schedule the function to tidy up reports and fetch updated keywords
-        asyncio.ensure_future(repeat(86400, data_svc.remove_expired_reports))
+        asyncio.ensure_future(repeat(86400, rest_svc.remove_expired_reports))
         asyncio.ensure_future(repeat(86400, website_handler.fetch_and_update_keywords))
     try:
         loop.run_forever()
@@ -155,12 +213,58 @@ def start(host, port, taxii_local=ONLINE_BUILD_SOURCE, build=False, json_file=No
         pass
 
 
-def main(directory_prefix='', route_prefix=None, app_setup_func=None, db_connection_func=None):
+def create_db_engine(db_conf, db_connection_func=None):
+    """Function to return the database engine for the `db-engine` config option."""
+    if db_conf == DB_SQLITE:
+        from threadcomponents.database.thread_sqlite3 import ThreadSQLite
+        return ThreadSQLite(os.path.join(dir_prefix, 'threadcomponents', 'database', 'thread.db'))
+    elif db_conf == DB_POSTGRESQL:
+        # Import here to avoid PostgreSQL requirements needed for non-PostgreSQL use
+        from threadcomponents.database.thread_postgresql import ThreadPostgreSQL
+        return ThreadPostgreSQL(db_connection_func=db_connection_func)
+    return None
+
+
+async def write_bulk_export(bulk_exporter, output, export_format, status, **filters):
+    """Function to write a bulk export to a (binary) file as it is read from the database."""
+    async for chunk in bulk_exporter.export(export_format, status, **filters):
+        output.write(chunk)
+
+
+def bulk_export(export_format, status=ReportStatus.COMPLETED.value, date_from=None, date_to=None, token=None,
+                output=None, db_connection_func=None):
+    """Function to export the confirmed techniques of the reports matching the filters (without launching the app).
+    As this is run by whoever has access to the database, reports of all tokens are exported unless a token is given."""
+    with open(os.path.join(dir_prefix, 'threadcomponents', 'conf', 'config.yml')) as c:
+        db_conf = yaml.safe_load(c).get('db-engine', DB_SQLITE)
+    bulk_exporter = BulkExporter(Dao(engine=create_db_engine(db_conf, db_connection_func=db_connection_func)))
+    filters = dict(date_from=date_from, date_to=date_to, token=token, all_tokens=not token)
+    # Write to stdout if no output file is given
+    output_file = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        asyncio.run(write_bulk_export(bulk_exporter, output_file, export_format, status, **filters))
+    finally:
+        if output:
+            output_file.close()
+        else:
+            output_file.flush()
+
+
+def date_arg(value):
+    """Function to check a command-line date is in the format YYYY-MM-DD."""
+    if not RestService.to_datetime_obj(value):
+        raise argparse.ArgumentTypeError('%s is not a date in the format YYYY-MM-DD' % value)
+    return value
+
+
+def main(directory_prefix='', route_prefix=None, app_setup_func=None, db_connection_func=None, profile_startup=False):
     global data_svc, dir_prefix, ml_svc, rest_svc, web_svc, website_handler
 
     dir_prefix = directory_prefix
     logging.getLogger().setLevel(logging.INFO)
     logging.info('Welcome to Thread')
+    # Record how long each startup step takes (reported in detail if profile_startup is set)
+    profiler = StartupProfiler(enabled=profile_startup)
 
     # Read from config
     with open(os.path.join(dir_prefix, 'threadcomponents', 'conf', 'config.yml')) as c:
@@ -178,6 +282,12 @@ def main(directory_prefix='', route_prefix=None, app_setup_func=None, db_connect
         json_file = config.get('json_file', None)
         update_json_file = config.get('update_json_file', False)
         json_file_indent = config.get('json_file_indent', 2)
+        url_cache_size = config.get('url_cache_size', 1000)
+        url_cache_ttl = config.get('url_cache_ttl', 3600)
+        index_page_size = config.get('index_page_size', 100)
+        request_query_limit = config.get('request_query_limit', 50)
+        slow_analysis_seconds = config.get('slow_analysis_seconds', 0)
+        metrics_token = config.get('metrics_token') or None
         json_file_path = os.path.join(dir_prefix, 'threadcomponents', 'models', json_file) if json_file else None
         attack_dict = None
     # Set the attack dictionary filepath if applicable
@@ -208,30 +318,52 @@ def main(directory_prefix='', route_prefix=None, app_setup_func=None, db_connect
         int(json_file_indent)
     except ValueError:
         raise ValueError(int_error % 'json_file_indent')
+    try:
+        if index_page_size < 1:
+            index_page_size = None
+    except TypeError:
+        raise ValueError(int_error % 'index_page_size')
+    try:
+        if request_query_limit < 1:
+            request_query_limit = None
+    except TypeError:
+        raise ValueError(int_error % 'request_query_limit')
+    try:
+        if slow_analysis_seconds < 1:
+            slow_analysis_seconds = None
+    except TypeError:
+        raise ValueError(int_error % 'slow_analysis_seconds')
+    for int_name, int_value in [('url_cache_size', url_cache_size), ('url_cache_ttl', url_cache_ttl)]:
+        try:
+            int(int_value)
+        except (TypeError, ValueError):
+            raise ValueError(int_error % int_name)
     # Determine DB engine to use
-    db_obj = None
-    if db_conf == DB_SQLITE:
-        from threadcomponents.database.thread_sqlite3 import ThreadSQLite
-        db_obj = ThreadSQLite(os.path.join(dir_prefix, 'threadcomponents', 'database', 'thread.db'))
-    elif db_conf == DB_POSTGRESQL:
-        # Import here to avoid PostgreSQL requirements needed for non-PostgreSQL use
-        from threadcomponents.database.thread_postgresql import ThreadPostgreSQL
-        db_obj = ThreadPostgreSQL(db_connection_func=db_connection_func)
+    db_obj = create_db_engine(db_conf, db_connection_func=db_connection_func)
 
     # Initialise DAO, start services and initiate main function
-    dao = Dao(engine=db_obj)
-    web_svc = WebService(route_prefix=route_prefix, is_local=is_local)
-    reg_svc = RegService(dao=dao)
-    data_svc = DataService(dao=dao, web_svc=web_svc, dir_prefix=dir_prefix)
-    ml_svc = MLService(web_svc=web_svc, dao=dao, dir_prefix=dir_prefix)
-    attack_file_settings = dict(filepath=json_file_path, update=update_json_file, indent=json_file_indent)
-    rest_svc = RestService(web_svc, reg_svc, data_svc, ml_svc, dao, dir_prefix=dir_prefix, queue_limit=queue_limit,
-                           sentence_limit=sentence_limit, max_tasks=max_tasks,
-                           attack_file_settings=attack_file_settings)
-    services = dict(dao=dao, data_svc=data_svc, ml_svc=ml_svc, reg_svc=reg_svc, web_svc=web_svc, rest_svc=rest_svc)
-    report_exporter = ReportExporter(services=services)
-    website_handler = WebAPI(services=services, report_exporter=report_exporter, js_src=js_src)
-    start(host, port, taxii_local=taxii_local, build=conf_build, json_file=attack_dict, app_setup_func=app_setup_func)
+    with profiler.step('create_services'):
+        dao = Dao(engine=db_obj)
+        web_svc = WebService(route_prefix=route_prefix, is_local=is_local, url_cache_size=int(url_cache_size),
+                             url_cache_ttl=int(url_cache_ttl))
+        reg_svc = RegService(dao=dao)
+        data_svc = DataService(dao=dao, web_svc=web_svc, dir_prefix=dir_prefix)
+        ml_svc = MLService(web_svc=web_svc, dao=dao, dir_prefix=dir_prefix)
+        attack_file_settings = dict(filepath=json_file_path, update=update_json_file, indent=json_file_indent)
+        rest_svc = RestService(web_svc, reg_svc, data_svc, ml_svc, dao, dir_prefix=dir_prefix,
+                               queue_limit=queue_limit, sentence_limit=sentence_limit, max_tasks=max_tasks,
+                               attack_file_settings=attack_file_settings, slow_analysis_seconds=slow_analysis_seconds)
+        services = dict(dao=dao, data_svc=data_svc, ml_svc=ml_svc, reg_svc=reg_svc, web_svc=web_svc,
+                        rest_svc=rest_svc)
+        report_exporter = ReportExporter(services=services)
+        static_assets = StaticAssets(os.path.join(dir_prefix, 'webapp', 'theme'),
+                                     web_svc.get_route(WebService.STATIC_KEY))
+        request_metrics = RequestMetrics(query_limit=request_query_limit)
+        website_handler = WebAPI(services=services, report_exporter=report_exporter, js_src=js_src,
+                                 index_page_size=index_page_size, static_assets=static_assets,
+                                 request_metrics=request_metrics, metrics_token=metrics_token)
+    start(host, port, taxii_local=taxii_local, build=conf_build, json_file=attack_dict, app_setup_func=app_setup_func,
+          profiler=profiler)
 
 
 if __name__ == '__main__':
@@ -239,6 +371,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launch the Thread webapp.')
     parser.add_argument('--build-db', action='store_true', help='builds the (PostgreSQL) database')
     parser.add_argument('--schema', help='the schema file to use if --build-db option is used')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='logs the time taken by each startup step and the modules each step imported')
+    parser.add_argument('--export', choices=list(EXPORT_FORMATS),
+                        help='exports the confirmed techniques of many reports (instead of launching the webapp)')
+    parser.add_argument('--export-status', default=ReportStatus.COMPLETED.value,
+                        choices=[ReportStatus.NEEDS_REVIEW.value, ReportStatus.IN_REVIEW.value,
+                                 ReportStatus.COMPLETED.value], help='the status of the reports to export')
+    parser.add_argument('--export-from', type=date_arg, help='exports reports written on or after this date')
+    parser.add_argument('--export-to', type=date_arg, help='exports reports written on or before this date')
+    parser.add_argument('--export-token', help='exports only the reports of this token')
+    parser.add_argument('--export-output', help='the file to export to (default: stdout)')
     given_args = vars(parser.parse_args())
 
     if given_args.get('build_db'):
@@ -246,5 +389,9 @@ if __name__ == '__main__':
         # Import here to avoid PostgreSQL requirements needed for non-PostgreSQL use
         from threadcomponents.database.thread_postgresql import build_db as build_postgresql
         build_postgresql(schema)
+    elif given_args.get('export'):
+        bulk_export(given_args['export'], status=given_args['export_status'], date_from=given_args.get('export_from'),
+                    date_to=given_args.get('export_to'), token=given_args.get('export_token'),
+                    output=given_args.get('export_output'))
     else:
-        main()
+        main(profile_startup=given_args.get('profile_startup', False))
@@ -1,6 +1,9 @@
+import json
 import os
+import tempfile
 
 from tests.thread_app_test import ThreadAppTest
+from threadcomponents.service.data_svc import iter_stix_objects
 
 
 class TestAttackData(ThreadAppTest):
@@ -41,3 +44,62 @@ class TestAttackData(ThreadAppTest):
         self.assertTrue(in_db in attacks, 'New attack did not appear in database.')
         self.assertTrue(in_dropdown_list in self.web_api.attack_dropdown_list,
                         'New attack did not appear in web-dropdown-list.')
+
+    async def test_unmodified_attacks_skipped(self):
+        """Function to test attacks are only re-checked when their modified timestamp changes."""
+        attack = dict(uid='w12345', tid='T1490', name='Water', modified='2022-03-07T00:00:00.000Z')
+        self.mock_current_attack_data(attack_list=[attack])
+        await self.data_svc.fetch_and_update_attack_data()
+        # Rename the attack in the database: the sync should leave it as the attack has not been modified since
+        await self.db.update('attack_uids', where=dict(uid=attack['uid']), data=dict(name='Waterga'))
+        self.mock_current_attack_data(attack_list=[attack])
+        _, _, name_changes = await self.data_svc.fetch_and_update_attack_data()
+        self.assertEqual(name_changes, [])
+        # Once the attack has been modified, its name should be checked and updated
+        self.mock_current_attack_data(attack_list=[dict(attack, modified='2023-01-01T00:00:00.000Z')])
+        _, _, name_changes = await self.data_svc.fetch_and_update_attack_data()
+        self.assertEqual(name_changes, [(attack['uid'], 'Water', 'Waterga')])
+        stored = await self.db.get('attack_modified', equal=dict(attack_uid=attack['uid']))
+        self.assertEqual(stored[0]['modified'], '2023-01-01T00:00:00.000Z')
+
+    def test_iter_stix_objects(self):
+        """Function to test objects are streamed from a STIX bundle when split across reads."""
+        objects = [dict(type='attack-pattern', id='attack-pattern--%s' % i, name='Attack [%s], {}' % i)
+                   for i in range(20)]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bundle_file = os.path.join(temp_dir, 'bundle.json')
+            with open(bundle_file, 'w') as bundle:
+                json.dump(dict(type='bundle', id='bundle--1', objects=objects), bundle, indent=2)
+            self.assertEqual(list(iter_stix_objects(bundle_file, chunk_size=7)), objects)
+            # A bundle which has been cut short should not be silently accepted
+            with open(bundle_file, 'r+') as bundle:
+                bundle.truncate(len(bundle.read()) // 2)
+            with self.assertRaises(ValueError):
+                list(iter_stix_objects(bundle_file, chunk_size=7))
+
+    async def test_insert_attack_json_data(self):
+        """Function to test techniques and their example uses are inserted from a streamed attack json file."""
+        technique = dict(type='attack-pattern', id='attack-pattern--s12345', name='Stone',
+                         external_references=[dict(source_name='mitre-attack', external_id='T1491')])
+        # The relationship appears before the technique it refers to
+        relationship = dict(type='relationship', relationship_type='uses', target_ref=technique['id'],
+                            description='[Golem](https://attack.mitre.org/software/S9999) turned things to stone.')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bundle_file = os.path.join(temp_dir, 'bundle.json')
+            with open(bundle_file, 'w') as bundle:
+                json.dump(dict(type='bundle', objects=[relationship, technique]), bundle)
+            await self.data_svc.insert_attack_json_data(bundle_file)
+        attacks = await self.db.get('attack_uids', equal=dict(uid=technique['id']))
+        self.assertEqual(attacks[0]['tid'], 'T1491')
+        true_positives = await self.db.get('true_positives', equal=dict(attack_uid=technique['id']))
+        self.assertEqual([tp['true_positive'] for tp in true_positives], [' turned things to stone.'])
+
+    async def test_new_sub_technique_linked_to_parent(self):
+        """Function to test a sub-technique added by a sync is returned with its parent-technique's info."""
+        new_attack = dict(uid='f99999', tid='T1562.999', name='Firaja')
+        self.mock_current_attack_data(attack_list=[dict(uid='f12345', tid='T1562', name='Fire'), new_attack])
+        await self.web_api.fetch_and_update_attack_data()
+        expected = dict(new_attack, inactive=0, parent_tid='T1562', parent_name='Fire')
+        self.assertIn(expected, self.web_api.attack_dropdown_list)
+        stored = await self.db.get('attack_hierarchy', equal=dict(attack_uid=new_attack['uid']))
+        self.assertEqual(stored[0]['parent_uid'], 'f12345')
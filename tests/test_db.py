@@ -76,10 +76,11 @@ class TestDBSQL(IsolatedAsyncioTestCase):
                 # If this still fails, fail the test
                 self.fail('Unable to obtain table names from schema; raw_select() may be at fault.')
         # The list of tables we are expecting to have been created
-        expected = ['attack_uids', 'reports', 'report_sentences', 'true_positives', 'true_negatives', 'false_positives',
-                    'false_negatives', 'regex_patterns', 'similar_words', 'report_sentence_hits', 'original_html',
-                    'report_sentences_initial', 'report_sentence_hits_initial', 'original_html_initial', 'categories',
-                    'report_categories', 'keywords', 'report_keywords', 'report_countries', 'report_all_assoc',
+        expected = ['attack_uids', 'attack_modified', 'attack_hierarchy', 'reports', 'report_sentences',
+                    'true_positives', 'true_negatives', 'false_positives', 'false_negatives', 'regex_patterns',
+                    'similar_words', 'report_sentence_hits', 'original_html', 'report_sentences_initial',
+                    'report_sentence_hits_initial', 'original_html_initial', 'categories', 'report_categories',
+                    'keywords', 'report_keywords', 'report_countries', 'report_all_assoc',
                     'report_sentence_indicators_of_compromise', 'report_regions', 'report_sentence_queue_progress']
         # Check the expectations against the results
         for table in results:
@@ -87,6 +88,30 @@ class TestDBSQL(IsolatedAsyncioTestCase):
         for table in expected:
             self.assertTrue(table in results, msg='Table %s was expected but not created.' % table)
 
+    async def test_build_adds_columns(self):
+        """Function to test building an existing database adds the columns added to its tables since."""
+        db_file = os.path.join('tests', 'threadtestupgrade.db')
+        self.addCleanup(delete_db_file, db_file)
+        # A reports table (with a report) from before title suffixes
+        with sqlite3.connect(db_file) as conn:
+            conn.execute('CREATE TABLE reports (uid VARCHAR(60) PRIMARY KEY, title VARCHAR(210), url VARCHAR(500), '
+                         'current_status VARCHAR(20), error BOOLEAN DEFAULT 0, token VARCHAR(60) DEFAULT NULL, '
+                         'automatically_generated VARCHAR(60) DEFAULT NULL);')
+            # Titles were not allocated atomically so there can be reports with the same title
+            conn.executemany('INSERT INTO reports (uid, title) VALUES (?, ?);',
+                             [('old', 'Old report'), ('dup-2', 'Dup report'), ('dup-1', 'Dup report')])
+        db = ThreadSQLite(db_file)
+        with self.assertNoLogs(level='ERROR'):
+            await db.build(self.schema)
+        # The tables after reports were still built
+        self.assertTrue(await db.raw_select('SELECT name FROM sqlite_master WHERE name = \'report_sentences\';'))
+        results = await db.raw_select('SELECT uid, base_title, title_suffix FROM reports ORDER BY uid;')
+        self.assertEqual([dict(uid='dup-1', base_title='Dup report', title_suffix=0),
+                          dict(uid='dup-2', base_title='Dup report', title_suffix=1),
+                          dict(uid='old', base_title='Old report', title_suffix=0)], results)
+        indexes = await db.raw_select('SELECT name FROM sqlite_master WHERE type = \'index\';', single_col=True)
+        self.assertTrue('reports_base_title_suffix_idx' in indexes)
+
     async def test_insert(self):
         """Function to test INSERT statements are generated correctly."""
         # Test data to insert
@@ -1,6 +1,15 @@
+import gzip
 import os
+import tempfile
 
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from aiohttp_jinja2 import render_string
 from tests.thread_app_test import ThreadAppTest
+from threadcomponents.service.rest_svc import ReportStatus
+from threadcomponents.service.static_assets import StaticAssets
+from unittest.mock import patch
+from urllib.parse import quote
 
 
 class TestPages(ThreadAppTest):
@@ -17,7 +26,156 @@ class TestPages(ThreadAppTest):
         resp = await self.client.get('/')
         self.assertTrue(resp.status == 200, msg='Home page failed to load successfully.')
 
+    async def test_home_page_columns_paged(self):
+        """Function to test each column of the home page is paged separately."""
+        for title, status in [('Paged A', ReportStatus.NEEDS_REVIEW), ('Paged B', ReportStatus.NEEDS_REVIEW),
+                              ('Paged C', ReportStatus.COMPLETED), ('Paged D', ReportStatus.COMPLETED)]:
+            await self.db.insert_generate_uid('reports', dict(title=title, url=title.lower(),
+                                                              current_status=status.value))
+        with patch.object(self.web_api, 'index_page_size', 1):
+            resp = await self.client.get('/?completed_page=2')
+            page = await resp.text()
+        self.assertEqual(resp.status, 200)
+        # Only the completed column has moved on to its second page
+        self.assertIn('Paged A', page)
+        self.assertNotIn('Paged B', page)
+        self.assertNotIn('Paged C', page)
+        self.assertIn('Paged D', page)
+        # Each column's links change its own page and keep the others' pages
+        self.assertIn('href="?completed_page=1"', page)
+        self.assertIn('href="?completed_page=2&amp;needs_review_page=2"', page)
+        self.assertNotIn('?page=', page)
+
     async def test_how_it_works_page(self):
         """Function to test the How Thread Works page loads successfully."""
         resp = await self.client.get('/how-thread-works')
         self.assertTrue(resp.status == 200, msg='How Thread Works page failed to load successfully.')
+
+    async def test_static_page_cached(self):
+        """Function to test a static page is rendered once and can be revalidated and served compressed."""
+        self.web_api.page_cache.pages.clear()
+        with patch('threadcomponents.handlers.web_api.render_string', wraps=render_string) as mock_render, \
+                patch.object(self.web_api, 'base_page_data', wraps=self.web_api.base_page_data) as mock_data:
+            resp = await self.client.get('/using-thread')
+            etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+            self.assertTrue(etag and last_modified, msg='Static page did not include validators.')
+            # A client with the current page is told it has not been modified
+            resp = await self.client.get('/using-thread', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status, 304)
+            resp = await self.client.get('/using-thread', headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status, 304)
+            # Else the page is sent compressed if the client accepts this
+            resp = await self.client.get('/using-thread', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.headers.get('Content-Encoding'), 'gzip')
+            self.assertIn('Using Thread', await resp.text())
+            resp = await self.client.get('/using-thread', headers={'Accept-Encoding': 'identity'})
+            self.assertIsNone(resp.headers.get('Content-Encoding'))
+            self.assertEqual(mock_render.call_count, 1, msg='Static page was rendered more than once.')
+            self.assertEqual(mock_data.call_count, 1, msg='Page data was built for a cached static page.')
+
+    async def test_dropdown_catalogue(self):
+        """Function to test the edit page links to the dropdown catalogues, which are served as versioned JSON."""
+        report_title = 'Catalogue This'
+        await self.db.insert_generate_uid('reports', dict(title=report_title, url='catalogue.this',
+                                                          current_status=ReportStatus.IN_REVIEW.value))
+        resp = await self.client.get('/edit/' + quote(report_title, safe=''))
+        page = await resp.text()
+        catalogue_url = self.web_api.catalogue_url('attacks')
+        self.assertIn('data-catalogue-url="%s"' % catalogue_url, page)
+        self.assertNotIn('<option class="missingTechOpt"', page, msg='Edit page still includes the technique options.')
+        # The current version of a catalogue can be cached indefinitely
+        resp = await self.client.get(catalogue_url)
+        self.assertEqual(resp.status, 200)
+        self.assertIn('immutable', resp.headers.get('Cache-Control'))
+        etag = resp.headers.get('ETag')
+        self.assertFalse(etag.startswith('W/'), msg='Catalogue ETag is not a strong ETag.')
+        attack_uids = [attack['uid'] for attack in await resp.json()]
+        self.assertEqual(attack_uids, [attack['uid'] for attack in self.web_api.attack_dropdown_list])
+        resp = await self.client.get(catalogue_url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+        # The catalogue gets a new version when its list changes
+        self.web_api.publish_catalogue('attacks', [])
+        self.assertNotEqual(self.web_api.catalogue_url('attacks'), catalogue_url)
+        resp = await self.client.get(catalogue_url)
+        self.assertEqual(await resp.json(), [])
+        self.assertEqual(resp.headers.get('Cache-Control'), 'no-cache')
+        resp = await self.client.get('/catalogue/unknown.json')
+        self.assertEqual(resp.status, 404)
+
+    async def test_static_assets(self):
+        """Function to test static files are served under hashed URLs which can be cached indefinitely."""
+        with tempfile.TemporaryDirectory() as theme_dir:
+            os.makedirs(os.path.join(theme_dir, 'style'))
+            os.makedirs(os.path.join(theme_dir, 'webfonts'))
+            with open(os.path.join(theme_dir, 'style', 'style.css'), 'w') as css_file:
+                css_file.write('@font-face { src: url("../webfonts/thread.ttf?#iefix"); }')
+            with open(os.path.join(theme_dir, 'webfonts', 'thread.ttf'), 'wb') as font_file:
+                font_file.write(b'font' * 100)
+            static_assets = StaticAssets(theme_dir, '/theme/')
+            static_assets.build()
+
+        def get(path, headers=None):
+            request = make_mocked_request('GET', '/theme/' + path, headers=headers, match_info=dict(path=path))
+            return static_assets.handler(request)
+
+        css_url = static_assets.url('style/style.css')
+        font_url = static_assets.url('webfonts/thread.ttf')
+        self.assertRegex(css_url, r'^/theme/style/style\.[0-9a-f]{12}\.css$')
+        # The stylesheet refers to the hashed font file
+        resp = await get(css_url[len('/theme/'):])
+        self.assertIn('immutable', resp.headers.get('Cache-Control'))
+        self.assertIn(b'url("../webfonts/%s?#iefix")' % os.path.basename(font_url).encode(), resp.body)
+        # The font is sent compressed if the client accepts this and the client can revalidate it
+        resp = await get(font_url[len('/theme/'):], headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(resp.body), b'font' * 100)
+        resp = await get(font_url[len('/theme/'):], headers={'If-None-Match': resp.headers.get('ETag')})
+        self.assertEqual(resp.status, 304)
+        # The file's original path is still served but has to be revalidated
+        resp = await get('webfonts/thread.ttf')
+        self.assertEqual(resp.headers.get('Cache-Control'), 'no-cache')
+        with self.assertRaises(web.HTTPNotFound):
+            await get('webfonts/missing.ttf')
+        # The pages use the hashed URLs
+        self.web_api.static_assets = static_assets
+        self.web_api.page_cache.pages.clear()
+        try:
+            resp = await self.client.get('/using-thread')
+            self.assertIn(static_assets.url('style/style.css'), await resp.text())
+        finally:
+            self.web_api.static_assets = None
+            self.web_api.page_cache.pages.clear()
+
+    async def test_metrics(self):
+        """Function to test the metrics are served in the Prometheus text format without revealing user tokens."""
+        queue = self.rest_svc.get_queue_for_user(token='secret-token')
+        queue.append('https://queued.report')
+        try:
+            await self.client.get('/using-thread')
+            resp = await self.client.get('/metrics')
+            body = await resp.text()
+        finally:
+            queue.remove('https://queued.report')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.content_type, 'text/plain')
+        # Every line is a comment or a sample of a metric (with any labels) and its value
+        for line in body.splitlines():
+            self.assertRegex(line, r'^(# (HELP|TYPE) \w+ .+|\w+(\{\w+="[^"]*"(,\w+="[^"]*")*\})? [-+\w.]+)$')
+        self.assertIn('thread_http_request_seconds_bucket{method="GET",route="/using-thread",index="",le="+Inf"}',
+                      body)
+        self.assertIn('thread_db_query_seconds_count{operation="select"}', body)
+        self.assertRegex(body, r'thread_cache_entries\{cache="pages"\} [1-9]')
+        self.assertRegex(body, r'thread_queue_reports\{user="[0-9a-f]{12}"\} 1')
+        self.assertNotIn('secret-token', body)
+
+    async def test_metrics_not_local(self):
+        """Function to test the metrics of a non-local app are only served to requests with the metrics token."""
+        with patch.object(self.web_api, 'is_local', False):
+            resp = await self.client.get('/metrics')
+            self.assertEqual(resp.status, 404, msg='Metrics were served without a metrics token being configured.')
+            with patch.object(self.web_api, 'metrics_token', 'scrape-token'):
+                resp = await self.client.get('/metrics', headers={'Authorization': 'Bearer wrong-token'})
+                self.assertEqual(resp.status, 404, msg='Metrics were served with the wrong token.')
+                resp = await self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'})
+                self.assertEqual(resp.status, 200, msg='Metrics were not served with the metrics token.')
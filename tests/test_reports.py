@@ -1,9 +1,15 @@
+import json
 import os
+import re
+import tempfile
 
 from tests.thread_app_test import ThreadAppTest
+from threadcomponents.database.thread_db import QueryStats, query_stats
 from threadcomponents.service.rest_svc import ReportStatus, UID as UID_KEY
+from threadcomponents.service.web_svc import WebService
 from uuid import uuid4
 from urllib.parse import quote
+from unittest.mock import patch
 
 
 class TestReports(ThreadAppTest):
@@ -72,12 +78,13 @@ class TestReports(ThreadAppTest):
         data = dict(index='insert_csv', file=csv_str)
         # Begin relevant patches
         await self.patches_on_insert()
+        verify_url = self.create_patch(target=WebService, attribute='verify_url', return_value=None)
 
         # Send off the limit-exceeding data
         resp = await self.client.post('/limit/rest', json=data)
         # Check for a positive response (as reports would have been submitted)
+        resp, resp_json = await self.get_batch_job_result(resp, rest_url='/limit/rest')
         self.assertTrue(resp.status == 200, msg='Bulk-report submission resulted in a non-200 response.')
-        resp_json = await resp.json()
         # Check that the user is told 1 report exceeded the limit and was not added to the queue
         success, info, alert_user = resp_json.get('success'), resp_json.get('info'), resp_json.get('alert_user')
         self.assertTrue(success, msg='Bulk-report submission was not flagged as successful.')
@@ -88,9 +95,55 @@ class TestReports(ThreadAppTest):
         # Check that the queue is filled to its limit
         self.assertEqual(self.rest_svc_with_limit.queue.qsize(), self.rest_svc_with_limit.QUEUE_LIMIT,
                          msg='Bulk-report submission with exceeded-queue resulted in an unfilled queue.')
+        # Check the report exceeding the limit was not downloaded
+        self.assertEqual(verify_url.call_count, limit, msg='Reports exceeding the queue limit were downloaded.')
         # Tidy-up for this method: reset queue limit and queue
         self.reset_queue(rest_svc=self.rest_svc_with_limit)
 
+    async def test_duplicate_urls_in_queue(self):
+        """Function to test variations of an already-queued URL are not added to the queue again."""
+        csv_str = 'title,url\nDup 1,https://dup.check/a-page\nDup 2,http://DUP.check/a-page/?utm_source=feed\n' \
+                  'Dup 3,dup.check/a-page#section\nNot Dup,dup.check/another-page\n'
+        await self.patches_on_insert()
+        resp = await self.client.post('/rest', json=dict(index='insert_csv', file=csv_str))
+        resp, resp_json = await self.get_batch_job_result(resp)
+        self.assertTrue(resp.status == 200, msg='Bulk-report submission resulted in a non-200 response.')
+        info = resp_json.get('info', '')
+        self.assertTrue('2 of 4 report(s) not added to the queue' in info and
+                        '2 already in the queue/duplicate URL(s)' in info,
+                        msg='Duplicate URLs in a bulk-report submission were not identified.')
+        self.assertEqual(len(self.rest_svc.get_queue_for_user()), 2, msg='Duplicate URLs were added to the queue.')
+        self.reset_queue()
+
+    async def test_batch_titles_made_unique(self):
+        """Function to test reports in a batch submission with the same title are given unique titles."""
+        await self.db.insert('reports', dict(uid='batch-title-1', title='Batch Title', url='batch.title/0',
+                                             current_status=ReportStatus.COMPLETED.value))
+        csv_str = 'title,url\nBatch Title,batch.title/1\nBatch Title,batch.title/2\n'
+        await self.patches_on_insert()
+        resp = await self.client.post('/rest', json=dict(index='insert_csv', file=csv_str))
+        await self.get_batch_job_result(resp)
+        titles = await self.db.raw_select('SELECT title FROM reports WHERE url LIKE ?', parameters=('%batch.title/%',),
+                                          single_col=True)
+        self.assertCountEqual(titles, ['Batch Title', 'Batch Title_1', 'Batch Title_2'],
+                              msg='Reports in a batch submission were not given unique titles.')
+        self.reset_queue()
+
+    async def test_allocate_titles(self):
+        """Function to test titles are allocated the next suffix and do not clash with titles ending in _X."""
+        existing = [('alloc-1', 'Alloc', 'Alloc', 0), ('alloc-2', 'Alloc_3', 'Alloc', 3),
+                    ('alloc-3', 'Alloc_5', 'Alloc_5', 0)]
+        for uid, title, base_title, title_suffix in existing:
+            await self.db.insert('reports', dict(uid=uid, title=title, url=uid, base_title=base_title,
+                                                 title_suffix=title_suffix))
+        allocated = await self.data_svc.allocate_titles(['Alloc', 'Alloc', 'Alloc', 'Alloc_5', 'New Alloc'])
+        titles = [a['title'] for a in allocated]
+        self.assertCountEqual(titles[:3], ['Alloc_4', 'Alloc_6', 'Alloc_7'])
+        self.assertEqual(titles[3:], ['Alloc_5_1', 'New Alloc'])
+        for entry in allocated:
+            self.assertEqual(entry['title'], entry['base_title'] + ('_%s' % entry['title_suffix']
+                                                                    if entry['title_suffix'] else ''))
+
     async def test_malformed_csv(self):
         """Function to test the behaviour of submitting a malformed CSV."""
         # Test cases for malformed CSVs
@@ -232,6 +285,86 @@ class TestReports(ThreadAppTest):
         self.assertEqual(unchecked_vals[0][0]['attack_uid'], 'd99999', msg=error_msg + ' Incorrect details.')
         self.assertEqual(unchecked_vals[1][0]['attack_uid'], 'd99999', msg=error_msg + ' Incorrect details.')
 
+    async def insert_long_report(self, report_id, report_title, sentence_count, status=ReportStatus.IN_REVIEW.value,
+                                 sentence_text='Sentence %s.'):
+        """Function to insert a report with many sentences (each with a prediction) and return, for each sentence
+        whose prediction is left to review, its expected unchecked attacks."""
+        await self.db.insert('reports', dict(uid=report_id, title=report_title, url=report_title.lower(),
+                                             current_status=status, date_written='2022-08-15'))
+        sql_list, expected = [], dict()
+        for sen_index in range(sentence_count):
+            sen_id = '%s-%s' % (report_id, sen_index)
+            sql_list.append(await self.db.insert('report_sentences', dict(
+                uid=sen_id, report_uid=report_id, text=sentence_text % sen_index, html=sentence_text % sen_index,
+                sen_index=sen_index, found_status=self.db.val_as_true), return_sql=True))
+            # Every sentence has a prediction: every 3rd is rejected (a false positive) and every 5th is confirmed
+            rejected, confirmed = (sen_index % 3 == 0), (sen_index % 5 == 0) and (sen_index % 3 != 0)
+            sql_list.append(await self.db.insert_generate_uid('report_sentence_hits', dict(
+                sentence_id=sen_id, report_uid=report_id, attack_uid='d99999', attack_tid='T1029',
+                attack_technique_name='Drain', initial_model_match=self.db.val_as_true,
+                active_hit=self.db.val_as_false if rejected else self.db.val_as_true,
+                confirmed=self.db.val_as_true if confirmed else self.db.val_as_false), return_sql=True))
+            if rejected:
+                sql_list.append(await self.db.insert_generate_uid('false_positives', dict(
+                    sentence_id=sen_id, attack_uid='d99999', false_positive='Sentence %s.' % sen_index),
+                    return_sql=True))
+            elif not confirmed:
+                expected[sen_id] = [dict(attack_uid='d99999', attack_tid='T1029')]
+            if sen_index % 10 == 0:
+                sql_list.append(await self.db.insert_generate_uid('report_sentence_indicators_of_compromise', dict(
+                    report_id=report_id, sentence_id=sen_id, refanged_sentence_text='1.2.3.4'), return_sql=True))
+        await self.db.run_sql_list(sql_list=sql_list)
+        return expected
+
+    @staticmethod
+    def request_query_count(resp):
+        """Function to return the number of database queries made for a response (from its Server-Timing header)."""
+        return int(re.search(r'db;desc="(\d+) queries', resp.headers['Server-Timing']).group(1))
+
+    async def test_large_report_review_data(self):
+        """Function to test the edit-page data for a 2000-sentence report is correct and read in a few queries."""
+        report_id, report_title, sentence_count = str(uuid4()), 'A Very Long Read', 2000
+        expected = await self.insert_long_report(report_id, report_title, sentence_count)
+        stats = QueryStats()
+        stats_token = query_stats.set(stats)
+        try:
+            unchecked_count = await self.data_svc.get_unconfirmed_undated_attack_count(report_id=report_id)
+            unchecked = await self.data_svc.get_unconfirmed_undated_attack_count(report_id=report_id,
+                                                                                 return_detail=True)
+        finally:
+            query_stats.reset(stats_token)
+        resp = await self.client.get('/edit/' + quote(report_title, safe=''))
+        self.assertEqual(resp.status, 200, msg='Edit-report page for a long report failed to load successfully.')
+        self.assertEqual(unchecked_count, len(expected))
+        self.assertEqual(unchecked, expected, msg='Attacks-to-Review miscalculated for a long report.')
+        self.assertEqual(list(unchecked), list(expected), msg='Attacks-to-Review not in sentence order.')
+        # The queries do not scale with the report (a query per sentence, IoC or hit would make thousands)
+        self.assertLessEqual(stats.count, 2, msg='Attacks-to-Review were not counted in one query each.')
+        self.assertLessEqual(self.request_query_count(resp), 15,
+                             msg='The edit page for a %s-sentence report made too many queries.' % sentence_count)
+
+    async def test_report_listing(self):
+        """Function to test the index page's report listings are paginated, cached and updated on deletion."""
+        status, token = ReportStatus.NEEDS_REVIEW.value, 'listing-token'
+        for title in ['Listed A', 'Listed B', 'Listed C']:
+            await self.db.insert_generate_uid('reports', dict(title=title, url=title.lower(), current_status=status,
+                                                              token=token))
+        listing = await self.data_svc.report_listing(status, criteria=dict(token=token), page_size=2, page=1)
+        self.assertEqual(listing['total'], 3)
+        self.assertEqual([report['title'] for report in listing['reports']], ['Listed A', 'Listed B'])
+        self.assertEqual(set(listing['reports'][0]), {'title', 'url', 'error', 'expires_on', 'link', 'title_quoted'})
+        listing = await self.data_svc.report_listing(status, criteria=dict(token=token), page_size=2, page=2)
+        self.assertEqual([report['title'] for report in listing['reports']], ['Listed C'])
+        # A repeated request should be served from the cache
+        with patch.object(self.data_svc, 'status_grouper') as mock_grouper:
+            await self.data_svc.report_listing(status, criteria=dict(token=token), page_size=2, page=1)
+            mock_grouper.assert_not_called()
+        # Deleting a report should be reflected in the next listing
+        await self.client.post('/rest', json=dict(index='delete_report', report_title=quote('Listed A', safe='')))
+        listing = await self.data_svc.report_listing(status, criteria=dict(token=token), page_size=2, page=1)
+        self.assertEqual(listing['total'], 2)
+        self.assertEqual([report['title'] for report in listing['reports']], ['Listed B', 'Listed C'])
+
     async def test_revert_status(self):
         """Function to test setting the status of a report back to its initial status of 'Queue'."""
         report_id, report_title = str(uuid4()), 'To Set or Not to Set: The Sequel'
@@ -388,6 +521,64 @@ class TestReports(ThreadAppTest):
         self.assertEqual(resp_attacks_json[0].get(UID_KEY), 'd99999',
                          msg='Confirmed attack not returned in confirmed attacks for sentence.')
 
+    async def test_sentence_index(self):
+        """Function to test obtaining the hits of all report sentences at once and that this is kept up-to-date."""
+        report_id, report_title = str(uuid4()), 'Index This!'
+        await self.submit_test_report(dict(uid=report_id, title=report_title, url='indexing.this'))
+        sentences = await self.db.get('report_sentences', equal=dict(report_uid=report_id))
+        sen_id = next((sen[UID_KEY] for sen in sentences if sen.get('found_status') == self.db.val_as_true), None)
+        if not sen_id:
+            self.skipTest('Could not test the sentence index as report test sentences do not have attacks.')
+        data = dict(index='sentence_index', report_title=quote(report_title, safe=''))
+        resp = await self.client.post('/rest', json=data)
+        self.assertTrue(resp.status < 300, msg='Obtaining the sentence index resulted in a non-200 response.')
+        sentence_index = (await resp.json())['sentences']
+        self.assertEqual([hit['attack_uid'] for hit in sentence_index[sen_id]['techniques']], ['d99999'])
+        self.assertEqual(sentence_index[sen_id]['confirmed'], [])
+        # Sentence clicks should now be served from the cached index rather than the database
+        with patch.object(self.data_svc, 'get_active_sentence_hits') as mock_hits:
+            resp = await self.client.post('/rest', json=dict(index='sentence_context', sentence_id=sen_id))
+            self.assertEqual((await resp.json())['techniques'][0]['attack_uid'], 'd99999')
+            mock_hits.assert_not_called()
+        # Confirming the attack should be reflected in the index
+        await self.client.post('/rest', json=dict(index='add_attack', sentence_id=sen_id, attack_uid='d99999'))
+        resp = await self.client.post('/rest', json=data)
+        sentence_index = (await resp.json())['sentences']
+        self.assertEqual([hit[UID_KEY] for hit in sentence_index[sen_id]['confirmed']], ['d99999'])
+        resp = await self.client.post('/rest', json=dict(index='confirmed_attacks', sentence_id=sen_id))
+        self.assertEqual((await resp.json())[0][UID_KEY], 'd99999')
+
+    async def test_review_action_delta(self):
+        """Function to test confirming and rejecting attacks return the sentence's changes and patch the index."""
+        report_id, report_title = str(uuid4()), 'Patch This!'
+        await self.submit_test_report(dict(uid=report_id, title=report_title, url='patching.this'))
+        sentences = await self.db.get('report_sentences', equal=dict(report_uid=report_id))
+        sen_id = next((sen[UID_KEY] for sen in sentences if sen.get('found_status') == self.db.val_as_true), None)
+        if not sen_id:
+            self.skipTest('Could not test review deltas as report test sentences do not have attacks.')
+        # Cache the report's sentence index before reviewing
+        await self.client.post('/rest', json=dict(index='sentence_index', report_title=quote(report_title, safe='')))
+        resp = await self.client.post('/rest', json=dict(index='add_attack', sentence_id=sen_id, attack_uid='d99999'))
+        self.assertEqual(resp.status, 200, msg='Confirming an attack did not return its changes.')
+        delta = (await resp.json())['delta']
+        self.assertEqual(delta['sentence_id'], sen_id)
+        self.assertEqual([hit[UID_KEY] for hit in delta['sentence']['confirmed']], ['d99999'])
+        self.assertTrue(delta['found_status'])
+        self.assertEqual(delta['unchecked'], 0, msg='Confirming the only attack left attacks to review.')
+        # The cached index is patched rather than re-queried for the whole report
+        with patch.object(self.data_svc, 'get_report_hit_index') as mock_index:
+            resp = await self.client.post('/rest', json=dict(index='confirmed_attacks', sentence_id=sen_id))
+            self.assertEqual((await resp.json())[0][UID_KEY], 'd99999')
+            mock_index.assert_not_called()
+        # Rejecting the only attack of the sentence leaves it without hits
+        resp = await self.client.post('/rest', json=dict(index='reject_attack', sentence_id=sen_id,
+                                                         attack_uid='d99999'))
+        delta = (await resp.json())['delta']
+        self.assertEqual(delta['sentence'], dict(techniques=[], confirmed=[]))
+        self.assertFalse(delta['found_status'])
+        resp = await self.client.post('/rest', json=dict(index='sentence_context', sentence_id=sen_id))
+        self.assertEqual((await resp.json())['techniques'], [])
+
     async def test_rollback_report(self):
         """Function to test functionality to rollback a report."""
         report_id, report_title = str(uuid4()), 'Never Gonna Rollback This Up'
@@ -515,3 +706,177 @@ class TestReports(ThreadAppTest):
         self.assertTrue(k['victims']['categories_all'], msg='Victim categories select-all' + error_sfx)
         self.assertFalse(k['victims']['countries_all'], msg='Victim countries select-all' + error_sfx)
         self.assertEqual(set(k['victims']['countries']), {'Hobbiton'}, msg='Victim countries (display)' + error_sfx)
+
+    async def test_completed_report_export_cached(self):
+        """Function to test the exports of a completed report are cached until the report is edited."""
+        report_id, report_title = str(uuid4()), 'Export This Again'
+        await self.submit_test_report(dict(uid=report_id, title=report_title, url='exporting.this',
+                                           date_written='2022-08-15'))
+        await self.db.update('reports', where=dict(uid=report_id),
+                             data=dict(current_status=ReportStatus.COMPLETED.value))
+        nav_url = '/export/nav/' + quote(report_title, safe='')
+        resp = await self.client.get(nav_url)
+        self.assertEqual(resp.status, 200)
+        layer = await resp.json()
+        self.assertEqual(layer['name'], report_title, msg='Navigator layer was not exported as a JSON object.')
+        etag = resp.headers.get('ETag')
+        technique = dict(model_score=0, techniqueID='T1029', comment='Drained', tech_start_date=None,
+                         tech_end_date=None)
+        with patch.object(self.data_svc, 'get_confirmed_techniques_for_nav_export',
+                          return_value=[technique]) as mock_techniques:
+            # The export is served from the cache and can be revalidated
+            resp = await self.client.get(nav_url)
+            self.assertEqual(await resp.json(), layer)
+            resp = await self.client.get(nav_url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status, 304)
+            mock_techniques.assert_not_called()
+            # Editing the report means its export is rebuilt
+            self.rest_svc.report_changed(report_id)
+            resp = await self.client.get(nav_url, headers={'If-None-Match': etag})
+            self.assertEqual((await resp.json())['techniques'], [technique])
+            mock_techniques.assert_called_once()
+        resp = await self.client.get('/export/pdf/' + quote(report_title, safe=''))
+        self.assertEqual((await resp.json())['info']['creator'], 'exporting.this')
+        # A deleted report's revision is no longer kept
+        self.assertIn(report_id, self.rest_svc.report_revisions)
+        await self.client.post('/rest', json=dict(index='delete_report', report_title=quote(report_title, safe='')))
+        self.assertNotIn(report_id, self.rest_svc.report_revisions)
+
+    async def test_bulk_export(self):
+        """Function to test the confirmed techniques of many reports are streamed as NDJSON or a STIX bundle."""
+        report_ids = []
+        for report_title in ['Bulk Export One', 'Bulk Export Two']:
+            report_id = str(uuid4())
+            await self.submit_test_report(dict(uid=report_id, title=report_title, url=report_title.lower(),
+                                               date_written='2022-08-15'))
+            sentences = await self.db.get('report_sentences', equal=dict(report_uid=report_id))
+            for sentence in sentences[:2]:
+                await self.client.post('/rest', json=dict(index='add_attack', sentence_id=sentence[UID_KEY],
+                                                          attack_uid='f32451'))
+            await self.db.update('reports', where=dict(uid=report_id),
+                                 data=dict(current_status=ReportStatus.COMPLETED.value))
+            report_ids.append(report_id)
+        # Read a report at a time to check the export continues across batches
+        bulk_exporter = self.web_api.report_exporter.bulk_exporter
+        bulk_exporter.batch_size = 1
+        # No database lock is held between batches (e.g. whilst a slow client reads the export) so writes can be made
+        exported = bulk_exporter.reports(ReportStatus.COMPLETED.value, all_tokens=True)
+        await exported.__anext__()
+        await self.db.update('reports', where=dict(uid=report_ids[0]), data=dict(url='bulk export one'))
+        await exported.aclose()
+        self.assertEqual(await self.db.raw_select('SELECT url FROM reports WHERE uid = ?', parameters=(report_ids[0],),
+                                                  single_col=True), ['bulk export one'])
+        resp = await self.client.get('/export/bulk', params=dict(format='ndjson', to='2022-08-15'))
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers.get('Transfer-Encoding'), 'chunked')
+        reports = {report['uid']: report for report in
+                   [json.loads(line) for line in (await resp.text()).splitlines()]}
+        for report_id in report_ids:
+            self.assertEqual([mapping['attack_tid'] for mapping in reports[report_id]['mappings']],
+                             ['T1562.004', 'T1562.004'])
+        # Reports written before the date range are not exported
+        resp = await self.client.get('/export/bulk', params=dict(format='ndjson', **{'from': '2022-08-16'}))
+        self.assertNotIn(report_ids[0], await resp.text())
+        # The STIX bundle refers to each technique once
+        resp = await self.client.get('/export/bulk', params=dict(format='stix'))
+        bundle = await resp.json(content_type=None)
+        self.assertEqual(bundle['type'], 'bundle')
+        stix_reports = [obj for obj in bundle['objects'] if obj['type'] == 'report']
+        self.assertTrue({'report--' + report_id for report_id in report_ids} <= {obj['id'] for obj in stix_reports})
+        patterns = [obj for obj in bundle['objects'] if obj['type'] == 'attack-pattern']
+        self.assertEqual(len(patterns), len({obj['id'] for obj in patterns}))
+        self.assertIn(stix_reports[0]['object_refs'][0], {obj['id'] for obj in patterns})
+        resp = await self.client.get('/export/bulk', params=dict(format='csv'))
+        self.assertEqual(resp.status, 400)
+
+    async def test_sentences_grouped_by_attack(self):
+        """Function to test a report's sentences can be grouped by attack in one query (including for SQLite)."""
+        report_id = str(uuid4())
+        await self.submit_test_report(dict(uid=report_id, title='Group These Sentences', url='grouping.this'))
+        sentences = await self.db.get('report_sentences', equal=dict(report_uid=report_id),
+                                      order_by_asc=dict(sen_index=1))
+        for sentence in reversed(sentences[:2]):
+            await self.client.post('/rest', json=dict(index='add_attack', sentence_id=sentence[UID_KEY],
+                                                      attack_uid='d99999'))
+        attacks = await self.data_svc.get_report_sentences_with_attacks(report_id=report_id, group_by_attack=True)
+        drain = next(attack for attack in attacks if attack['attack_tid'] == 'T1029')
+        # The sentences of an attack are listed in report order
+        self.assertEqual([mapping[UID_KEY] for mapping in drain['mappings']],
+                         [sentence[UID_KEY] for sentence in sentences[:2]])
+        # The grouped PDF table lists the attack once, spanning the rows of its sentences
+        report_exporter = self.web_api.report_exporter
+        rows, _ = report_exporter._pdfmake_add_sentences_grouped_by_attacks(dict(content=[]), attacks, [])
+        drain_rows = [row for row in rows if isinstance(row[0], dict) and row[0].get('text') == 'T1029']
+        self.assertEqual(drain_rows[0][0].get('rowSpan'), 2)
+
+    async def test_large_report_export(self):
+        """Function to test the exports of a completed 2000-sentence report are correct and read in a few queries."""
+        report_id, report_title, sentence_count = str(uuid4()), 'A Very Long Export', 2000
+        # Long sentences with markup to strip for the navigator layer
+        sentence_text = 'Sentence %s <a href="https://long.read/">' + ('is <b>very</b> long. ' * 40) + '</a>'
+        await self.insert_long_report(report_id, report_title, sentence_count, status=ReportStatus.COMPLETED.value,
+                                      sentence_text=sentence_text)
+        resp = await self.client.get('/export/nav/' + quote(report_title, safe=''))
+        layer = await resp.json()
+        query_counts = [self.request_query_count(resp)]
+        resp = await self.client.get('/export/pdf/' + quote(report_title, safe=''))
+        pdf = await resp.json()
+        query_counts.append(self.request_query_count(resp))
+        # Every 5th sentence (but not every 3rd) is confirmed
+        confirmed = [sen_index for sen_index in range(sentence_count) if sen_index % 5 == 0 and sen_index % 3 != 0]
+        self.assertEqual(len(layer['techniques']), len(confirmed))
+        self.assertEqual(layer['techniques'][0]['comment'], 'Sentence 5 is very long. ' + ('is very long. ' * 39)[:-1])
+        # Every 10th sentence is an IoC
+        ioc_table = pdf['content'][-2]['table']
+        self.assertEqual(len(ioc_table['body']) - 1, len(range(0, sentence_count, 10)))
+        # The queries do not scale with the report (a query per sentence or IoC would make thousands)
+        for query_count in query_counts:
+            self.assertLessEqual(query_count, 15, msg='Exporting a %s-sentence report made %s queries.'
+                                                      % (sentence_count, query_count))
+
+    async def test_request_metrics(self):
+        """Function to test requests are timed (by REST function) with the queries they made."""
+        report_id = str(uuid4())
+        await self.insert_long_report(report_id, 'Measure Twice', 3)
+        labels = dict(method='POST', route='/rest', index='confirmed_attacks')
+        previous = self.request_metrics.latency.get(**labels)
+        previous_count = previous.count if previous else 0
+        resp = await self.client.post('/rest', json=dict(index='confirmed_attacks', sentence_id=report_id + '-0'))
+        self.assertEqual(resp.status, 200)
+        latency = self.request_metrics.latency.get(**labels)
+        self.assertEqual(latency.count, previous_count + 1)
+        self.assertEqual(latency.cumulative_counts()[-1][1], latency.count)
+        # The header has the request's query count and database time
+        timing = resp.headers.get('Server-Timing', '')
+        self.assertRegex(timing, r'^db;desc="[1-9]\d* queries";dur=[\d.]+, total;dur=[\d.]+$')
+        # A request making more queries than the limit is logged and marked in the header
+        over_limit = self.request_metrics.over_query_limit.get(**labels) or 0
+        with patch.object(self.request_metrics, 'query_limit', 0), self.assertLogs(level='WARNING') as logs:
+            resp = await self.client.post('/rest', json=dict(index='confirmed_attacks', sentence_id=report_id + '-0'))
+        self.assertIn('(over limit)', resp.headers['Server-Timing'])
+        self.assertIn('(confirmed_attacks) ran', logs.output[0])
+        self.assertEqual(self.request_metrics.over_query_limit.get(**labels), over_limit + 1)
+        # Unknown REST functions are not labelled separately
+        await self.client.post('/rest', json=dict(index='not_a_function'))
+        self.assertIsNotNone(self.request_metrics.latency.get(method='POST', route='/rest', index=''))
+        self.assertIsNone(self.request_metrics.latency.get(method='POST', route='/rest', index='not_a_function'))
+
+    async def test_slow_analysis_profiled(self):
+        """Function to test an analysis is traced by stage and, if slow, has its profile saved."""
+        report_id = str(uuid4())
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with patch.object(self.rest_svc, 'SLOW_ANALYSIS_SECONDS', 0.001), \
+                    patch.object(self.rest_svc, 'profile_dir', profile_dir), self.assertLogs(level='INFO') as logs:
+                await self.submit_test_report(dict(uid=report_id, title='Slowly Does It', url='slowly.does.it'))
+            profiles = os.listdir(profile_dir)
+            self.assertEqual(len(profiles), 1)
+            self.assertTrue(profiles[0].startswith(report_id))
+            with open(os.path.join(profile_dir, profiles[0])) as profile_file:
+                header = profile_file.readline()
+        self.assertIn('report %s (slowly.does.it)' % report_id, header)
+        # The trace is logged with the report ID and the time taken by each stage
+        trace_logs = [line for line in logs.output if 'Analysis trace report_id=%s' % report_id in line]
+        self.assertEqual(len(trace_logs), 1)
+        for stage in ['map_all_html', 'tokenize', 'ml_analysis', 'regex_analysis', 'save_sentences']:
+            self.assertRegex(trace_logs[0], r'\b%s=\d+\.\d{3}s' % stage)
+        self.assertTrue(any('Slow analysis profiled report_id=%s' % report_id in line for line in logs.output))
@@ -146,3 +146,7 @@ class TestReportDates(ThreadAppTest):
         self.assertTrue(resp.status < 300, msg='Updating technique dates resulted in a non-200 response.')
         self.assertEqual(hits[0]['start_date'], '2023-08-16', msg='Start date not updated correctly.')
         self.assertEqual(hits[0]['end_date'], '2023-12-25', msg='End date not updated correctly.')
+        # The updated technique and report dates are sent back for the page to display
+        delta = (await resp.json())['delta']
+        self.assertEqual(delta['sentences'][hits[0]['sentence_id']]['confirmed'][0]['start_date'], '2023-08-16')
+        self.assertEqual(delta['report_dates'], dict(end_date='2023-12-25'))
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import unittest
+
+from threadcomponents.service.startup_orchestrator import DONE, FAILED, SKIPPED, StartupOrchestrator
+
+
+class TestStartupOrchestrator(unittest.IsolatedAsyncioTestCase):
+    """A test suite for running the startup steps."""
+
+    async def asyncSetUp(self):
+        self.orchestrator = StartupOrchestrator()
+        self.events = []
+
+    def make_step(self, name, delay=0.0, fail=False):
+        """Helper-method to create a step which notes when it starts and finishes."""
+        async def step():
+            self.events.append(('start', name))
+            await asyncio.sleep(delay)
+            if fail:
+                raise RuntimeError('%s failed' % name)
+            self.events.append(('end', name))
+        return step
+
+    async def test_steps_run_concurrently_after_dependencies(self):
+        """Function to test independent steps overlap whilst dependent steps wait."""
+        database = self.orchestrator.add_step('database', self.make_step('database', delay=0.01))
+        self.orchestrator.add_step('categories', self.make_step('categories', delay=0.05), after=[database])
+        self.orchestrator.add_step('keywords', self.make_step('keywords', delay=0.05), after=[database])
+        self.assertTrue(await self.orchestrator.run())
+        self.assertEqual(self.events[:2], [('start', 'database'), ('end', 'database')])
+        # Both data steps started before either finished
+        self.assertCountEqual(self.events[2:4], [('start', 'categories'), ('start', 'keywords')])
+        status = self.orchestrator.status()
+        self.assertTrue(status['ready'])
+        self.assertEqual({step['state'] for step in status['steps'].values()}, {DONE})
+        self.assertGreaterEqual(status['steps']['keywords']['seconds'], 0.05)
+
+    async def test_ready_without_optional_steps(self):
+        """Function to test the app is ready before steps it does not need have finished."""
+        self.orchestrator.add_step('dropdowns', self.make_step('dropdowns'))
+        self.orchestrator.add_step('nltk', self.make_step('nltk', delay=0.05), needed_for_ready=False)
+        run = asyncio.ensure_future(self.orchestrator.run())
+        await asyncio.wait_for(self.orchestrator.wait_until_ready(), timeout=1)
+        self.assertNotIn(('end', 'nltk'), self.events)
+        await run
+        self.assertIn(('end', 'nltk'), self.events)
+
+    async def test_failed_step_skips_dependants(self):
+        """Function to test a failed step stops the steps depending on it and is reported once the app is ready."""
+        database = self.orchestrator.add_step('database', self.make_step('database', fail=True))
+        self.orchestrator.add_step('dropdowns', self.make_step('dropdowns'), after=[database])
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertFalse(await self.orchestrator.run())
+        finally:
+            logging.disable(logging.NOTSET)
+        status = self.orchestrator.status()
+        self.assertTrue(status['ready'])
+        self.assertEqual(status['failed'], ['database', 'dropdowns'])
+        self.assertEqual(status['steps']['database']['state'], FAILED)
+        self.assertEqual(status['steps']['dropdowns']['state'], SKIPPED)
+
+    def test_unknown_dependency(self):
+        """Function to test a step cannot depend on a step which has not been added."""
+        with self.assertRaises(ValueError):
+            self.orchestrator.add_step('dropdowns', self.make_step('dropdowns'), after=['database'])
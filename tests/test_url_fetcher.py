@@ -0,0 +1,157 @@
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+from threadcomponents.service.ttl_cache import TTLCache
+from threadcomponents.service.url_fetcher import canonicalise_url, FAILED_STATUS, URLFetcher
+from threadcomponents.service.web_svc import WebService
+from unittest.mock import patch
+
+
+class TestURLFetcher(AioHTTPTestCase):
+    """A test suite for fetching URLs with the shared URL-fetcher."""
+
+    async def get_application(self):
+        """Overrides AioHTTPTestCase.get_application()."""
+        self.flaky_calls, self.article_calls = 0, 0
+        app = web.Application()
+        app.router.add_get('/article', self.article)
+        app.router.add_get('/old-article', self.old_article)
+        app.router.add_get('/flaky', self.flaky)
+        app.router.add_get('/canonical/{target:.*}', self.canonical)
+        return app
+
+    async def article(self, request):
+        self.article_calls += 1
+        return web.Response(text='<html><body><p>Hello</p></body></html>', content_type='text/html')
+
+    async def old_article(self, request):
+        raise web.HTTPMovedPermanently(location='/article')
+
+    async def canonical(self, request):
+        link = '<link rel="canonical" href="%s">' % request.match_info['target']
+        return web.Response(text='<html><head>%s</head><body><p>Hello</p></body></html>' % link,
+                            content_type='text/html')
+
+    async def flaky(self, request):
+        self.flaky_calls += 1
+        if self.flaky_calls == 1:
+            raise web.HTTPServiceUnavailable()
+        return web.Response(text='Recovered')
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.web_svc = WebService()
+        self.web_svc.url_fetcher = URLFetcher(retries=1, backoff=0)
+
+    async def asyncTearDown(self):
+        await self.web_svc.close_url_sessions()
+        await super().asyncTearDown()
+
+    async def test_fetch_follows_redirects(self):
+        """Function to test the final URL is returned after a redirect."""
+        response = await self.web_svc.url_fetcher.fetch(str(self.server.make_url('/old-article')), read_body=True)
+        self.assertTrue(response.ok)
+        self.assertEqual(response.url, str(self.server.make_url('/article')))
+        self.assertIn('Hello', response.text)
+
+    async def test_fetch_retries_on_server_error(self):
+        """Function to test a temporary server error is retried."""
+        response = await self.web_svc.url_fetcher.fetch(str(self.server.make_url('/flaky')), read_body=True)
+        self.assertEqual(self.flaky_calls, 2)
+        self.assertEqual(response.text, 'Recovered')
+
+    async def test_fetch_connection_error(self):
+        """Function to test an unreachable URL returns a failed response or raises an error when requested."""
+        url = 'http://127.0.0.1:1/unreachable'
+        response = await self.web_svc.url_fetcher.fetch(url, log_errors=False)
+        self.assertEqual(response.status_code, FAILED_STATUS)
+        with self.assertRaises(ValueError):
+            await self.web_svc.verify_url(None, url=url)
+
+    async def test_urls_match_after_redirect(self):
+        """Function to test two URLs are matched when one redirects to the other."""
+        matched = await self.web_svc.urls_match(testing_url=str(self.server.make_url('/old-article')),
+                                                matches_with=str(self.server.make_url('/article')))
+        self.assertTrue(matched)
+
+    async def test_cached_responses_store_no_body(self):
+        """Function to test a cached URL response keeps the final URL and status but not the body."""
+        url = str(self.server.make_url('/old-article'))
+        await self.web_svc.get_response_from_url(url)
+        cached = self.web_svc.cached_responses.get(url)
+        self.assertEqual(cached.url, str(self.server.make_url('/article')))
+        self.assertEqual(cached.status_code, 200)
+        self.assertIsNone(cached.text)
+        # A second lookup should be served from the cache
+        await self.web_svc.get_response_from_url(url)
+        self.assertEqual(self.web_svc.cached_responses.stats()['hits'], 2)
+
+    async def test_document_downloaded_once(self):
+        """Function to test a document downloaded whilst checking its URL is reused when mapping its html."""
+        url = str(self.server.make_url('/article'))
+        document = self.web_svc.get_document(url)
+        await self.web_svc.get_response_from_url(url, document=document)
+        await self.web_svc.map_all_html(url, document=document)
+        self.assertEqual(self.article_calls, 1)
+        self.assertIn('Hello', document.text)
+        self.assertEqual(document.canonical_url(), url)
+        document.release()
+        self.assertIsNone(document.text)
+
+    async def test_url_keys_canonical_same_site(self):
+        """Function to test a page's canonical link is only a duplicate key if it is another page on the same site."""
+        same_site = str(self.server.make_url('/article'))
+        expected = [(same_site, True), (str(self.server.make_url('/')), False), ('https://other.site/article', False)]
+        for target, is_key in expected:
+            url = str(self.server.make_url('/canonical/' + target))
+            document = self.web_svc.get_document(url)
+            await self.web_svc.get_response_from_url(url, document=document)
+            keys = self.web_svc.get_url_keys(url, document=document)
+            self.assertEqual(canonicalise_url(target) in keys, is_key, msg='Canonical %s handled wrongly.' % target)
+            self.assertIn(canonicalise_url(url), keys)
+
+
+class TestTTLCache(unittest.TestCase):
+    """A test suite for the bounded, expiring cache."""
+
+    def test_size_limit_evicts_least_recently_used(self):
+        """Function to test the least recently used entry is evicted when the cache is full."""
+        cache = TTLCache(max_size=2, ttl=0)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_entries_are_misses(self):
+        """Function to test an entry is not returned once its time-to-live has passed."""
+        cache = TTLCache(max_size=0, ttl=60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        with patch('threadcomponents.service.ttl_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+
+class TestCanonicaliseURL(unittest.TestCase):
+    """A test suite for normalising URLs for duplicate checks."""
+
+    def test_equivalent_urls(self):
+        """Function to test variations of the same URL are given the same canonical URL."""
+        expected = 'https://example.com/news/report?id=2&page=1'
+        for url in ['https://example.com/news/report?id=2&page=1', 'http://EXAMPLE.com:80/news/report/?page=1&id=2',
+                    'https://example.com:443/news/report?utm_source=x&id=2&fbclid=y&page=1#top']:
+            self.assertEqual(canonicalise_url(url), expected)
+
+    def test_different_urls(self):
+        """Function to test different pages are not given the same canonical URL."""
+        self.assertNotEqual(canonicalise_url('https://example.com/news/report?id=2'),
+                            canonicalise_url('https://example.com/news/report?id=3'))
+        self.assertNotEqual(canonicalise_url('https://example.com:8080/a'), canonicalise_url('https://example.com/a'))
+        with self.assertRaises(ValueError):
+            canonicalise_url('not-a-url')
@@ -9,7 +9,6 @@ import sqlite3
 from aiohttp import web
 from aiohttp.test_utils import AioHTTPTestCase
 from contextlib import suppress
-from stix2.base import _STIXBase
 from tests.misc import delete_db_file, SCHEMA_FILE
 from threadcomponents.database.dao import Dao
 from threadcomponents.database.thread_sqlite3 import ThreadSQLite
@@ -19,6 +18,7 @@ from threadcomponents.service import data_svc
 from threadcomponents.service.data_svc import DataService, NO_DESC
 from threadcomponents.service.ml_svc import MLService
 from threadcomponents.service.reg_svc import RegService
+from threadcomponents.service.request_metrics import RequestMetrics
 from threadcomponents.service.rest_svc import ReportStatus, RestService, UID as UID_KEY
 from threadcomponents.service.web_svc import WebService
 from unittest.mock import MagicMock, patch
@@ -58,7 +58,8 @@ class ThreadAppTest(AioHTTPTestCase):
         services = dict(dao=cls.dao, data_svc=cls.data_svc, ml_svc=cls.ml_svc, reg_svc=cls.reg_svc, web_svc=cls.web_svc,
                         rest_svc=cls.rest_svc)
         report_exporter = ReportExporter(services=services)
-        cls.web_api = WebAPI(services=services, report_exporter=report_exporter)
+        cls.request_metrics = RequestMetrics(query_limit=50)
+        cls.web_api = WebAPI(services=services, report_exporter=report_exporter, request_metrics=cls.request_metrics)
         # Duplicate resources so we can test the queue limit without causing limit-exceeding test failures elsewhere
         cls.rest_svc_with_limit = RestService(cls.web_svc, cls.reg_svc, cls.data_svc, cls.ml_svc, cls.dao,
                                               queue_limit=random.randint(1, 20))
@@ -118,13 +119,18 @@ class ThreadAppTest(AioHTTPTestCase):
 
     async def get_application(self):
         """Overrides AioHTTPTestCase.get_application()."""
-        app = web.Application()
+        app = web.Application(middlewares=[self.request_metrics.middleware])
         # Some of the routes we'll be testing
         app.router.add_route('GET', self.web_svc.get_route(WebService.HOME_KEY), self.web_api.index)
         app.router.add_route('GET', self.web_svc.get_route(WebService.EDIT_KEY), self.web_api.edit)
         app.router.add_route('GET', self.web_svc.get_route(WebService.ABOUT_KEY), self.web_api.about)
         app.router.add_route('GET', self.web_svc.get_route(WebService.HOW_IT_WORKS_KEY), self.web_api.how_it_works)
         app.router.add_route('*', self.web_svc.get_route(WebService.REST_KEY), self.web_api.rest_api)
+        app.router.add_route('GET', self.web_svc.get_route(WebService.CATALOGUE_KEY), self.web_api.catalogue)
+        app.router.add_route('GET', self.web_svc.get_route(WebService.METRICS_KEY), self.web_api.metrics)
+        app.router.add_route('GET', self.web_svc.get_route(WebService.EXPORT_PDF_KEY), self.web_api.pdf_export)
+        app.router.add_route('GET', self.web_svc.get_route(WebService.EXPORT_NAV_KEY), self.web_api.nav_export)
+        app.router.add_route('GET', self.web_svc.get_route(WebService.EXPORT_BULK_KEY), self.web_api.bulk_export)
         # A different route for limit-testing
         app.router.add_route('*', '/limit' + self.web_svc.get_route(WebService.REST_KEY),
                              self.web_api_with_limit.rest_api)
@@ -148,11 +154,20 @@ class ThreadAppTest(AioHTTPTestCase):
         """A helper method to set up patches when an insert_* rest endpoint is tested."""
         # We are not passing valid URLs; mock verifying the URLs to raise no errors
         self.create_patch(target=WebService, attribute='verify_url', return_value=None)
-        # Duplicate URL checks will raise an error with malformed URLS; mock this to raise no errors
-        self.create_patch(target=WebService, attribute='urls_match', return_value=False)
         # We don't want the queue to be checked after this test; mock this to return (and do) nothing
         self.create_patch(target=RestService, attribute='check_queue', return_value=None)
 
+    async def get_batch_job_result(self, resp, rest_url='/rest'):
+        """A helper method to wait for and return the outcome of a batch submission given its response."""
+        self.assertEqual(resp.status, 202, msg='Batch submission did not return an accepted job.')
+        job_id = (await resp.json()).get('job_id')
+        while True:
+            status_resp = await self.client.post(rest_url, json=dict(index='batch_job_status', job_id=job_id))
+            result = await status_resp.json() if status_resp.status != 204 else dict(success=1)
+            if not result.get('pending'):
+                return status_resp, result
+            await asyncio.sleep(0.01)
+
     async def submit_test_report(self, report, sentences=None, attacks_found=None, fail_map_html=False,
                                  post_confirm_attack=False, confirm_attack='d99999'):
         """A helper method to submit a test report and create some associated test-sentences."""
@@ -212,8 +227,9 @@ class ThreadAppTest(AioHTTPTestCase):
         for attack in attack_list:
             tid = attack.get('tid', 'Txxxx')
             new_attack_list.append(dict(
-                type='attack-pattern', modified='2022-03-7T00:00:00.000Z', name=attack.get('name', 'No name'),
-                created='2001-07-19T00:00:00.000Z', id=attack.get('uid', random.randint(0, 999999999)),
+                type='attack-pattern', modified=attack.get('modified', '2022-03-7T00:00:00.000Z'),
+                name=attack.get('name', 'No name'), created='2001-07-19T00:00:00.000Z',
+                id=attack.get('uid', random.randint(0, 999999999)),
                 spec_version='2.1', description=attack.get('description', NO_DESC),
                 external_references=[
                     {'url': 'https://attack.mitre.org/techniques/' + tid,
@@ -222,6 +238,4 @@ class ThreadAppTest(AioHTTPTestCase):
                 x_mitre_attack_spec_version='2.1.0', x_mitre_domains=['enterprise-attack'], x_mitre_version='1.0',
             ))
         # Mock the fetch-data method to return our mocked list
-        self.create_patch(target=data_svc, attribute='fetch_attack_data', return_value=dict(objects=new_attack_list))
-        # Prevent the Stix library flagging incorrect data
-        self.create_patch(target=_STIXBase, attribute='_check_property', return_value=False)
+        self.create_patch(target=data_svc, attribute='fetch_attack_data', return_value=iter(new_attack_list))
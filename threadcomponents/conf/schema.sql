@@ -12,6 +12,21 @@ CREATE TABLE IF NOT EXISTS attack_uids (
     name VARCHAR(200)
 );
 
+CREATE TABLE IF NOT EXISTS attack_modified (
+    -- The STIX `modified` timestamp of each attack when it was last synced (to only apply changed attacks)
+    attack_uid VARCHAR(60) PRIMARY KEY,
+    modified VARCHAR(30),
+    FOREIGN KEY(attack_uid) REFERENCES attack_uids(uid) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS attack_hierarchy (
+    -- Links each sub-technique (e.g. T1562.004) to its parent-technique (e.g. T1562)
+    attack_uid VARCHAR(60) PRIMARY KEY,
+    parent_uid VARCHAR(60) NOT NULL,
+    FOREIGN KEY(attack_uid) REFERENCES attack_uids(uid) ON DELETE CASCADE,
+    FOREIGN KEY(parent_uid) REFERENCES attack_uids(uid) ON DELETE CASCADE
+);
+
 CREATE TABLE IF NOT EXISTS reports (
     uid VARCHAR(60) PRIMARY KEY,
     -- The title of the report as submitted by the user
@@ -28,6 +43,11 @@ CREATE TABLE IF NOT EXISTS reports (
     automatically_generated VARCHAR(60) DEFAULT NULL
 );
 
+-- Report titles are looked up by title and allocated by (base_title, title_suffix): the title as submitted and the
+-- number appended to it to make it unique (0 = nothing appended). The build adds these columns (so existing databases
+-- gain them) and their unique index.
+CREATE INDEX IF NOT EXISTS reports_title_idx ON reports (title);
+
 CREATE TABLE IF NOT EXISTS report_sentences (
     uid VARCHAR(60) PRIMARY KEY,
     -- The report which this sentence belongs to
@@ -166,6 +186,9 @@ CREATE TABLE IF NOT EXISTS false_positives (
     FOREIGN KEY(sentence_id) REFERENCES report_sentences(uid) ON DELETE CASCADE
 );
 
+-- Unconfirmed hits are checked for a matching false positive (see get_unconfirmed_undated_attack_count())
+CREATE INDEX IF NOT EXISTS false_positives_sentence_attack_idx ON false_positives (sentence_id, attack_uid);
+
 CREATE TABLE IF NOT EXISTS false_negatives (
     uid VARCHAR(60) PRIMARY KEY,
     -- Attack ID
@@ -219,6 +242,9 @@ CREATE TABLE IF NOT EXISTS report_sentence_hits (
     FOREIGN KEY(sentence_id) REFERENCES report_sentences(uid) ON DELETE CASCADE
 );
 
+-- A report's hits are looked up whenever it is viewed or edited
+CREATE INDEX IF NOT EXISTS report_sentence_hits_report_idx ON report_sentence_hits (report_uid);
+
 CREATE TABLE IF NOT EXISTS original_html (
     uid VARCHAR(60) PRIMARY KEY,
     -- The report ID for this html element
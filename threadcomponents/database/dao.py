@@ -65,6 +65,9 @@ class Dao:
     async def raw_select(self, query, parameters=None, single_col=False):
         return await self.db.raw_select(query, parameters=parameters, single_col=single_col)
 
+    async def select_batch(self, query, parameters=None):
+        return await self.db.select_batch(query, parameters=parameters)
+
     async def run_sql_list(self, sql_list=None, return_success=True):
         return await self.db.run_sql_list(sql_list=sql_list, return_success=return_success)
 
@@ -1,13 +1,29 @@
+import asyncio
+import functools
+import json
 import logging
+import time
 import uuid
 
 from abc import ABC, abstractmethod
-from contextlib import suppress
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from threadcomponents.metrics import REGISTRY
 
 BACKUP_TABLE_SUFFIX = '_initial'
 TABLES_WITH_BACKUPS = ['report_sentences', 'report_sentence_hits', 'original_html']
 # The beginning and end strings of an SQL create statement
 CREATE_BEGIN, CREATE_END = 'CREATE TABLE IF NOT EXISTS', ');'
+# Columns added to tables since their first release: build() also adds these to the tables of existing databases
+ADDED_COLUMNS = dict(reports=['base_title', 'title_suffix'])
+# Statements build() runs once the added columns exist: reports from before title suffixes keep their title as-is but
+# reports with the same title (titles were not allocated atomically) are numbered by ID so their keys are unique
+ADDED_COLUMNS_SQL = [
+    'UPDATE reports SET title_suffix = (SELECT COUNT(*) FROM reports AS earlier WHERE earlier.base_title IS NULL '
+    'AND earlier.title = reports.title AND earlier.uid < reports.uid) WHERE base_title IS NULL;',
+    'UPDATE reports SET base_title = title WHERE base_title IS NULL;',
+    'CREATE UNIQUE INDEX IF NOT EXISTS reports_base_title_suffix_idx ON reports (base_title, title_suffix);'
+]
 
 
 def find_create_statement_in_schema(schema, table, log_error=True, find_closing_bracket=False):
@@ -45,6 +61,62 @@ def find_create_statement_in_schema(schema, table, log_error=True, find_closing_
     return start_pos, (start_pos + end_pos)
 
 
+class QueryStats:
+    """A count of the queries run (and the time spent running them) on behalf of something, e.g. a request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # Tasks started by a request inherit its context: once closed, their queries are no longer counted
+        self.closed = False
+
+    def add(self, seconds):
+        """Function to record a query which took a number of seconds."""
+        if not self.closed:
+            self.count += 1
+            self.seconds += seconds
+
+
+# The QueryStats (if any) recording the queries made in the current context
+query_stats = ContextVar('query_stats', default=None)
+# Every method running SQL opens (and closes) its own connection
+DB_QUERY_SECONDS = REGISTRY.histogram('thread_db_query_seconds', 'Time taken to run database statements.',
+                                      label_names=('operation',))
+DB_CONNECTIONS = REGISTRY.counter('thread_db_connections_total', 'Database connections opened.')
+DB_CONNECTIONS_OPEN = REGISTRY.gauge('thread_db_connections_open', 'Database connections currently open.')
+
+
+@contextmanager
+def tracked_connection():
+    """Context manager to count a database connection while it is open."""
+    DB_CONNECTIONS.inc()
+    DB_CONNECTIONS_OPEN.inc()
+    try:
+        yield
+    finally:
+        DB_CONNECTIONS_OPEN.dec()
+
+
+def timed_query(method):
+    """Decorator for the (async) methods running SQL to record each call's duration (adding it to the current
+    QueryStats if there is one)."""
+    operation = method.__name__.replace('_execute_', '').strip('_')
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracked_connection():
+                return await method(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            DB_QUERY_SECONDS.observe(seconds, operation=operation)
+            stats = query_stats.get()
+            if stats is not None:
+                stats.add(seconds)
+    return wrapper
+
+
 class ThreadDB(ABC):
     """A base class for DB tasks (where the SQL statements are the same across DB engines)."""
     IS_SQL_LITE = False
@@ -53,12 +125,18 @@ class ThreadDB(ABC):
     FUNC_STR_POS = 'string_pos'
     FUNC_TIME_NOW = 'time_now'
     FUNC_DATE_TO_STR = 'to_char'
+    FUNC_JSON_AGG, FUNC_JSON_OBJECT = 'json_agg', 'json_object'
+    # Whether an aggregate function can be given an ORDER BY for the rows it aggregates
+    AGGREGATE_ORDER_BY = False
 
     def __init__(self, mapped_functions=None):
         # The map to keep track of SQL functions
         self._mapped_functions = dict()
         # The function to find a substring position in a string
         self._mapped_functions[self.FUNC_STR_POS] = 'INSTR'
+        # The functions to aggregate rows into a JSON array and to build a JSON object
+        self._mapped_functions[self.FUNC_JSON_AGG] = 'json_group_array'
+        self._mapped_functions[self.FUNC_JSON_OBJECT] = 'json_object'
         # Update mapped_functions if provided
         if mapped_functions is not None:
             self._mapped_functions.update(mapped_functions)
@@ -121,6 +199,12 @@ class ThreadDB(ABC):
         else:
             return schema[:end_pos] + ' ' + column + ', ' + schema[end_pos:]
 
+    @staticmethod
+    def added_columns(schema_updates):
+        """Function to return the (table, SQL field) of the schema updates which existing tables need adding."""
+        return [(table, sql_field) for table, sql_field, _, _ in schema_updates
+                if sql_field.split()[0] in ADDED_COLUMNS.get(table, [])]
+
     @staticmethod
     def generate_copied_tables(schema=''):
         """Function to return a new schema that has copied structures of report-sentence tables from a given schema."""
@@ -147,6 +231,7 @@ class ThreadDB(ABC):
         """Method to build the db given a schema."""
         pass
 
+    # Implementations decorate the methods below which run SQL with @timed_query so each query can be accounted for
     @abstractmethod
     async def _get_column_names(self, sql):
         """Method to get column names for data retrieved by a given SQL statement."""
@@ -172,6 +257,19 @@ class ThreadDB(ABC):
         """Method to connect to the db and execute a list of SQL statements in a single transaction."""
         pass
 
+    @abstractmethod
+    def _select_rows(self, sql, parameters=None):
+        """Method to run an SQL SELECT query on a new connection (closed before returning) and return its rows as
+        dictionaries. This is not async so it can be run in a worker thread."""
+        pass
+
+    @timed_query
+    async def select_batch(self, sql, parameters=None):
+        """Method to run an SQL SELECT query for a batch of a long read (e.g. a bulk export) in a worker thread. Each
+        batch has its own short-lived connection so no transaction (or lock) is held between batches."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self._select_rows, sql, parameters))
+
     async def raw_select(self, sql, parameters=None, single_col=False):
         """Method to run a constructed SQL SELECT query."""
         return await self._execute_select(sql, parameters=parameters, single_col=single_col)
@@ -193,6 +291,26 @@ class ThreadDB(ABC):
         converter = self.get_function_name(self.FUNC_DATE_TO_STR, sql, 'YYYY-MM-DD', unquote=[sql])
         return "%s AS %s" % (converter or sql, field_name_as)
 
+    def sql_json_agg(self, fields, field_name_as, order_by=None):
+        """Method that returns a statement aggregating the rows of a group into a JSON array of objects, given the
+        objects' fields as a dictionary of key -> sql."""
+        json_object = '%s(%s)' % (self.get_function_name(self.FUNC_JSON_OBJECT),
+                                  ', '.join("'%s', %s" % (key, sql) for key, sql in fields.items()))
+        # If the rows cannot be ordered here, json_agg_value() orders them
+        if order_by and self.AGGREGATE_ORDER_BY:
+            json_object += ' ORDER BY ' + order_by
+        return '%s(%s) AS %s' % (self.get_function_name(self.FUNC_JSON_AGG), json_object, field_name_as)
+
+    def json_agg_value(self, value, order_by=None):
+        """Method that returns a column from sql_json_agg() as a list (the db may return the JSON as a string),
+        ordering the objects by the order_by key if the db could not."""
+        if isinstance(value, str):
+            value = json.loads(value)
+        value = value or []
+        if order_by and not self.AGGREGATE_ORDER_BY:
+            value.sort(key=lambda json_object: json_object.get(order_by))
+        return value
+
     @staticmethod
     def _check_method_parameters(table, data, data_allowed_as_none=False, method_name='unspecified'):
         """Function to check parameters passed to CRUD methods."""
@@ -3,7 +3,7 @@ import os
 import psycopg2
 import psycopg2.extras
 
-from .thread_db import ThreadDB
+from .thread_db import ADDED_COLUMNS_SQL, ThreadDB, timed_query
 from getpass import getpass
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
@@ -78,6 +78,8 @@ def _create_tables(db_name, username, password, host, port, schema='', is_partia
         ('reports', 'date_written TIMESTAMP WITH TIME ZONE', not_partial_log, is_partial),
         ('reports', start_date_field, not_partial_log, is_partial),
         ('reports', end_date_field, not_partial_log, is_partial),
+        ('reports', 'base_title VARCHAR(210)', not_partial_log, is_partial),
+        ('reports', 'title_suffix INTEGER DEFAULT 0', not_partial_log, is_partial),
         ('report_sentence_hits', start_date_field, not_partial_log, is_partial),
         ('report_sentence_hits', end_date_field, not_partial_log, is_partial),
         # (3) and (4) are inverse above because report_sentence_hits_initial is from partial schema
@@ -94,6 +96,11 @@ def _create_tables(db_name, username, password, host, port, schema='', is_partia
         except ValueError as e:
             if not ignore_value_error:
                 raise e
+    if not is_partial:
+        # Existing databases already have their tables so add any columns these are missing
+        schema += '\n' + '\n'.join('ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s;' % added
+                                     for added in ThreadDB.added_columns(schema_updates))
+        schema += '\n' + '\n'.join(ADDED_COLUMNS_SQL)
     connection = None
     try:
         # Set up a connection to the specified database
@@ -110,6 +117,7 @@ def _create_tables(db_name, username, password, host, port, schema='', is_partia
 
 class ThreadPostgreSQL(ThreadDB):
     IS_POSTGRESQL = True
+    AGGREGATE_ORDER_BY = True
     db_name = None
 
     def __init__(self, db_connection_func=None):
@@ -118,6 +126,8 @@ class ThreadPostgreSQL(ThreadDB):
         function_name_map[self.FUNC_STR_POS] = 'STRPOS'
         function_name_map[self.FUNC_TIME_NOW] = 'NOW'
         function_name_map[self.FUNC_DATE_TO_STR] = 'TO_CHAR'
+        function_name_map[self.FUNC_JSON_AGG] = 'jsonb_agg'
+        function_name_map[self.FUNC_JSON_OBJECT] = 'jsonb_build_object'
         super().__init__(mapped_functions=function_name_map)
         db_connection_func = db_connection_func if callable(db_connection_func) else get_db_info
         self.db_name, self.username, self.password, self.host, self.port = db_connection_func()
@@ -166,6 +176,7 @@ class ThreadPostgreSQL(ThreadDB):
         # If we're returning a success-boolean, return that; else return any value obtained
         return success if return_success else return_val
 
+    @timed_query
     async def _get_column_names(self, sql):
         """Implements ThreadDB._get_column_names()"""
         def cursor_select(cursor):
@@ -175,6 +186,7 @@ class ThreadPostgreSQL(ThreadDB):
             return [desc[0] for desc in cursor.description]
         return self._connection_wrapper(cursor_select, cursor_factory=psycopg2.extras.DictCursor)
 
+    @timed_query
     async def _execute_select(self, sql, parameters=None, single_col=False, on_fetch=None):
         """Implements ThreadDB._execute_select()"""
         def cursor_select(cursor):
@@ -192,6 +204,15 @@ class ThreadPostgreSQL(ThreadDB):
                 return [ix[0] for ix in rows] if single_col else [dict(ix) for ix in rows]
         return self._connection_wrapper(cursor_select, cursor_factory=psycopg2.extras.DictCursor)
 
+    def _select_rows(self, sql, parameters=None):
+        """Implements ThreadDB._select_rows()"""
+        def cursor_select(cursor):
+            cursor.execute(sql, parameters)
+            return [dict(row) for row in cursor.fetchall()]
+        # The transaction is committed (and the connection closed) once this batch's rows are fetched
+        return self._connection_wrapper(cursor_select, cursor_factory=psycopg2.extras.DictCursor) or []
+
+    @timed_query
     async def _execute_insert(self, sql, data):
         """Implements ThreadDB._execute_insert()"""
         def cursor_insert(cursor):
@@ -200,6 +221,7 @@ class ThreadPostgreSQL(ThreadDB):
             return cursor.lastrowid
         return self._connection_wrapper(cursor_insert)
 
+    @timed_query
     async def _execute_update(self, sql, data):
         """Implements ThreadDB._execute_update()"""
         # Nothing extra do to or return: just execute the SQL statement with the data to update
@@ -214,6 +236,7 @@ class ThreadPostgreSQL(ThreadDB):
         results = await self.raw_select('SELECT array(SELECT %s FROM %s)' % (column, table))
         return results[0]['array']  # Let a KeyError raise if 'array' doesn't work - this means the library changed
 
+    @timed_query
     async def run_sql_list(self, sql_list=None, return_success=True):
         """Implements ThreadDB.run_sql_list()"""
         def cursor_multiple_execute(cursor):
@@ -5,7 +5,8 @@
 import logging
 import sqlite3
 
-from .thread_db import ThreadDB
+from contextlib import closing
+from .thread_db import ADDED_COLUMNS_SQL, ThreadDB, timed_query
 
 ENABLE_FOREIGN_KEYS = 'PRAGMA foreign_keys = ON;'
 
@@ -40,6 +41,8 @@ class ThreadSQLite(ThreadDB):
             ('reports', 'date_written TEXT', not_partial_log, is_partial),
             ('reports', start_date_field, not_partial_log, is_partial),
             ('reports', end_date_field, not_partial_log, is_partial),
+            ('reports', 'base_title VARCHAR(210)', not_partial_log, is_partial),
+            ('reports', 'title_suffix INTEGER DEFAULT 0', not_partial_log, is_partial),
             ('report_sentence_hits', start_date_field, not_partial_log, is_partial),
             ('report_sentence_hits', end_date_field, not_partial_log, is_partial),
             ('report_sentence_hits_initial', start_date_field, partial_log, not is_partial),
@@ -62,7 +65,25 @@ class ThreadSQLite(ThreadDB):
                 conn.commit()
         except Exception as exc:
             logging.error('! error building db : {}'.format(exc))
+        if not is_partial:
+            await self._add_columns(schema_updates)
 
+    async def _add_columns(self, schema_updates):
+        """Function to add any columns missing from the tables of an existing database."""
+        try:
+            with sqlite3.connect(self.database) as conn:
+                cursor = conn.cursor()
+                for table, sql_field in self.added_columns(schema_updates):
+                    # sqlite3 cannot add a column only if it does not exist: check the table's columns first
+                    columns = [row[1] for row in cursor.execute('PRAGMA table_info(%s);' % table)]
+                    if sql_field.split()[0] not in columns:
+                        cursor.execute('ALTER TABLE %s ADD COLUMN %s;' % (table, sql_field))
+                cursor.executescript('\n'.join(ADDED_COLUMNS_SQL))
+                conn.commit()
+        except Exception as exc:
+            logging.error('! error adding columns to db : {}'.format(exc))
+
+    @timed_query
     async def _get_column_names(self, sql):
         """Implements ThreadDB._get_column_names()"""
         with sqlite3.connect(self.database) as conn:
@@ -72,6 +93,7 @@ class ThreadSQLite(ThreadDB):
             # Return the column names from the cursor description
             return [desc[0] for desc in cursor.description]
 
+    @timed_query
     async def _execute_select(self, sql, parameters=None, single_col=False, on_fetch=None):
         """Implements ThreadDB._execute_select()"""
         if single_col and on_fetch:
@@ -94,6 +116,13 @@ class ThreadSQLite(ThreadDB):
                 # Return the data as-is if returning a single column, else return the rows as dictionaries
                 return rows if single_col else [dict(ix) for ix in rows]
 
+    def _select_rows(self, sql, parameters=None):
+        """Implements ThreadDB._select_rows()"""
+        with closing(sqlite3.connect(self.database)) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, parameters or ())]
+
+    @timed_query
     async def _execute_insert(self, sql, data):
         """Implements ThreadDB._execute_insert()"""
         with sqlite3.connect(self.database) as conn:
@@ -105,6 +134,7 @@ class ThreadSQLite(ThreadDB):
             conn.commit()
             return saved_id
 
+    @timed_query
     async def _execute_update(self, sql, data):
         """Implements ThreadDB._execute_update()"""
         # Nothing extra do to or return:
@@ -115,6 +145,7 @@ class ThreadSQLite(ThreadDB):
             cursor.execute(sql, tuple(data))
             conn.commit()
 
+    @timed_query
     async def run_sql_list(self, sql_list=None, return_success=True):
         """Implements ThreadDB.run_sql_list()"""
         # Don't do anything if we don't have a list
@@ -2,24 +2,54 @@
 # This file has been moved into a different directory
 # To see its full history, please use `git log --follow <filename>` to view previous commits and additional contributors
 
+import asyncio
+import hmac
+import json
 import logging
 
 from aiohttp.web_exceptions import HTTPException
-from aiohttp_jinja2 import template, web
+from aiohttp_jinja2 import render_string, template, web
 from aiohttp_security import authorized_userid
 from aiohttp_session import get_session
 from datetime import datetime
-from urllib.parse import quote
+from threadcomponents.metrics import EXPOSITION_CONTENT_TYPE, REGISTRY
+from threadcomponents.reports.bulk_exporter import EXPORT_FORMATS, NDJSON
+from threadcomponents.service.page_cache import CachedPage, PageCache
+from threadcomponents.service.request_metrics import REQUEST_INDEX_KEY
+from threadcomponents.service.startup_orchestrator import StartupOrchestrator
+from urllib.parse import quote, urlencode
 
 # The config options to load JS dependencies
 ONLINE_JS_SRC = 'js-online-src'
 OFFLINE_JS_SRC = 'js-local-src'
 # Key for a flag checking when a user has accepted the cookie notice
 ACCEPT_COOKIE = 'accept_cookie_notice'
+# The dropdown catalogues the edit page loads separately (rather than having them in every page)
+ATTACK_CATALOGUE, CATEGORY_CATALOGUE, KEYWORD_CATALOGUE = 'attacks', 'categories', 'keywords'
+COUNTRY_CATALOGUE = 'countries'
+# Catalogue URLs include the catalogue version so browsers can keep a catalogue until it changes
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Report exports can only be kept by the client and have to be revalidated before reuse
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+# Metrics read from the services when the metrics are requested (rather than updated as these change)
+QUEUE_REPORTS = REGISTRY.gauge('thread_queue_reports', 'Reports queued by each user (tokens are hashed).',
+                               label_names=('user',))
+QUEUE_SIZE = REGISTRY.gauge('thread_queue_size', 'Reports waiting to be analysed.')
+ANALYSIS_TASKS = REGISTRY.gauge('thread_analysis_tasks_running', 'Reports being analysed.')
+CACHE_ENTRIES = REGISTRY.gauge('thread_cache_entries', 'Entries held by each cache.', label_names=('cache',))
+CACHE_HITS = REGISTRY.counter('thread_cache_hits_total', 'Cache lookups which found an entry.',
+                              label_names=('cache',))
+CACHE_MISSES = REGISTRY.counter('thread_cache_misses_total', 'Cache lookups which found no entry.',
+                                label_names=('cache',))
+CACHE_EVICTIONS = REGISTRY.counter('thread_cache_evictions_total', 'Cache entries evicted or expired.',
+                                   label_names=('cache',))
+CACHE_HIT_RATIO = REGISTRY.gauge('thread_cache_hit_ratio', 'Proportion of cache lookups which found an entry.',
+                                 label_names=('cache',))
 
 
 class WebAPI:
-    def __init__(self, services, report_exporter, js_src=None):
+    def __init__(self, services, report_exporter, js_src=None, index_page_size=None, static_assets=None,
+                 request_metrics=None, metrics_token=None):
         self.dao = services['dao']
         self.data_svc = services['data_svc']
         self.web_svc = services['web_svc']
@@ -29,6 +59,14 @@ class WebAPI:
         self.report_statuses = self.rest_svc.get_status_enum()
         self.is_local = self.web_svc.is_local
         self.report_exporter = report_exporter
+        # The maximum number of reports to display in each status column of the index page (None for no limit)
+        self.index_page_size = index_page_size
+        # The StaticAssets giving static files content-hashed URLs (if not set, static files use their own paths)
+        self.static_assets = static_assets
+        # The RequestMetrics timing requests (if its middleware is used)
+        self.request_metrics = request_metrics
+        # The token a non-local app's metrics are requested with (if not set, these are only served for local-use)
+        self.metrics_token = metrics_token
         js_src_config = js_src if js_src in [ONLINE_JS_SRC, OFFLINE_JS_SRC] else ONLINE_JS_SRC
         self.BASE_PAGE_DATA = dict(about_url=self.web_svc.get_route(self.web_svc.ABOUT_KEY),
                                    home_url=self.web_svc.get_route(self.web_svc.HOME_KEY),
@@ -36,14 +74,24 @@ class WebAPI:
                                    what_to_submit_url=self.web_svc.get_route(self.web_svc.WHAT_TO_SUBMIT_KEY),
                                    rest_url=self.web_svc.get_route(self.web_svc.REST_KEY),
                                    static_url=self.web_svc.get_route(self.web_svc.STATIC_KEY),
+                                   static_asset=self.static_asset_url,
                                    js_src_online=js_src_config == ONLINE_JS_SRC, is_local=self.is_local)
         self.attack_dropdown_list = []
         self.cat_dropdown_list = []
         self.web_svc.keyword_dropdown_list = []
+        # The StartupOrchestrator running the steps needed before pages can be served
+        self.startup = None
+        # Rendered pages whose content only changes on deploy
+        self.page_cache = PageCache()
+        # Catalogue name -> CachedPage of its JSON (updated when the dropdown lists are set)
+        self.catalogues = dict()
 
     async def set_attack_dropdown_list(self):
         """Function to set the attack-dropdown-list used to add/reject attacks in a report."""
         self.attack_dropdown_list = await self.data_svc.get_techniques(get_parent_info=True)
+        self.publish_catalogue(ATTACK_CATALOGUE, [dict(uid=attack['uid'], name=attack['name'],
+                                                       parent_name=attack.get('parent_name'))
+                                                  for attack in self.attack_dropdown_list])
 
     async def set_keyword_dropdown_list(self):
         """Function to set the keyword-dropdown-list used to select aggressors and victims in a report."""
@@ -54,19 +102,135 @@ class WebAPI:
         non_apt_query = "SELECT name FROM keywords WHERE name NOT LIKE 'APT%' ORDER BY name"
         r2 = await self.dao.raw_select(non_apt_query, single_col=True)
         self.web_svc.keyword_dropdown_list = r1 + r2
+        self.publish_catalogue(KEYWORD_CATALOGUE, self.web_svc.keyword_dropdown_list)
 
-    async def pre_launch_init(self):
-        """Function to call any required methods before the app is initialised and launched."""
-        # We want nltk packs downloaded before startup; not run concurrently with startup
-        await self.ml_svc.check_nltk_packs()
+    async def set_category_dropdown_list(self):
+        """Function to set the category-dropdown-list used to select categories in a report."""
+        self.cat_dropdown_list = await self.data_svc.get_all_categories()
+        self.publish_catalogue(CATEGORY_CATALOGUE, [dict(keyname=category['keyname'],
+                                                         display_name=category['display_name'])
+                                                    for category in self.cat_dropdown_list])
+
+    def publish_catalogue(self, name, data):
+        """Function to (re)generate the JSON of a dropdown catalogue, giving it a new version if its data changed."""
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        current = self.catalogues.get(name)
+        if (current is None) or (current.body != body):
+            self.catalogues[name] = CachedPage(body, content_type='application/json', strong_etag=True)
+
+    def get_catalogue(self, name):
+        """Function to return the CachedPage of a dropdown catalogue (None if there is no such catalogue)."""
+        # The regions and countries are only read from file at startup: publish these when first needed
+        if (name == COUNTRY_CATALOGUE) and (name not in self.catalogues):
+            # Regions and countries are lists (not objects) as browsers would reorder the numeric region IDs
+            self.publish_catalogue(name, dict(regions=list(self.data_svc.region_dict.items()),
+                                              countries=list(self.data_svc.country_dict.items()),
+                                              country_regions=self.data_svc.country_region_dict))
+        return self.catalogues.get(name)
+
+    def catalogue_url(self, name):
+        """Function to return the (versioned) URL of a dropdown catalogue."""
+        catalogue = self.get_catalogue(name)
+        if catalogue is None:
+            return None
+        return self.web_svc.get_route(self.web_svc.CATALOGUE_KEY, param='%s.%s.json' % (name, catalogue.version))
+
+    async def catalogue(self, request):
+        """Function to serve a dropdown catalogue, which can be cached indefinitely if its current version is asked."""
+        name, _, version = request.match_info.get(self.web_svc.REPORT_PARAM, '').rsplit('.json', 1)[0].partition('.')
+        catalogue = self.get_catalogue(name)
+        if catalogue is None:
+            raise web.HTTPNotFound()
+        # An old version (e.g. from a page loaded before the catalogue changed) gets the current data uncached
+        cache_control = IMMUTABLE_CACHE_CONTROL if version == catalogue.version else 'no-cache'
+        return catalogue.response(request, cache_control=cache_control)
+
+    def static_asset_url(self, path):
+        """Function to return the URL of a static file (under webapp/theme) for templates to use."""
+        if self.static_assets:
+            return self.static_assets.url(path)
+        return self.web_svc.get_route(self.web_svc.STATIC_KEY) + path
+
+    async def build_static_assets(self):
+        """Function to fingerprint and compress the static files (in a thread as this reads and compresses files)."""
+        await asyncio.get_running_loop().run_in_executor(None, self.static_assets.build)
+
+    def add_pre_launch_steps(self, orchestrator, database_step=None, attack_step=None, category_step=None,
+                             keyword_step=None):
+        """Function to add the steps needed before the app can serve pages to a StartupOrchestrator. Each step waits
+        for the (optional) named steps which build the data it reads."""
+        self.startup = orchestrator
         # Before the app starts up, prepare the queue of reports
-        await self.rest_svc.prepare_queue()
+        orchestrator.add_step('prepare_queue', self.rest_svc.prepare_queue, after=[database_step])
         # We want the list of attacks, categories and keywords ready before the app starts
-        await self.set_attack_dropdown_list()
-        self.cat_dropdown_list = await self.data_svc.get_all_categories()
-        await self.set_keyword_dropdown_list()
+        # (the links between sub-techniques and their parents are refreshed first, e.g. for databases built before
+        # these were stored)
+        hierarchy_step = orchestrator.add_step('refresh_attack_hierarchy', self.data_svc.refresh_attack_hierarchy,
+                                               after=[database_step, attack_step])
+        orchestrator.add_step('set_attack_dropdown_list', self.set_attack_dropdown_list, after=[hierarchy_step])
+        orchestrator.add_step('set_category_dropdown_list', self.set_category_dropdown_list,
+                              after=[database_step, category_step])
+        orchestrator.add_step('set_keyword_dropdown_list', self.set_keyword_dropdown_list,
+                              after=[database_step, keyword_step])
         # We want column names ready
-        await self.dao.db.initialise_column_names()
+        orchestrator.add_step('initialise_column_names', self.dao.db.initialise_column_names, after=[database_step])
+        # Pages refer to the hashed URLs of static files so these need to be ready
+        if self.static_assets:
+            orchestrator.add_step('build_static_assets', self.build_static_assets)
+
+    async def pre_launch_init(self, profiler=None):
+        """Function to call any required methods before the app is initialised and launched."""
+        # nltk packs are no longer checked here: this is done once the app has started (before the first analysis)
+        orchestrator = StartupOrchestrator(profiler=profiler)
+        self.add_pre_launch_steps(orchestrator)
+        await orchestrator.run()
+
+    @web.middleware
+    async def startup_gate(self, request, handler):
+        """Function to intercept requests made before the app is ready, asking the client to retry later."""
+        # Readiness and metrics are available while starting up (e.g. to follow the startup's progress)
+        available = [self.web_svc.get_route(self.web_svc.READY_KEY), self.web_svc.get_route(self.web_svc.METRICS_KEY)]
+        if (self.startup is None) or self.startup.ready or (request.path in available) or request.path.startswith(
+                self.web_svc.get_route(self.web_svc.STATIC_KEY)):
+            return await handler(request)
+        raise web.HTTPServiceUnavailable(text='Thread is starting up; please try again shortly.',
+                                         headers={'Retry-After': '5'})
+
+    def caches(self):
+        """Function to return the caches (by name) whose usage is included in the metrics."""
+        return dict(url_responses=self.web_svc.cached_responses, report_listings=self.data_svc.report_listings,
+                    report_hit_index=self.rest_svc.report_hit_index, report_exports=self.report_exporter.export_cache,
+                    pages=self.page_cache.pages)
+
+    def collect_metrics(self):
+        """Function to update the metrics which are read from the services (the queues and caches)."""
+        QUEUE_REPORTS.set_all(self.rest_svc.queue_sizes())
+        QUEUE_SIZE.set(self.rest_svc.queue.qsize())
+        ANALYSIS_TASKS.set(len([task for task in self.rest_svc.current_tasks if not task.done()]))
+        stats = {name: cache.stats() for name, cache in self.caches().items()}
+        for metric, stat in [(CACHE_ENTRIES, 'size'), (CACHE_HITS, 'hits'), (CACHE_MISSES, 'misses'),
+                             (CACHE_EVICTIONS, 'evictions')]:
+            metric.set_all({name: cache_stats[stat] for name, cache_stats in stats.items()})
+        # Caches which have not been used yet have no hit rate
+        CACHE_HIT_RATIO.set_all({name: cache_stats['hit_rate'] for name, cache_stats in stats.items()
+                                 if cache_stats['hit_rate'] is not None})
+
+    async def metrics(self, request):
+        """Function to serve the app's metrics in the Prometheus text format."""
+        # The metrics describe the app's usage so a non-local app only serves these to a scraper with the token
+        if not self.is_local:
+            authorization = request.headers.get('Authorization', '')
+            if not (self.metrics_token and hmac.compare_digest(authorization.encode('utf-8'),
+                                                               ('Bearer ' + self.metrics_token).encode('utf-8'))):
+                raise web.HTTPNotFound()
+        self.collect_metrics()
+        return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Cache-Control': 'no-store'},
+                            content_type=EXPOSITION_CONTENT_TYPE.split(';')[0], charset='utf-8')
+
+    async def readiness(self, request):
+        """Function to report whether the app has finished the startup steps it needs (and how long each took)."""
+        status = self.startup.status() if self.startup else dict(ready=False, failed=[], steps=dict())
+        return web.json_response(status, status=200 if status['ready'] else 503)
 
     async def fetch_and_update_attack_data(self):
         """Function to fetch and update the attack data."""
@@ -89,15 +253,25 @@ class WebAPI:
         # If there is no data dictionary to update, there is nothing to do
         if not isinstance(data, dict):
             return
-        # Update data with the base page data
-        data.update(self.BASE_PAGE_DATA)
+        data.update(self.base_page_data(hide_cookie_notice=await self.cookie_notice_hidden(request)))
+
+    def base_page_data(self, hide_cookie_notice=False):
+        """Function to return the base page data given whether the cookie notice has been dismissed."""
+        data = dict(self.BASE_PAGE_DATA)
         data.update(current_year=datetime.now().strftime('%Y'))
         # Non-local sessions include cookies, update context data for this
         if not self.is_local:
-            # Check request if the cookie banner has been dismissed
-            session = await get_session(request)
-            data.update(hide_cookie_notice=session.get(ACCEPT_COOKIE, False),
+            data.update(hide_cookie_notice=hide_cookie_notice,
                         cookie_url=self.web_svc.get_route(self.web_svc.COOKIE_KEY))
+        return data
+
+    async def cookie_notice_hidden(self, request):
+        """Function to return whether a request's session has dismissed the cookie notice."""
+        # There is no cookie notice for local-use (so no need to look up the session)
+        if self.is_local:
+            return False
+        session = await get_session(request)
+        return session.get(ACCEPT_COOKIE, False)
 
     @staticmethod
     @web.middleware
@@ -136,23 +310,27 @@ class WebAPI:
         response.content_type = 'text/html'
         return response
 
-    @template('about.html')
+    async def cached_page(self, request, template_name, title):
+        """Function to return a page which only changes on deploy, rendering it only if it is not cached."""
+        hide_cookie_notice = await self.cookie_notice_hidden(request)
+        # Only what can change the page between requests is part of the key
+        key = (template_name, self.BASE_PAGE_DATA['js_src_online'], datetime.now().strftime('%Y'), hide_cookie_notice)
+
+        def render():
+            page_data = self.base_page_data(hide_cookie_notice=hide_cookie_notice)
+            page_data.update(title=title)
+            return render_string(template_name, request, page_data)
+
+        return self.page_cache.get_page(key, render).response(request)
+
     async def about(self, request):
-        page_data = dict(title='Using Thread')
-        await self.add_base_page_data(request, data=page_data)
-        return page_data
+        return await self.cached_page(request, 'about.html', 'Using Thread')
 
-    @template('what-to-submit.html')
     async def what_to_submit(self, request):
-        page_data = dict(title='What Can I Submit?')
-        await self.add_base_page_data(request, data=page_data)
-        return page_data
+        return await self.cached_page(request, 'what-to-submit.html', 'What Can I Submit?')
 
-    @template('how-it-works.html')
     async def how_it_works(self, request):
-        page_data = dict(title='How Thread Works')
-        await self.add_base_page_data(request, data=page_data)
-        return page_data
+        return await self.cached_page(request, 'how-it-works.html', 'How Thread Works')
 
     @template('index.html')
     async def index(self, request):
@@ -170,6 +348,8 @@ class WebAPI:
                 template_data.update(username=username)
         # For each report status, get the reports for the index page
         for status in self.report_statuses:
+            # Each column is paged separately (e.g. ?completed_page=2) so paging one leaves the others in place
+            page = self._requested_page(request, status.value)
             is_complete_status = status.value == self.report_statuses.COMPLETED.value
             # Properties for all statuses when displayed on the index page
             page_data[status.value] = \
@@ -178,15 +358,18 @@ class WebAPI:
                      analysis_button='View Analysis' if is_complete_status else 'Analyse')
             # If the status is 'queue', obtain errored reports separately so we can provide info without these
             if status.value == self.report_statuses.QUEUE.value:
-                pending = await self.data_svc.status_grouper(
-                    status.value, criteria=dict(error=self.dao.db_false_val, token=verified_token))
-                errored = await self.data_svc.status_grouper(
-                    status.value, criteria=dict(error=self.dao.db_true_val, token=verified_token))
-                page_data[status.value]['reports'] = pending + errored
+                pending = await self.data_svc.report_listing(
+                    status.value, criteria=dict(error=self.dao.db_false_val, token=verified_token),
+                    page_size=self.index_page_size, page=page)
+                errored = await self.data_svc.report_listing(
+                    status.value, criteria=dict(error=self.dao.db_true_val, token=verified_token),
+                    page_size=self.index_page_size, page=page)
+                page_data[status.value]['reports'] = pending['reports'] + errored['reports']
+                more_reports = self._has_more_reports(pending, page) or self._has_more_reports(errored, page)
                 if self.rest_svc.QUEUE_LIMIT:
                     template_data['queue_set'] = 1
                     # Extra info for queued reports if a queue limit was set
-                    queue_ratio = (len(pending), self.rest_svc.QUEUE_LIMIT)
+                    queue_ratio = (pending['total'], self.rest_svc.QUEUE_LIMIT)
                     # Add to the display name the fraction of the queue limit used
                     page_data[status.value]['display_name'] += ' (%s/%s)' % queue_ratio
                     # Also add a fuller sentence describing the fraction
@@ -199,14 +382,39 @@ class WebAPI:
                 page_data[status.value]['error_msg'] = 'Sorry, the contents of this report could not be retrieved.'
             # Else proceed to obtain the reports for this status as normal
             else:
-                page_data[status.value]['reports'] = \
-                    await self.data_svc.status_grouper(status.value, criteria=dict(token=verified_token))
+                listing = await self.data_svc.report_listing(status.value, criteria=dict(token=verified_token),
+                                                             page_size=self.index_page_size, page=page)
+                page_data[status.value]['reports'] = listing['reports']
+                more_reports = self._has_more_reports(listing, page)
             # Allow only mid-review reports to be rollbacked
             page_data[status.value]['allow_rollback'] = status.value == self.report_statuses.IN_REVIEW.value
+            # Links to this column's neighbouring pages if there are any
+            page_data[status.value].update(
+                previous_page=self._page_link(request, status.value, page - 1) if page > 1 else None,
+                next_page=self._page_link(request, status.value, page + 1) if more_reports else None)
         # Update overall template data and return
         template_data.update(reports_by_status=page_data)
         return template_data
 
+    @staticmethod
+    def _requested_page(request, status):
+        """Function to get the page of reports requested for a status's column on the index page."""
+        try:
+            return max(1, int(request.query.get('%s_page' % status, 1)))
+        except ValueError:
+            return 1
+
+    @staticmethod
+    def _page_link(request, status, page):
+        """Function to get the index-page link to a page of a status's column (keeping the other columns' pages)."""
+        query = dict(request.query)
+        query['%s_page' % status] = page
+        return '?' + urlencode(query)
+
+    def _has_more_reports(self, listing, page):
+        """Function to check if a report listing has reports after the given page."""
+        return bool(self.index_page_size) and listing['total'] > page * self.index_page_size
+
     async def rest_api(self, request):
         """
         Function to handle rest api calls
@@ -223,11 +431,13 @@ class WebAPI:
                     set_status=lambda d: self.rest_svc.set_status(request=request, criteria=d),
                     insert_report=lambda d: self.rest_svc.insert_report(request=request, criteria=d),
                     insert_csv=lambda d: self.rest_svc.insert_csv(request=request, criteria=d),
+                    batch_job_status=lambda d: self.rest_svc.batch_job_status(request=request, criteria=d),
                     remove_sentence=lambda d: self.rest_svc.remove_sentence(request=request, criteria=d),
                     delete_report=lambda d: self.rest_svc.delete_report(request=request, criteria=d),
                     rollback_report=lambda d: self.rest_svc.rollback_report(request=request, criteria=d),
                     sentence_context=lambda d: self.rest_svc.sentence_context(request=request, criteria=d),
                     confirmed_attacks=lambda d: self.rest_svc.confirmed_attacks(request=request, criteria=d),
+                    sentence_index=lambda d: self.rest_svc.sentence_index(request=request, criteria=d),
                     update_report_dates=lambda d: self.rest_svc.update_report_dates(request=request, criteria=d),
                     update_attack_time=lambda d: self.rest_svc.update_attack_time(request=request, criteria=d),
                     set_report_keywords=lambda d: self.rest_svc.set_report_keywords(request=request, criteria=d),
@@ -242,11 +452,16 @@ class WebAPI:
             method = options[request.method][index]
         except KeyError:
             return web.json_response(None, status=404)
+        # Time each REST function separately (only known functions are labelled so the labels are a fixed set)
+        request[REQUEST_INDEX_KEY] = index
         output = await method(data)
         status = 200
         if (output is not None) and (not isinstance(output, dict)):
             pass
-        elif (output is None) or (output.get('success') and not output.get('alert_user')):
+        elif (output is not None) and output.get('job_id'):
+            status = 202
+        # A success with nothing for the user or page to update has no content to return
+        elif (output is None) or (output.get('success') and not (output.get('alert_user') or output.get('delta'))):
             status = 204
         elif output.get('ignored'):
             status = 202
@@ -284,24 +499,25 @@ class WebAPI:
         categories = await self.data_svc.get_report_categories_for_display(report_id, include_keynames=True)
         keywords = await self.data_svc.get_report_aggressors_victims(report_id)
         indicators_of_compromise = await self.data_svc.get_report_sentence_indicators_of_compromise(report_id)
+        ioc_sentence_ids = {ioc['sentence_id'] for ioc in indicators_of_compromise}
         for sentence in sentences:
-            sentence['is_ioc'] = any(ioc['sentence_id'] == sentence['uid'] for ioc in indicators_of_compromise)
+            sentence['is_ioc'] = sentence['uid'] in ioc_sentence_ids
         original_html = await self.dao.get('original_html', equal=dict(report_uid=report_id),
                                            order_by_asc=dict(elem_index=1))
         final_html = await self.web_svc.build_final_html(original_html, sentences)
         pdf_link = self.web_svc.get_route(self.web_svc.EXPORT_PDF_KEY, param=title_quoted)
         nav_link = self.web_svc.get_route(self.web_svc.EXPORT_NAV_KEY, param=title_quoted)
         # Add some help-text
-        completed_info, private_info, sen_limit_help = None, None, None
+        private_info, sen_limit_help = None, None
         is_completed = int(report_status == self.report_statuses.COMPLETED.value)
         if report[0]['token']:
             private_info = 'This is a private report. If this page becomes unresponsive, please refresh or ' \
                            'visit the Arachne site to check your session has not expired.'
-        if is_completed:
-            completed_info = 'This is a <b>completed</b> report. You can still click on sentences to view confirmed ' \
-                + 'techniques. You can also click the Export PDF button to generate a PDF of this completed report.'
-            if not self.is_local:
-                completed_info += '<br><br><b>Completed reports will expire 24 hours after completion.</b>'
+        # The completed-report help-text is included (but hidden) for reports in review, to show once completed
+        completed_info = 'This is a <b>completed</b> report. You can still click on sentences to view confirmed ' \
+            + 'techniques. You can also click the Export PDF button to generate a PDF of this completed report.'
+        if not self.is_local:
+            completed_info += '<br><br><b>Completed reports will expire 24 hours after completion.</b>'
         if self.rest_svc.SENTENCE_LIMIT:
             sen_limit_help = 'Reports are currently capped to the first %s sentences.' % self.rest_svc.SENTENCE_LIMIT
         # Get the list of sentences with techniques that need to be confirmed
@@ -314,7 +530,6 @@ class WebAPI:
             final_html=final_html,
             sentences=sentences,
             sentence_limit_helptext=sen_limit_help,
-            attack_uids=self.attack_dropdown_list,
             original_html=original_html,
             pdf_link=pdf_link,
             nav_link=nav_link,
@@ -323,8 +538,6 @@ class WebAPI:
             private_help_text=private_info,
             completed=is_completed,
             categories=categories,
-            category_list=self.cat_dropdown_list,
-            group_list=self.web_svc.keyword_dropdown_list,
             aggressor_groups=keywords['aggressors']['groups'],
             aggressor_regions=keywords['aggressors']['region_ids'],
             aggressor_countries=keywords['aggressors']['country_codes'],
@@ -332,7 +545,8 @@ class WebAPI:
             victim_countries=keywords['victims']['country_codes'],
             region_list=self.data_svc.region_dict,
             country_list=self.data_svc.country_dict,
-            country_region_list=self.data_svc.country_region_dict,
+            catalogue_urls={name: self.catalogue_url(name) for name in
+                            [ATTACK_CATALOGUE, CATEGORY_CATALOGUE, KEYWORD_CATALOGUE, COUNTRY_CATALOGUE]},
             vic_cat_all=keywords['victims']['categories_all'],
             vic_countries_all=keywords['victims']['countries_all'],
         )
@@ -352,8 +566,9 @@ class WebAPI:
         :param request: The title of the report information
         :return: the layer json
         """
-        json_str = await self.report_exporter.nav_export(request)
-        return web.json_response(json_str)
+        export_page = await self.report_exporter.nav_export(request)
+        # Exports can be token-protected so only the client may keep a copy (which it revalidates via the ETag)
+        return export_page.response(request, cache_control=PRIVATE_CACHE_CONTROL)
 
     async def pdf_export(self, request):
         """
@@ -361,8 +576,47 @@ class WebAPI:
         :param request: The title of the report information
         :return: response status of function
         """
-        pdfmake_data = await self.report_exporter.pdf_export(request)
-        return web.json_response(pdfmake_data)
+        export_page = await self.report_exporter.pdf_export(request)
+        return export_page.response(request, cache_control=PRIVATE_CACHE_CONTROL)
+
+    async def bulk_export(self, request):
+        """
+        Function to stream the confirmed techniques of many reports as NDJSON or a STIX 2.1 bundle
+        :param request: The format (ndjson/stix) and the filters (status, from/to dates and token) as query parameters
+        :return: the export, sent in chunks as it is read from the database
+        """
+        await self.web_svc.action_allowed(request, 'bulk-export')
+        export_format = request.query.get('format', NDJSON)
+        status = request.query.get('status', self.report_statuses.COMPLETED.value)
+        date_from, date_to = request.query.get('from'), request.query.get('to')
+        if export_format not in EXPORT_FORMATS:
+            raise web.HTTPBadRequest(text='Unknown export format: expected one of %s.' % ', '.join(EXPORT_FORMATS))
+        if status not in [self.report_statuses.NEEDS_REVIEW.value, self.report_statuses.IN_REVIEW.value,
+                          self.report_statuses.COMPLETED.value]:
+            raise web.HTTPBadRequest(text='Only reports which are not queued can be exported.')
+        if any(date and not self.rest_svc.to_datetime_obj(date) for date in (date_from, date_to)):
+            raise web.HTTPBadRequest(text='Dates should be in the format YYYY-MM-DD.')
+        # Local users have all reports; else only the user's reports (or public reports if not logged in) are exported
+        if self.is_local:
+            token = request.query.get('token')
+            filters = dict(token=token, all_tokens=not token)
+        else:
+            token = None
+            if await authorized_userid(request):
+                _, token = await self.web_svc.get_current_arachne_user(request)
+            filters = dict(token=token)
+        chunks = self.report_exporter.bulk_exporter.export(export_format, status, date_from=date_from,
+                                                           date_to=date_to, **filters)
+        filename = 'thread-%s.%s' % (status, 'ndjson' if export_format == NDJSON else 'json')
+        response = web.StreamResponse(headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
+        response.content_type = EXPORT_FORMATS[export_format]
+        # Send the export as it is read rather than building it all in memory first
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        async for chunk in chunks:
+            await response.write(chunk)
+        await response.write_eof()
+        return response
 
     async def rebuild_ml(self, request):
         """
@@ -0,0 +1,184 @@
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# The types of metric (as named in the Prometheus text format)
+COUNTER, GAUGE, HISTOGRAM = 'counter', 'gauge', 'histogram'
+# The upper bounds (in seconds) of the buckets durations are counted in
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Buckets for durations of minutes (e.g. analysing a report or building models) rather than milliseconds
+LONG_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+# The content type of the Prometheus text format
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram:
+    """A count of the observations falling in each of a set of buckets, with the count and sum of all observations."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket and a final count for observations larger than the last bucket
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Function to add an observation to the histogram."""
+        # Buckets are upper bounds, i.e. a value equal to a bucket's bound falls in that bucket
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Function to return (upper bound, count of observations <= upper bound) for each bucket (and infinity)."""
+        counts, total = [], 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), self.bucket_counts):
+            total += bucket_count
+            counts.append((bound, total))
+        return counts
+
+
+def format_value(value):
+    """Function to format a sample value for the text format."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    """Function to format a list of (name, value) labels for the text format."""
+    if not labels:
+        return ''
+    escaped = ['%s="%s"' % (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+               for name, value in labels]
+    return '{%s}' % ','.join(escaped)
+
+
+class Metric:
+    """A named metric holding a value (or a Histogram) for each combination of its label values."""
+
+    def __init__(self, name, help_text, metric_type, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        # Label values (in the order of label_names) -> value or Histogram
+        self.values = dict()
+        # Analyses run in other threads so updates are guarded by a lock
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label_name, '')) for label_name in self.label_names)
+
+    def inc(self, amount=1, **labels):
+        """Function to increase the value for the given labels."""
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Function to decrease the value for the given labels."""
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """Function to set the value for the given labels."""
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def set_all(self, values):
+        """Function to replace every value with a dictionary of label values -> value (dropping the label values
+        which are no longer present, e.g. the queue of a user with nothing queued)."""
+        values = {self._key(dict(zip(self.label_names, key if isinstance(key, tuple) else (key,)))): value
+                  for key, value in values.items()}
+        with self._lock:
+            self.values = values
+
+    def observe(self, value, **labels):
+        """Function to add an observation to the histogram for the given labels."""
+        key = self._key(labels)
+        with self._lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager to observe how long its block takes (in seconds)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Function to return the value (or Histogram) for the given labels (None if nothing has been recorded)."""
+        return self.values.get(self._key(labels))
+
+    def exposition(self):
+        """Function to return the lines of this metric in the text format."""
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.metric_type)]
+        with self._lock:
+            values = sorted(self.values.items())
+            if self.metric_type == HISTOGRAM:
+                # Take a copy of each histogram's counts as these could change while the lines are built
+                values = [(key, (histogram.cumulative_counts(), histogram.sum, histogram.count))
+                          for key, histogram in values]
+        for key, value in values:
+            labels = list(zip(self.label_names, key))
+            if self.metric_type != HISTOGRAM:
+                lines.append('%s%s %s' % (self.name, format_labels(labels), format_value(value)))
+                continue
+            cumulative_counts, total, count = value
+            for bound, bucket_count in cumulative_counts:
+                lines.append('%s_bucket%s %s' % (self.name, format_labels(labels + [('le', format_value(bound))]),
+                                                 bucket_count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(labels), format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, format_labels(labels), count))
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics of the app, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        # Name -> Metric (in the order these were registered)
+        self.metrics = dict()
+        self._lock = threading.Lock()
+
+    def _register(self, name, help_text, metric_type, label_names=(), buckets=LATENCY_BUCKETS):
+        """Function to return the metric with a given name, registering it if it does not exist."""
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(name, help_text, metric_type, label_names=label_names,
+                                                     buckets=buckets)
+            elif (metric.metric_type != metric_type) or (metric.label_names != tuple(label_names)):
+                raise ValueError('Metric %s is already registered with a different type or labels' % name)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(name, help_text, COUNTER, label_names=label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(name, help_text, GAUGE, label_names=label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(name, help_text, HISTOGRAM, label_names=label_names, buckets=buckets)
+
+    def render(self):
+        """Function to return every metric in the text format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry the app's metrics are recorded in (shared by the services and the analyses running in other threads)
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,175 @@
+import json
+import uuid
+
+from datetime import datetime, timedelta, timezone
+
+# The formats reports can be bulk-exported in
+NDJSON, STIX = 'ndjson', 'stix'
+EXPORT_FORMATS = {NDJSON: 'application/x-ndjson', STIX: 'application/json'}
+# The namespace for STIX IDs generated from Thread IDs which are not UUIDs
+STIX_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/arachne-threat-intel/thread')
+ATTACK_URL = 'https://attack.mitre.org/techniques/%s/'
+
+
+def stix_id(object_type, value):
+    """Function to return the STIX ID of an object, reusing the object's ID if this is already a UUID."""
+    if value.startswith(object_type + '--'):
+        return value
+    try:
+        return '%s--%s' % (object_type, uuid.UUID(value))
+    except ValueError:
+        return '%s--%s' % (object_type, uuid.uuid5(STIX_NAMESPACE, value))
+
+
+def stix_timestamp(date_str=None):
+    """Function to return a STIX timestamp for a YYYY-MM-DD date (or for now if no date is given)."""
+    if date_str:
+        return '%sT00:00:00.000Z' % date_str[:10]
+    return datetime.now(tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class BulkExporter:
+    """A class to export the confirmed techniques of many reports, reading and writing one report at a time."""
+
+    def __init__(self, dao, batch_size=100):
+        self.dao = dao
+        # How many reports to read from the database at a time: each batch is read by its own short queries so no
+        # transaction (and, for SQLite, no lock blocking writes) is held open whilst the export is sent
+        self.batch_size = batch_size
+
+    def _filter_clauses(self, status, date_from=None, date_to=None, token=None, all_tokens=False):
+        """Function to return the SQL FROM and WHERE clauses (and their parameters) selecting the confirmed techniques
+        of the reports matching the given filters."""
+        clauses = ['reports.current_status = %s' % self.dao.db_qparam, 'reports.error = %s' % self.dao.db_false_val,
+                   'report_sentence_hits.confirmed = %s' % self.dao.db_true_val,
+                   'report_sentence_hits.active_hit = %s' % self.dao.db_true_val,
+                   'attack_uids.inactive = %s' % self.dao.db_false_val]
+        parameters = [status]
+        # Unless told otherwise, only export the reports of the given token (or public reports if there is no token)
+        if not all_tokens:
+            if token:
+                clauses.append('reports.token = %s' % self.dao.db_qparam)
+                parameters.append(token)
+            else:
+                clauses.append('reports.token IS NULL')
+        # Dates are YYYY-MM-DD but saved dates may have a time so compare the end of the range with the following day
+        if date_from:
+            clauses.append('reports.date_written >= %s' % self.dao.db_qparam)
+            parameters.append(date_from)
+        if date_to:
+            clauses.append('reports.date_written < %s' % self.dao.db_qparam)
+            parameters.append((datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+        from_clause = (' FROM ((reports '
+                       'INNER JOIN report_sentence_hits ON reports.uid = report_sentence_hits.report_uid) '
+                       'INNER JOIN report_sentences ON report_sentence_hits.sentence_id = report_sentences.uid) '
+                       'INNER JOIN attack_uids ON report_sentence_hits.attack_uid = attack_uids.uid ')
+        return from_clause, clauses, parameters
+
+    def _report_ids_query(self, after_uid=None, **filters):
+        """Function to return the SQL (and its parameters) selecting the IDs of the next batch of reports (after a
+        report ID, as reports are read in ID order) matching the given filters."""
+        from_clause, clauses, parameters = self._filter_clauses(**filters)
+        if after_uid is not None:
+            clauses.append('reports.uid > %s' % self.dao.db_qparam)
+            parameters.append(after_uid)
+        query = ('SELECT DISTINCT reports.uid' + from_clause + 'WHERE ' + ' AND '.join(clauses) +
+                 ' ORDER BY reports.uid LIMIT %d' % self.batch_size)
+        return query, tuple(parameters)
+
+    def _mappings_query(self, report_ids, **filters):
+        """Function to return the SQL (and its parameters) selecting the confirmed techniques of the given reports,
+        ordered by report."""
+        db = self.dao.db
+        columns = ['reports.uid AS report_uid', 'reports.title', 'reports.url', 'reports.current_status',
+                   db.sql_date_field_to_str('reports.date_written'), db.sql_date_field_to_str('reports.start_date'),
+                   db.sql_date_field_to_str('reports.end_date'), 'report_sentence_hits.attack_uid',
+                   'report_sentence_hits.attack_tid', 'attack_uids.name AS attack_name',
+                   'report_sentences.uid AS sentence_id', 'report_sentences.text',
+                   db.sql_date_field_to_str('report_sentence_hits.start_date', field_name_as='tech_start_date'),
+                   db.sql_date_field_to_str('report_sentence_hits.end_date', field_name_as='tech_end_date')]
+        from_clause, clauses, parameters = self._filter_clauses(**filters)
+        clauses.append('reports.uid IN (%s)' % ', '.join([self.dao.db_qparam] * len(report_ids)))
+        parameters.extend(report_ids)
+        query = ('SELECT ' + ', '.join(columns) + from_clause + 'WHERE ' + ' AND '.join(clauses) + ' '
+                 'ORDER BY reports.uid, report_sentences.sen_index, report_sentence_hits.attack_tid')
+        return query, tuple(parameters)
+
+    async def reports(self, status, date_from=None, date_to=None, token=None, all_tokens=False):
+        """Function to yield each report (matching the given filters) with its confirmed techniques. Reports without
+        confirmed techniques are not included."""
+        filters = dict(status=status, date_from=date_from, date_to=date_to, token=token, all_tokens=all_tokens)
+        after_uid = None
+        while True:
+            query, parameters = self._report_ids_query(after_uid=after_uid, **filters)
+            report_ids = [row['uid'] for row in await self.dao.select_batch(query, parameters=parameters)]
+            if not report_ids:
+                return
+            query, parameters = self._mappings_query(report_ids, **filters)
+            report = None
+            for row in await self.dao.select_batch(query, parameters=parameters):
+                # Rows are ordered by report: a new report ID means the previous report has all its mappings
+                if (report is None) or (report['uid'] != row['report_uid']):
+                    if report is not None:
+                        yield report
+                    report = dict(uid=row['report_uid'], title=row['title'], url=row['url'],
+                                  status=row['current_status'], date_written=row['date_written'],
+                                  start_date=row['start_date'], end_date=row['end_date'], mappings=[])
+                report['mappings'].append(dict(
+                    attack_uid=row['attack_uid'], attack_tid=row['attack_tid'], attack_name=row['attack_name'],
+                    sentence_id=row['sentence_id'], sentence=row['text'], start_date=row['tech_start_date'],
+                    end_date=row['tech_end_date']))
+            if report is not None:
+                yield report
+            if len(report_ids) < self.batch_size:
+                return
+            after_uid = report_ids[-1]
+
+    async def ndjson(self, status, **filters):
+        """Function to yield each report (see reports()) as a line of JSON."""
+        async for report in self.reports(status, **filters):
+            yield (json.dumps(report) + '\n').encode('utf-8')
+
+    async def stix_bundle(self, status, **filters):
+        """Function to yield a STIX 2.1 bundle of the reports (see reports()) and the techniques they refer to, an
+        object at a time."""
+        created = stix_timestamp()
+        # Each technique is added to the bundle once, before the first report referring to it
+        added_patterns = set()
+        yield ('{"type": "bundle", "id": "%s", "objects": [' % stix_id('bundle', str(uuid.uuid4()))).encode('utf-8')
+        separator = ''
+        async for report in self.reports(status, **filters):
+            objects, pattern_refs = [], []
+            for mapping in report['mappings']:
+                pattern_id = stix_id('attack-pattern', mapping['attack_uid'])
+                if pattern_id not in pattern_refs:
+                    pattern_refs.append(pattern_id)
+                if pattern_id not in added_patterns:
+                    added_patterns.add(pattern_id)
+                    tid = mapping['attack_tid']
+                    objects.append(dict(
+                        type='attack-pattern', spec_version='2.1', id=pattern_id, created=created, modified=created,
+                        name=mapping['attack_name'],
+                        external_references=[dict(source_name='mitre-attack', external_id=tid,
+                                                  url=ATTACK_URL % tid.replace('.', '/'))]))
+            # The sentences and dates of each technique have no STIX property so are added as a custom property
+            published = stix_timestamp(report['date_written']) if report['date_written'] else created
+            objects.append(dict(
+                type='report', spec_version='2.1', id=stix_id('report', report['uid']), created=created,
+                modified=created, name=report['title'], published=published,
+                report_types=['threat-report'], object_refs=pattern_refs,
+                external_references=[dict(source_name='thread-report-source', url=report['url'])],
+                x_thread_mappings=[dict(attack_pattern_ref=stix_id('attack-pattern', mapping['attack_uid']),
+                                        sentence=mapping['sentence'], start_date=mapping['start_date'],
+                                        end_date=mapping['end_date']) for mapping in report['mappings']]))
+            for stix_object in objects:
+                yield (separator + json.dumps(stix_object)).encode('utf-8')
+                separator = ', '
+        yield b']}'
+
+    def export(self, export_format, status, **filters):
+        """Function to return the async generator of a bulk export's chunks in the given format."""
+        if export_format == STIX:
+            return self.stix_bundle(status, **filters)
+        if export_format == NDJSON:
+            return self.ndjson(status, **filters)
+        raise ValueError('Unknown export format: %s' % export_format)
@@ -1,6 +1,9 @@
 import json
 
 from aiohttp_jinja2 import web
+from threadcomponents.reports.bulk_exporter import BulkExporter
+from threadcomponents.service.page_cache import CachedPage
+from threadcomponents.service.ttl_cache import TTLCache
 
 UID = 'uid'
 URL = 'url'
@@ -10,6 +13,8 @@ DATE_WRITTEN = 'date_written_str'
 START_DATE = 'start_date_str'
 END_DATE = 'end_date_str'
 MITRE_ATTACK_VERSION = 13.1
+# The types of export
+NAV_EXPORT, PDF_EXPORT = 'nav', 'pdf'
 
 
 def sanitise_filename(filename=''):
@@ -30,6 +35,12 @@ class ReportExporter:
         self.rest_svc = services['rest_svc']
         self.report_statuses = self.rest_svc.get_status_enum()
         self.is_local = self.web_svc.is_local
+        # The exports of completed reports: (report ID, export type, report revision) -> CachedPage of the export
+        # See RestService.report_revision() for which revisions this can be trusted with
+        self.export_cache = TTLCache(max_size=200, ttl=3600)
+        self.export_builders = {NAV_EXPORT: self.build_nav_export, PDF_EXPORT: self.build_pdf_export}
+        # For exporting many reports at once
+        self.bulk_exporter = BulkExporter(self.dao)
 
     async def check_request_for_export(self, request, action):
         """Checks a request can return report-data for export."""
@@ -56,9 +67,32 @@ class ReportExporter:
             raise web.HTTPNotFound()
         return report
 
+    async def export(self, request, export_type):
+        """Function to return a CachedPage of a report's export (as JSON), reusing any cached export of the report."""
+        report = await self.check_request_for_export(request, '%s-export' % export_type)
+        build = self.export_builders[export_type]
+        # Reports still being reviewed change often so only the exports of completed reports are kept
+        if report[STATUS] != self.report_statuses.COMPLETED.value:
+            return CachedPage(json.dumps(await build(report)).encode('utf-8'), content_type='application/json',
+                              compress_body=False)
+        # Any edit to the report changes its revision so the export is then rebuilt
+        key = (report[UID], export_type, self.rest_svc.report_revision(report[UID]))
+        page = self.export_cache.get(key)
+        if page is None:
+            page = CachedPage(json.dumps(await build(report)).encode('utf-8'), content_type='application/json')
+            self.export_cache.set(key, page)
+        return page
+
     async def nav_export(self, request):
         """Exports a report in a navigator-friendly format."""
-        report = await self.check_request_for_export(request, 'nav-export')
+        return await self.export(request, NAV_EXPORT)
+
+    async def pdf_export(self, request):
+        """Exports a report as a pdfmake document definition."""
+        return await self.export(request, PDF_EXPORT)
+
+    async def build_nav_export(self, report):
+        """Function to return a report's navigator layer."""
         report_id = report[UID]
         report_title = report[TITLE]
         date_of = report[DATE_WRITTEN]
@@ -93,11 +127,10 @@ class ReportExporter:
         for technique in techniques:
             enterprise_layer['techniques'].append(technique)
 
-        # Return as a JSON string
-        return json.dumps(enterprise_layer)
+        return enterprise_layer
 
-    async def pdf_export(self, request):
-        report = await self.check_request_for_export(request, 'pdf-export')
+    async def build_pdf_export(self, report):
+        """Function to return a report's pdfmake document definition."""
         report_id = report[UID]
         title = report[TITLE]
         report_url = report[URL]
@@ -107,7 +140,8 @@ class ReportExporter:
         end_date = report[END_DATE] or '-'
 
         # Continue with the method and retrieve the report's sentences and aggressors/victims
-        flatten_sentences = self.is_local or not self.dao.db.IS_POSTGRESQL
+        # Local exports include the article text which has to be in sentence order
+        flatten_sentences = self.is_local
         report_data = await self.data_svc.export_report_data(report=report, report_id=report_id,
                                                              flatten_sentences=flatten_sentences)
         sentences = report_data.get('sentences', [])
@@ -224,6 +258,7 @@ class ReportExporter:
         """Adds a list of report-sentences to existing dictionary, dd, and returns table rows for sentences and IoCs."""
         sen_table_rows = []
         ioc_table_rows = []
+        ioc_sentence_ids = {ioc['sentence_id'] for ioc in indicators_of_compromise}
 
         seen_sentences = set()  # set to prevent duplicate sentences being exported
         for sentence in sentences:
@@ -242,7 +277,7 @@ class ReportExporter:
                                        sentence.get('tech_end_date')])
 
             # Check if IoC
-            if any(ioc['sentence_id'] == sen_id for ioc in indicators_of_compromise):
+            if sen_id in ioc_sentence_ids:
                 ioc_table_rows.append([sen_text])
 
         return sen_table_rows, ioc_table_rows
@@ -251,6 +286,7 @@ class ReportExporter:
         """Adds grouped-by attack-data to existing dictionary, dd, and returns table rows for sentences and IoCs."""
         sen_table_rows = []
         ioc_table_rows = []
+        ioc_sentence_ids = {ioc['sentence_id'] for ioc in indicators_of_compromise}
 
         seen_sentences = set()  # set to prevent duplicate sentences being exported
         for attack in sentences:
@@ -284,7 +320,7 @@ class ReportExporter:
                     mappings_added += 1
 
                 # Check if IoC
-                if any(ioc['sentence_id'] == sen_id for ioc in indicators_of_compromise):
+                if sen_id in ioc_sentence_ids:
                     ioc_table_rows.append([sen_text])
 
             # Have the attack-data cover multiple table-rows for as many mappings there are
@@ -0,0 +1,117 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# How often (in seconds) the profiler samples the analysing thread's call stack
+PROFILE_INTERVAL = 0.01
+# The number of functions listed (by samples spent in them) at the top of a saved profile
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class AnalysisTrace:
+    """The spans (timed stages) of analysing a report, logged with the report's ID."""
+
+    def __init__(self, report_id, stage_histogram=None):
+        self.report_id = report_id
+        # The histogram (if any) to record each span's duration in, labelled by the span's name
+        self.stage_histogram = stage_histogram
+        self.started = time.perf_counter()
+        # (name, seconds, fields) of each finished span, in the order these finished
+        self.spans = []
+        # The names of the spans currently open (a span's name includes the spans it is nested in)
+        self._open = []
+
+    def log(self, level, message, **fields):
+        """Function to log a message about this report's analysis with the report's ID (and any other fields)."""
+        field_str = ' '.join('%s=%s' % (key, value) for key, value in fields.items())
+        logging.log(level, '%s report_id=%s%s' % (message, self.report_id, (' ' + field_str) if field_str else ''))
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Context manager to time a stage of the analysis. Any fields (e.g. counts) are logged with the span."""
+        self._open.append(name)
+        full_name = '/'.join(self._open)
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            seconds = time.perf_counter() - start
+            self._open.pop()
+            self.spans.append((full_name, seconds, fields))
+            if self.stage_histogram is not None:
+                self.stage_histogram.observe(seconds, stage=full_name)
+            self.log(logging.DEBUG, 'Analysis span', stage=full_name, seconds='%.3f' % seconds, **fields)
+
+    def elapsed(self):
+        """Function to return the number of seconds since the analysis started."""
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """Function to return the time taken by each span as a string, e.g. `download=1.200s tokenize=0.030s`."""
+        return ' '.join('%s=%.3fs' % (name, seconds) for name, seconds, _ in self.spans)
+
+
+class SamplingProfiler:
+    """A profiler sampling a thread's call stack at an interval. As it does not trace every call, it barely slows the
+    thread down so can run for every analysis (with only the profiles of slow analyses being kept)."""
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        # Call stack (outermost call first) -> number of samples
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Function to start sampling (in a background thread)."""
+        self._thread = threading.Thread(target=self._sample, name='analysis-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Function to stop sampling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                # Use the line a function starts on (rather than the current line) so samples of a function combine
+                stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def top_functions(self, limit=PROFILE_TOP_FUNCTIONS):
+        """Function to return the functions the thread was most often found running (and their number of samples)."""
+        own_samples = Counter()
+        for stack, count in self.stacks.items():
+            own_samples[stack[-1]] += count
+        return own_samples.most_common(limit)
+
+    def save(self, directory, name, header_lines=None):
+        """Function to save the profile to a file in a directory, returning the file's path. The file lists the top
+        functions then each sampled stack in the 'collapsed' format read by flame graph tools (e.g. speedscope)."""
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.now(tz=timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        path = os.path.join(directory, '%s-%s.txt' % (name, timestamp))
+        lines = ['# %s' % line for line in (header_lines or [])]
+        lines.append('# %s samples taken every %sms' % (self.samples, int(self.interval * 1000)))
+        lines.append('# Top functions (samples):')
+        lines.extend('#   %8s  %s' % (count, function) for function, count in self.top_functions())
+        lines.extend('%s %s' % (';'.join(stack), count) for stack, count in self.stacks.most_common())
+        with open(path, 'w') as profile_file:
+            profile_file.write('\n'.join(lines) + '\n')
+        return path
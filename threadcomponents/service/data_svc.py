@@ -2,6 +2,7 @@
 # This file has been moved into a different directory
 # To see its full history, please use `git log --follow <filename>` to view previous commits and additional contributors
 
+import asyncio
 import os
 import re
 import requests
@@ -11,20 +12,146 @@ import logging
 from contextlib import suppress
 from copy import deepcopy
 from datetime import datetime
-from stix2 import Filter, MemoryStore
+from threadcomponents.service.ttl_cache import TTLCache
 from urllib.parse import quote
 
 # Text to set on attack descriptions where this originally was not set
 NO_DESC = 'No description provided'
 # A name for a temporary table representing the output of SQL_PAR_ATTACK
 FULL_ATTACK_INFO = 'full_attack_info'
+# Where the latest Att%ck data is downloaded from
+ATTACK_DATA_URL = ('https://raw.githubusercontent.com/mitre-attack/attack-stix-data/master/enterprise-attack/'
+                   'enterprise-attack.json')
+# The STIX object types which are stored as attacks
+ATTACK_TYPES = {'attack-pattern', 'malware', 'tool'}
+# The number of characters to read at a time when streaming a STIX bundle
+STIX_CHUNK_SIZE = 65536
+# Where the list of objects starts in a STIX bundle
+STIX_OBJECTS_START = re.compile(r'"objects"\s*:\s*\[')
+# Characters which can appear between objects in a JSON list
+JSON_SEPARATORS = ' \t\r\n,'
+# The reports-table columns displayed on each report's card on the index page
+REPORT_CARD_COLUMNS = ['title', 'url', 'error', 'expires_on']
 
 
-def fetch_attack_data():
-    """Function to fetch the latest Att%ck data."""
-    url = 'https://raw.githubusercontent.com/mitre-attack/attack-stix-data/master/enterprise-attack/' \
-          'enterprise-attack.json'
-    return requests.get(url).json()
+def iter_stix_objects(file_path, chunk_size=STIX_CHUNK_SIZE):
+    """Function to yield each object in a STIX bundle one at a time (without loading the whole bundle)."""
+    decoder = json.JSONDecoder()
+    buffer, in_objects = '', False
+    with open(file_path, 'r', encoding='utf-8') as stix_file:
+        while True:
+            chunk = stix_file.read(chunk_size)
+            buffer += chunk
+            if not in_objects:
+                match = STIX_OBJECTS_START.search(buffer)
+                if not match:
+                    if not chunk:
+                        raise ValueError('No objects list found in STIX bundle %s' % file_path)
+                    # Keep the end of the buffer in case the start of the list is split across chunks
+                    buffer = buffer[-32:]
+                    continue
+                buffer, in_objects = buffer[match.end():], True
+            pos = 0
+            while True:
+                # Skip over whitespace and commas to the next object (or the end of the list)
+                while pos < len(buffer) and buffer[pos] in JSON_SEPARATORS:
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if buffer[pos] == ']':
+                    return
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # The object is incomplete: read more of the file before trying again
+                    if not chunk:
+                        raise
+                    break
+                yield item
+            # Only keep what has not been decoded yet
+            buffer = buffer[pos:]
+            if not chunk:
+                raise ValueError('STIX bundle %s ended before its objects list did' % file_path)
+
+
+def fetch_attack_data(cache_file, timeout=60):
+    """Function to fetch the latest Att%ck data, only downloading it if it has changed since the cached copy."""
+    meta_file = cache_file + '.meta'
+    headers = dict()
+    # If we have a cached copy, make the request conditional on the data having changed since
+    if os.path.isfile(cache_file):
+        with suppress(OSError, ValueError), open(meta_file, 'r') as meta_opened:
+            meta = json.load(meta_opened)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        with requests.get(ATTACK_DATA_URL, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                logging.info('ATT&CK data has not changed since it was last downloaded.')
+            else:
+                response.raise_for_status()
+                # Download to a temporary file so an interrupted download does not replace the cached copy
+                os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+                temp_file = cache_file + '.download'
+                with open(temp_file, 'wb') as temp_opened:
+                    for chunk in response.iter_content(chunk_size=STIX_CHUNK_SIZE):
+                        temp_opened.write(chunk)
+                os.replace(temp_file, cache_file)
+                with open(meta_file, 'w') as meta_opened:
+                    json.dump(dict(etag=response.headers.get('ETag'),
+                                   last_modified=response.headers.get('Last-Modified')), meta_opened)
+    except requests.RequestException as e:
+        if not os.path.isfile(cache_file):
+            raise
+        logging.warning('Could not download ATT&CK data (%s); using the previously downloaded copy.' % e)
+    return iter_stix_objects(cache_file)
+
+
+def normalise_example_use(use):
+    """Function to clean up the description of a 'uses' relationship to store as an example use."""
+    # remove unnecessary strings, fix unicode errors
+    use = use.replace('<code>', '').replace('</code>', '').replace('"', '').replace(',', '').replace(
+        '\t', '').replace('  ', ' ').replace('\n', '').encode('ascii', 'ignore').decode('ascii')
+    find_pattern = re.compile('\[.*?\]\(.*?\)')  # get rid of att&ck reference (name)[link to site]
+    m = find_pattern.findall(use)
+    if len(m) > 0:
+        for j in m:
+            use = use.replace(j, '')
+            if use[0:2] == '\'s':
+                use = use[3:]
+            elif use[0] == ' ':
+                use = use[1:]
+    return use
+
+
+def parse_attack_data(stix_objects, known_uids=None):
+    """Function to collect, in a single pass over STIX objects, the attacks to store and example uses of new ones."""
+    known_uids = known_uids or set()
+    attacks, example_uses = dict(), dict()
+    for item in stix_objects:
+        item_type = item.get('type')
+        if (item_type not in ATTACK_TYPES and item_type != 'relationship') or attack_data_reject(item):
+            continue
+        if item_type == 'relationship':
+            target = item.get('target_ref', '')
+            # Example uses are only stored when an attack is first added so skip those for attacks we already have
+            if (item.get('relationship_type') == 'uses') and target.startswith('attack-pattern') \
+                    and (target not in known_uids):
+                example_uses.setdefault(target, []).append(normalise_example_use(item.get('description', NO_DESC)))
+            continue
+        # TODO check if we should be skipping those without a description?
+        # some software do not have description, example: darkmoon https://attack.mitre.org/software/S0209
+        if item_type == 'malware' and 'description' not in item:
+            continue
+        attacks[item['id']] = dict(tid=attack_data_get_tid(item), name=item['name'], modified=item.get('modified'),
+                                   example_uses=[])
+    # Relationships can appear before the attacks they refer to, so only attach their uses once all attacks are read
+    for target, uses in example_uses.items():
+        if target in attacks:
+            attacks[target]['example_uses'] = uses
+    return attacks
 
 
 def attack_data_reject(attack_data):
@@ -73,38 +200,40 @@ class DataService:
         self.country_dict = {}
         self.country_region_dict = {}
         self.region_countries_dict = {}
-        # SQL queries below use a string-pos function which differs across DB engines; obtain the correct one
-        str_pos = self.dao.db_func(self.dao.db.FUNC_STR_POS)
         # SQL query to obtain attack records where sub-techniques are returned with their parent-technique info
+        # The parent of each sub-technique is kept in attack_hierarchy (see refresh_attack_hierarchy()) so this is
+        # a join on primary keys rather than working out each parent from the TIDs every time
         sql_par_attack_base = (
-            # Use a temporary table 'parent_tids' to return attacks which are sub-techniques (i.e. tid is Txxx.xx)
-            # Use the substring method to save in the parent_tid column as the Txxx part of the tid (without the .xx)
-            "WITH parent_tids(uid, name, tid, inactive, parent_tid) AS "
-            "(SELECT uid, name, tid, inactive, SUBSTR(tid, 0, %s(tid, '.'))" % str_pos + " "
+            # Need to use `AS parent_...` to not confuse the parent's fields with the attack's fields
+            "SELECT attack_uids.uid, attack_uids.name, attack_uids.tid, attack_uids.inactive, "
+            "parents.tid AS parent_tid, parents.name AS parent_name "
+            "FROM ((attack_uids LEFT JOIN attack_hierarchy ON attack_uids.uid = attack_hierarchy.attack_uid) "
+            "LEFT JOIN attack_uids AS parents ON attack_hierarchy.parent_uid = parents.uid) "
+            # Sub-techniques (i.e. tid is Txxx.xx) are only returned if we have their parent-technique
             # %% in LIKE because % messes up parameters in psycopg (https://github.com/psycopg/psycopg2/issues/827)
             # LIKE '%.%' = '%%.%%' so this does not affect other DB engines
-            "FROM attack_uids WHERE tid LIKE '%%.%%'{inactive_AND}) "
-            # With parent_tids, select all fields from it and the name of the parent_tid from the attack_uids table
-            # Need to use `AS parent_name` to not confuse it with parent_tids.name
-            # Using an INNER JOIN because we only care about returning sub-techniques here
-            "SELECT parent_tids.*, attack_uids.name AS parent_name FROM "
-            "(attack_uids INNER JOIN parent_tids ON attack_uids.tid = parent_tids.parent_tid){inactive_WHERE} "
-            # Union the sub-tech query with one for all other techniques (where the tid does not contain a '.')
-            # Need to pass in two NULLs so the number of columns for the UNION is the same
-            # (and parent_name & parent_tid doesn't exist for these techniques which are not sub-techniques)
-            "UNION SELECT uid, name, tid, inactive, NULL, NULL FROM attack_uids "
-            "WHERE tid NOT LIKE '%%.%%'{inactive_AND}")
-        # Use this query to omit any 'inactive' attacks
-        exc_inactive = 'inactive = %s' % self.dao.db_false_val
+            "WHERE (attack_uids.tid NOT LIKE '%%.%%' OR parents.uid IS NOT NULL){inactive_AND}")
+        # Use this query to omit any 'inactive' attacks (and sub-techniques of 'inactive' parent-techniques)
+        exc_inactive = ' AND attack_uids.inactive = {false} AND (parents.uid IS NULL OR parents.inactive = {false})'\
+            .format(false=self.dao.db_false_val)
         with_par_attack = ('WITH %s(uid, name, tid, inactive, parent_tid, parent_name) AS (%s) ' %
                            (FULL_ATTACK_INFO, '%s'))
-        self.SQL_PAR_ATTACK = sql_par_attack_base.format(inactive_AND=' AND ' + exc_inactive,
-                                                         inactive_WHERE=' WHERE attack_uids.' + exc_inactive)
+        self.SQL_PAR_ATTACK = sql_par_attack_base.format(inactive_AND=exc_inactive)
         # A prefix SQL statement to use with queries that want the full attack info
         self.SQL_WITH_PAR_ATTACK = with_par_attack % self.SQL_PAR_ATTACK
         # A version of the above queries that includes inactive attacks
-        self.SQL_PAR_ATTACK_INC_INACTIVE = sql_par_attack_base.format(inactive_AND='', inactive_WHERE='')
+        self.SQL_PAR_ATTACK_INC_INACTIVE = sql_par_attack_base.format(inactive_AND='')
         self.SQL_WITH_PAR_ATTACK_INC_INACTIVE = with_par_attack % self.SQL_PAR_ATTACK_INC_INACTIVE
+        # SQL query to record when an attack was last modified (supported by both SQLite and PostgreSQL)
+        self.SQL_UPSERT_ATTACK_MODIFIED = (
+            'INSERT INTO attack_modified (attack_uid, modified) VALUES ({qp}, {qp}) ON CONFLICT (attack_uid) '
+            'DO UPDATE SET modified = excluded.modified'.format(qp=self.dao.db_qparam))
+        # Where the downloaded Att&ck data is kept so later syncs only download it if it has changed
+        self.attack_cache_file = os.path.join(dir_prefix, 'threadcomponents', 'models', 'enterprise-attack.json')
+        # The index page's report cards for each (status, criteria, page); see report_listing()
+        # A status's cards are dropped by bumping its version whenever a report moves in or out of that status
+        self.report_listings = TTLCache(max_size=500, ttl=300)
+        self.report_listing_versions = dict()
 
     async def reload_database(self, schema_file=os.path.join('threadcomponents', 'conf', 'schema.sql')):
         """
@@ -122,119 +251,85 @@ class DataService:
         await self.dao.build(schema)
         await self.dao.build(copied_tables_schema, is_partial=True)
 
+    async def refresh_attack_hierarchy(self):
+        """Function to update the table linking each sub-technique to its parent-technique (matched by TID)."""
+        attacks = await self.dao.get('attack_uids')
+        stored = ((await self.dao.get_dict_value_as_key('attack_uid', table='attack_hierarchy', columns=['parent_uid']))
+                  or dict())
+        # Parent-techniques by TID (preferring active attacks if a TID has been used more than once)
+        parents = dict()
+        for attack in attacks:
+            tid = attack.get('tid') or ''
+            if tid and ('.' not in tid) and ((tid not in parents) or not attack.get('inactive')):
+                parents[tid] = attack['uid']
+        sql_list = []
+        for attack in attacks:
+            tid = attack.get('tid') or ''
+            if '.' not in tid:
+                continue
+            # The parent-technique's TID is the Txxx part of the sub-technique's TID (without the .xx)
+            parent_uid = parents.get(tid.split('.')[0])
+            current = stored.pop(attack['uid'], None)
+            if parent_uid is None:
+                continue
+            if current is None:
+                sql_list.append(await self.dao.insert('attack_hierarchy', dict(attack_uid=attack['uid'],
+                                                                               parent_uid=parent_uid), return_sql=True))
+            elif current.get('parent_uid') != parent_uid:
+                sql_list.append(await self.dao.update('attack_hierarchy', where=dict(attack_uid=attack['uid']),
+                                                      data=dict(parent_uid=parent_uid), return_sql=True))
+        # Remove any links which no longer apply
+        for attack_uid in stored:
+            sql_list.append(await self.dao.delete('attack_hierarchy', dict(attack_uid=attack_uid), return_sql=True))
+        if sql_list:
+            await self.dao.run_sql_list(sql_list=sql_list)
+
     async def fetch_and_update_attack_data(self):
         """
         Function to retrieve ATT&CK data and insert it into the DB.
         Further reading on approach: https://github.com/arachne-threat-intel/thread/pull/27#issuecomment-1047456689
         """
-        logging.info('Downloading ATT&CK data from GitHub repo `mitre-attack/attack-stix-data`...')
-        attack = {}
-        stix_json = fetch_attack_data()
-        ms = MemoryStore(stix_data=stix_json['objects'])
-        filter_objs = {'techniques': Filter('type', '=', 'attack-pattern'),
-                       'groups': Filter('type', '=', 'intrusion-set'), 'malware': Filter('type', '=', 'malware'),
-                       'tools': Filter('type', '=', 'tool'), 'relationships': Filter('type', '=', 'relationship')}
-        for key in filter_objs:
-            # Could pass [filter_objs[key], Filter('x_mitre_deprecated', '!=', True), Filter('revoked', '!=', True)]
-            # But numbers are not adding up when ('=', False) are used
-            attack[key] = ms.query(filter_objs[key])
-        references = {}
-
-        # add all of the patterns and dictionary keys/values for each technique and software
-        for i in attack['techniques']:
-            if attack_data_reject(i):
-                continue
-            references[i['id']] = {'name': i['name'], 'tid': attack_data_get_tid(i), 'example_uses': [],
-                                   'description': i.get('description', NO_DESC).replace('<code>', '').replace(
-                                       '</code>', '').replace('\n', '').encode('ascii', 'ignore').decode('ascii'),
-                                   'similar_words': [i['name']]}
-
-        for i in attack['relationships']:
-            if attack_data_reject(i):
-                continue
-            if i['relationship_type'] == 'uses':
-                if ('attack-pattern' in i['target_ref']) and (i['target_ref'] in references):
-                    use = i.get('description', NO_DESC)
-                    # remove unnecessary strings, fix unicode errors
-                    use = use.replace('<code>', '').replace('</code>', '').replace('"', '').replace(',', '').replace(
-                        '\t', '').replace('  ', ' ').replace('\n', '').encode('ascii', 'ignore').decode('ascii')
-                    find_pattern = re.compile('\[.*?\]\(.*?\)')  # get rid of att&ck reference (name)[link to site]
-                    m = find_pattern.findall(use)
-                    if len(m) > 0:
-                        for j in m:
-                            use = use.replace(j, '')
-                            if use[0:2] == '\'s':
-                                use = use[3:]
-                            elif use[0] == ' ':
-                                use = use[1:]
-                    # combine all the examples to one list
-                    references[i['target_ref']]['example_uses'].append(use)
-
-        for i in attack['malware']:
-            # TODO check if we should be skipping those without a description?
-            # some software do not have description, example: darkmoon https://attack.mitre.org/software/S0209
-            if ('description' not in i) or attack_data_reject(i):
-                continue
-            else:
-                references[i['id']] = {'tid': attack_data_get_tid(i), 'name': i['name'],
-                                       'description': i.get('description', NO_DESC),
-                                       'examples': [], 'example_uses': [], 'similar_words': [i['name']]}
-        for i in attack['tools']:
-            if attack_data_reject(i):
-                continue
-            references[i['id']] = {'tid': attack_data_get_tid(i), 'name': i['name'],
-                                   'description': i.get('description', NO_DESC),
-                                   'examples': [], 'example_uses': [], 'similar_words': [i['name']]}
-
-        attack_data = references
-        logging.info('Finished...now creating the database.')
-
         cur_attacks = ((await self.dao.get_dict_value_as_key('uid', table='attack_uids', columns=['name', 'inactive']))
                        or dict())
+        # The `modified` timestamps of attacks when they were last synced
+        cur_modified = ((await self.dao.get_dict_value_as_key('attack_uid', table='attack_modified',
+                                                              columns=['modified'])) or dict())
         cur_uids = set(cur_attacks.keys())
+        logging.info('Downloading ATT&CK data from GitHub repo `mitre-attack/attack-stix-data`...')
+        # Downloading and reading the data blocks, so do this outside the event loop
+        loop = asyncio.get_running_loop()
+        attack_data = await loop.run_in_executor(
+            None, lambda: parse_attack_data(fetch_attack_data(self.attack_cache_file), known_uids=cur_uids))
+        logging.info('Finished...now updating the database.')
+
         retrieved_uids = set(attack_data.keys())
         added_attacks = retrieved_uids - cur_uids
         name_changes = []
+        # Build the changes to make as one list of SQL statements so these are applied in a single transaction
+        sql_list = []
         for k, v in attack_data.items():
-            # If this loop takes long, the below logging-statement will help track progress
-            # logging.info('Processing attack %s of %s.' % (list(attack_data.keys()).index(k) + 1, len(attack_data)))
-            if k not in cur_uids:
-                await self.dao.insert('attack_uids', dict(uid=k, tid=v['tid'], name=v['name']))
-                if 'regex_patterns' in v:
-                    [await self.dao.insert_generate_uid('regex_patterns',
-                                                        dict(attack_uid=k, regex_pattern=defang_text(x)))
-                     for x in v['regex_patterns']]
-                if 'similar_words' in v:
-                    [await self.dao.insert_generate_uid('similar_words',
-                                                        dict(attack_uid=k, similar_word=defang_text(x)))
-                     for x in v['similar_words']]
-                if 'false_negatives' in v:
-                    [await self.dao.insert_generate_uid(
-                        'false_negatives',
-                        dict(attack_uid=k, false_negative=self.dao.truncate_str(defang_text(x), 800)))
-                     for x in v['false_negatives']]
-                if 'false_positives' in v:
-                    [await self.dao.insert_generate_uid(
-                        'false_positives',
-                        dict(attack_uid=k, false_positive=self.dao.truncate_str(defang_text(x), 800)))
-                     for x in v['false_positives']]
-                if 'true_positives' in v:
-                    [await self.dao.insert_generate_uid(
-                        'true_positives',
-                        dict(attack_uid=k, true_positive=self.dao.truncate_str(defang_text(x), 800)))
-                     for x in v['true_positives']]
-                if 'example_uses' in v:
-                    [await self.dao.insert_generate_uid(
-                        'true_positives',
-                        dict(attack_uid=k, true_positive=self.dao.truncate_str(defang_text(x), 800)))
-                     for x in v['example_uses']]
+            current_attack_data = cur_attacks.get(k)
+            last_modified = cur_modified.get(k, dict()).get('modified')
+            if current_attack_data is None:
+                sql_list.append(await self.dao.insert('attack_uids', dict(uid=k, tid=v['tid'], name=v['name']),
+                                                      return_sql=True))
+                sql_list.append(await self.dao.insert_generate_uid(
+                    'similar_words', dict(attack_uid=k, similar_word=defang_text(v['name'])), return_sql=True))
+                for x in v['example_uses']:
+                    sql_list.append(await self.dao.insert_generate_uid(
+                        'true_positives', dict(attack_uid=k, true_positive=self.dao.truncate_str(defang_text(x), 800)),
+                        return_sql=True))
             else:
-                # If the attack is already in the DB, check the name hasn't changed; update if so
-                retrieved_name = (attack_data.get(k, dict())).get('name')
-                current_attack_data = cur_attacks.get(k, dict())
-                current_name = current_attack_data.get('name')
-                if retrieved_name and (retrieved_name != current_name):
-                    await self.dao.update('attack_uids', where=dict(uid=k), data=dict(name=retrieved_name))
+                # Confirm this attack is considered active
+                if current_attack_data.get('inactive'):
+                    sql_list.append(await self.dao.update('attack_uids', where=dict(uid=k),
+                                                          data=dict(inactive=self.dao.db_false_val), return_sql=True))
+                # If the attack has been modified since we last synced it, check the name hasn't changed; update if so
+                retrieved_name, current_name = v['name'], current_attack_data.get('name')
+                if (not last_modified or last_modified != v['modified']) and retrieved_name \
+                        and (retrieved_name != current_name):
+                    sql_list.append(await self.dao.update('attack_uids', where=dict(uid=k),
+                                                          data=dict(name=retrieved_name), return_sql=True))
                     name_changes.append((k, retrieved_name, current_name))
                     # Update the similar-words table if we're updating the attack-entry
                     for name in [retrieved_name, current_name]:
@@ -244,18 +339,24 @@ class DataService:
                             stored = await self.dao.get('similar_words', equal=db_criteria)
                             # If not, update the attack's similar-words to include this name
                             if not stored:
-                                await self.dao.insert_generate_uid('similar_words', db_criteria)
-                # Confirm this attack is considered active
-                if current_attack_data.get('inactive'):
-                    await self.dao.update('attack_uids', where=dict(uid=k), data=dict(inactive=self.dao.db_false_val))
+                                sql_list.append(await self.dao.insert_generate_uid('similar_words', db_criteria,
+                                                                                   return_sql=True))
+            # Record when this attack was last modified so unchanged attacks can be skipped next time
+            if v['modified'] and (v['modified'] != last_modified):
+                sql_list.append((self.SQL_UPSERT_ATTACK_MODIFIED, (k, v['modified'])))
         # Inactive attack IDs have been calculated by using what is in the database currently
         # Update the database entries to be inactive if not already flagged as such
-        already_inactive = await self.dao.raw_select(
-            ('SELECT uid FROM attack_uids WHERE inactive = %s' % self.dao.db_true_val), single_col=True)
-        inactive_attacks = (cur_uids - retrieved_uids) - set(already_inactive)
+        inactive_attacks = {uid for uid in cur_uids - retrieved_uids if not cur_attacks[uid].get('inactive')}
         for inactive_id in inactive_attacks:
-            await self.dao.update('attack_uids', where=dict(uid=inactive_id), data=dict(inactive=self.dao.db_true_val))
-        logging.info('[!] DB Item Count: {}'.format(len(await self.dao.get('attack_uids'))))
+            sql_list.append(await self.dao.update('attack_uids', where=dict(uid=inactive_id),
+                                                  data=dict(inactive=self.dao.db_true_val), return_sql=True))
+        if sql_list and not await self.dao.run_sql_list(sql_list=sql_list):
+            logging.error('ATT&CK data could not be updated in the database.')
+            return set(), set(), []
+        if added_attacks:
+            await self.refresh_attack_hierarchy()
+        logging.info('[!] DB Item Count: {} ({} added, {} renamed, {} now inactive)'.format(
+            len(cur_uids | added_attacks), len(added_attacks), len(name_changes), len(inactive_attacks)))
         return added_attacks, inactive_attacks, name_changes
 
     async def insert_attack_json_data(self, buildfile):
@@ -264,55 +365,46 @@ class DataService:
         :param buildfile: Enterprise attack json file to build from
         :return: nil
         """
-        cur_uids = await self.dao.get_column_as_list(table='attack_uids', column='uid')
+        cur_uids = set(await self.dao.get_column_as_list(table='attack_uids', column='uid'))
         logging.info('[#] {} Existing items in the DB'.format(len(cur_uids)))
-        with open(buildfile, 'r') as infile:
-            attack_dict = json.load(infile)
-            loaded_items = {}
-            # Extract all TIDs
-            for item in attack_dict['objects']:
-                if 'external_references' in item:
-                    # Filter down
-                    if any(x for x in item['external_references'] if x['source_name'] == 'mitre-attack'):
-                        items = [x['external_id'] for x in item['external_references'] if
-                                 x['source_name'] == 'mitre-attack']
-                        if len(items) == 1:
-                            tid = items[0]
-                            # Add in
-                            if tid.startswith('T') and not tid.startswith('TA'):
-                                if item['type'] == "attack-pattern":
-                                    loaded_items[item['id']] = {'id': tid, 'name': item['name'],
-                                                                'examples': [],
-                                                                'similar_words': [],
-                                                                'description': item.get('description', NO_DESC),
-                                                                'example_uses': []}
-                        else:
-                            logging.critical('[!] Error: multiple MITRE sources: {} {}'.format(item['id'], items))
-            # Extract uses for all TIDs
-            for item in attack_dict['objects']:
-                if item['type'] == 'relationship':
-                    if item["relationship_type"] == 'uses':
-                        if 'description' in item:
-                            normalized_example = item['description'].replace('<code>', '').replace('</code>', '')\
-                                .replace('\n', '').encode('ascii', 'ignore').decode('ascii')
-                            # Remove att&ck reference (name)[link to site]
-                            normalized_example = re.sub('\[.*?\]\(.*?\)', '', normalized_example)
-                            if item['target_ref'].startswith('attack-pattern'):
-                                if item['target_ref'] in loaded_items:
-                                    loaded_items[item['target_ref']]['example_uses'].append(normalized_example)
-                                else:
-                                    logging.critical('[!] Found target_ref not in loaded data: {}'
-                                                     .format(item['target_ref']))
+        # Techniques keyed by their STIX ID as (tid, name) and example uses keyed by the technique they refer to
+        loaded_items, example_uses = {}, {}
+        # Read the objects one at a time so memory does not grow with the size of the file
+        for item in iter_stix_objects(buildfile):
+            item_type = item.get('type')
+            if item_type == 'attack-pattern' and 'external_references' in item:
+                # Filter down
+                items = [x['external_id'] for x in item['external_references'] if x['source_name'] == 'mitre-attack']
+                if len(items) == 1:
+                    tid = items[0]
+                    # Add in
+                    if tid.startswith('T') and not tid.startswith('TA'):
+                        loaded_items[item['id']] = (tid, item['name'])
+                elif items:
+                    logging.critical('[!] Error: multiple MITRE sources: {} {}'.format(item['id'], items))
+            # Extract uses for all TIDs (skipping those for techniques already in the DB as these are not re-added)
+            elif item_type == 'relationship' and item['relationship_type'] == 'uses' and 'description' in item \
+                    and item['target_ref'].startswith('attack-pattern') and item['target_ref'] not in cur_uids:
+                normalized_example = item['description'].replace('<code>', '').replace('</code>', '')\
+                    .replace('\n', '').encode('ascii', 'ignore').decode('ascii')
+                # Remove att&ck reference (name)[link to site]
+                normalized_example = re.sub('\[.*?\]\(.*?\)', '', normalized_example)
+                example_uses.setdefault(item['target_ref'], []).append(normalized_example)
+        # Relationships can appear before the techniques they refer to, so only check their targets once all are read
+        for target_ref in example_uses:
+            if target_ref not in loaded_items:
+                logging.critical('[!] Found target_ref not in loaded data: {}'.format(target_ref))
         logging.info("[#] {} Techniques found in input file".format(len(loaded_items)))
         # Deduplicate input data from existing items in the DB
         to_add = {x: y for x, y in loaded_items.items() if x not in cur_uids}
         logging.info('[#] {} Techniques found that are not in the existing database'.format(len(to_add)))
-        for k, v in to_add.items():
-            await self.dao.insert('attack_uids', dict(uid=k, tid=v['id'], name=v['name']))
-            if 'example_uses' in v:
-                [await self.dao.insert_generate_uid(
-                    'true_positives', dict(attack_uid=k, true_positive=self.dao.truncate_str(defang_text(x), 800)))
-                 for x in v['example_uses']]
+        for k, (tid, name) in to_add.items():
+            await self.dao.insert('attack_uids', dict(uid=k, tid=tid, name=name))
+            [await self.dao.insert_generate_uid(
+                'true_positives', dict(attack_uid=k, true_positive=self.dao.truncate_str(defang_text(x), 800)))
+             for x in example_uses.get(k, [])]
+        if to_add:
+            await self.refresh_attack_hierarchy()
 
     async def set_regions_data(self, buildfile=os.path.join('threadcomponents', 'conf', 'country-regions.json')):
         """Function to read in the regions json file."""
@@ -408,27 +500,79 @@ class DataService:
             await self.dao.insert_generate_uid('keywords', dict(name=adding_keyword))
         return to_add
 
-    async def status_grouper(self, status, criteria=None):
+    async def status_grouper(self, status, criteria=None, limit=None, offset=0):
+        """Function to retrieve the report cards (the fields the index page displays) of reports with a status."""
         # The search based on the given status
         search = dict(current_status=status)
         # If extra search criteria has been passed, update the current search dictionary
         if isinstance(criteria, dict):
             search.update(criteria)
+        where, parameters = self._reports_where(search)
+        query = 'SELECT %s FROM reports%s ORDER BY title' % (', '.join(REPORT_CARD_COLUMNS), where)
+        if limit:
+            query += ' LIMIT %s OFFSET %s' % (int(limit), max(0, int(offset)))
         # Execute the search on the reports table
-        reports = await self.dao.get('reports', search)
+        reports = await self.dao.raw_select(query, parameters=parameters)
         for report in reports:
-            del report['uid']  # Prevent ID reaching request-response
             title_quoted = quote(report['title'], safe='')
             edit_link = self.web_svc.get_route(self.web_svc.EDIT_KEY, param=title_quoted)
-            # Format dates if applicable
+            # Format dates if applicable (keeping the date so whether it has expired is checked when displayed)
             expires_on = report.get('expires_on', '')
             if isinstance(expires_on, datetime):
-                # Replace the expiry date with a formatted string
-                is_expired = expires_on < datetime.now(tz=expires_on.tzinfo)
-                report.update(dict(expires_on=expires_on.strftime('%Y-%m-%d %H:%M %Z'), is_expired=is_expired))
+                report.update(dict(expires_on=expires_on.strftime('%Y-%m-%d %H:%M %Z'), expires_at=expires_on))
             report.update(dict(link=edit_link, title_quoted=title_quoted))
         return reports
 
+    async def status_count(self, status, criteria=None):
+        """Function to count the reports with a status."""
+        search = dict(current_status=status)
+        if isinstance(criteria, dict):
+            search.update(criteria)
+        where, parameters = self._reports_where(search)
+        count = await self.dao.raw_select('SELECT COUNT(*) AS count FROM reports' + where, parameters=parameters)
+        return count[0]['count']
+
+    def _reports_where(self, search):
+        """Function to return the WHERE clause (and its parameters) for searching the reports table."""
+        clauses, parameters = [], []
+        for column, value in search.items():
+            if value is None:
+                clauses.append('%s IS NULL' % column)
+            else:
+                clauses.append('%s = %s' % (column, self.dao.db_qparam))
+                parameters.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', tuple(parameters)
+
+    async def report_listing(self, status, criteria=None, page_size=None, page=1):
+        """Function to return a page of report cards for a status and the total number of reports with that status.
+        :return: dict(reports=[...], total=int)"""
+        criteria = criteria or dict()
+        page = max(1, page)
+        key = (status, self.report_listing_versions.get(status, 0), tuple(sorted(criteria.items())), page_size, page)
+        listing = self.report_listings.get(key)
+        if listing is None:
+            offset = (page - 1) * page_size if page_size else 0
+            listing = dict(reports=await self.status_grouper(status, criteria=criteria, limit=page_size, offset=offset),
+                           total=await self.status_count(status, criteria=criteria))
+            self.report_listings.set(key, listing)
+        # Copy the cards so whether a report has expired is worked out now rather than when they were cached
+        reports = []
+        for report in listing['reports']:
+            report = dict(report)
+            expires_at = report.pop('expires_at', None)
+            if expires_at:
+                report['is_expired'] = expires_at < datetime.now(tz=expires_at.tzinfo)
+            reports.append(report)
+        return dict(reports=reports, total=listing['total'])
+
+    def invalidate_report_listings(self, *statuses):
+        """Function to drop the cached report cards of the given statuses (or of all statuses if none are given)."""
+        if not statuses:
+            self.report_listings.clear()
+            return
+        for status in statuses:
+            self.report_listing_versions[status] = self.report_listing_versions.get(status, 0) + 1
+
     async def get_all_categories(self):
         """Function to retrieve all the possible categories for a report."""
         query = 'SELECT keyname, display_name FROM categories'
@@ -550,15 +694,22 @@ class DataService:
             # Need to order by for JOIN query (otherwise sentences can be out of order if attacks are updated)
             "ORDER BY report_sentences.sen_index")
 
-        if group_by_attack:
-            query = (f"SELECT attack_tid, attack_technique_name, attack_parent_name, inactive_attack, "
-                     f"jsonb_agg(jsonb_build_object('uid', rs.uid, 'text', rs.text, 'html', rs.html, "
-                     f"'sen_index', rs.sen_index, 'active_hit', rs.active_hit, "
-                     f"'tech_start_date', rs.tech_start_date, 'tech_end_date', rs.tech_end_date)) as mappings "
-                     f"FROM ({query}) AS rs GROUP BY attack_tid, attack_technique_name, "
-                     f"attack_parent_name, inactive_attack")
+        if not group_by_attack:
+            return await self.dao.raw_select(query, parameters=tuple([report_id]))
 
-        return await self.dao.raw_select(query, parameters=tuple([report_id]))
+        # Group the sentences by attack in the same query (the JSON functions used depend on the db engine)
+        mapping_fields = {field: 'rs.' + field for field in ['uid', 'text', 'html', 'sen_index', 'active_hit',
+                                                             'tech_start_date', 'tech_end_date']}
+        mappings = self.dao.db.sql_json_agg(mapping_fields, 'mappings', order_by='rs.sen_index')
+        query = (f"SELECT attack_tid, attack_technique_name, attack_parent_name, inactive_attack, {mappings} "
+                 f"FROM ({query}) AS rs GROUP BY attack_tid, attack_technique_name, "
+                 f"attack_parent_name, inactive_attack "
+                 # List the attacks in the order they first appear in the report
+                 f"ORDER BY MIN(rs.sen_index)")
+        attacks = await self.dao.raw_select(query, parameters=tuple([report_id]))
+        for attack in attacks:
+            attack['mappings'] = self.dao.db.json_agg_value(attack['mappings'], order_by='sen_index')
+        return attacks
 
     async def get_techniques(self, get_parent_info=False):
         # If we are not getting the parent-attack info (for sub-techniques), then return all results as normal
@@ -582,8 +733,8 @@ class DataService:
             report_id = img_dict[0]['report_uid']
         return report_id
 
-    async def get_confirmed_attacks_for_sentence(self, sentence_id=''):
-        """Function to retrieve confirmed-attack data for a sentence."""
+    async def get_confirmed_attacks_for_sentence(self, sentence_id='', report_id=None):
+        """Function to retrieve confirmed-attack data for a sentence (or every sentence in a report if given)."""
         # Ensure any date fields are converted into strings
         start_date = self.dao.db.sql_date_field_to_str('report_sentence_hits.start_date')
         end_date = self.dao.db.sql_date_field_to_str('report_sentence_hits.end_date')
@@ -591,50 +742,46 @@ class DataService:
             # Select all columns from the full attack info table
             self.SQL_WITH_PAR_ATTACK_INC_INACTIVE + "SELECT " + FULL_ATTACK_INFO + ".*, "
             # Include row ID for use when updating dates of attack
-            "report_sentence_hits.uid AS mapping_id, " + start_date + ", " + end_date + " "
+            "report_sentence_hits.uid AS mapping_id, report_sentence_hits.sentence_id, " + start_date + ", " +
+            end_date + " "
             # Use an INNER JOIN on full_attack_info and report_sentence_hits (to get the intersection of attacks)
             "FROM (" + FULL_ATTACK_INFO + " INNER JOIN report_sentence_hits ON " + FULL_ATTACK_INFO +
             ".uid = report_sentence_hits.attack_uid) "
             # Finish with the WHERE clause stating which sentence we are searching for and that the attack is confirmed
-            "WHERE report_sentence_hits.sentence_id = %s" % self.dao.db_qparam + " "
+            "WHERE report_sentence_hits.%s = %s" % (self._hits_filter(report_id), self.dao.db_qparam) + " "
             "AND report_sentence_hits.confirmed = %s" % self.dao.db_true_val)
         # Run the above query and return its results
-        return await self.dao.raw_select(select_join_query, parameters=tuple([sentence_id]))
+        return await self.dao.raw_select(select_join_query, parameters=tuple([report_id or sentence_id]))
 
     async def get_unconfirmed_undated_attack_count(self, report_id='', return_detail=False):
         """Function to retrieve the number of unconfirmed attacks without a start-date for a report."""
-        # Retrieve all unconfirmed attacks
-        all_unconfirmed = await self.dao.get('report_sentence_hits', dict(report_uid=report_id,
-                                                                          confirmed=self.dao.db_false_val))
-        # Ignore entries in the database where the model was incorrect (i.e. is unconfirmed because it was rejected and
-        # we are storing in report_sentence_hits that initial_model_match=1 so confirmed=0): these are false positives
-        select_join_query = (
-            "SELECT * FROM (report_sentence_hits INNER JOIN false_positives "
-            "ON report_sentence_hits.attack_uid = false_positives.attack_uid "
-            "AND report_sentence_hits.sentence_id = false_positives.sentence_id) "
+        # Retrieve all unconfirmed attacks, ignoring entries in the database where the model was incorrect (i.e. is
+        # unconfirmed because it was rejected and we are storing in report_sentence_hits that initial_model_match=1 so
+        # confirmed=0): these are false positives, which the database leaves out using NOT EXISTS
+        where_unconfirmed = (
             "WHERE report_sentence_hits.report_uid = %s" % self.dao.db_qparam + " "
-            "AND (report_sentence_hits.confirmed = %s" % self.dao.db_false_val + " "
-            "OR report_sentence_hits.start_date IS NULL)")
-        ignore = await self.dao.raw_select(select_join_query, parameters=tuple([report_id]))
-        # Ideally would use an SQL MINUS query but this caused errors
+            "AND report_sentence_hits.confirmed = %s" % self.dao.db_false_val + " "
+            "AND NOT EXISTS (SELECT 1 FROM false_positives "
+            "WHERE false_positives.sentence_id = report_sentence_hits.sentence_id "
+            "AND false_positives.attack_uid = report_sentence_hits.attack_uid)")
         # Return the count if we are not returning the detail
         if not return_detail:
-            return len(all_unconfirmed) - len(ignore)
-        # If returning details, set up a dictionary and convert the dictionaries in ignore to tuples (for matching)
-        unconfirmed_by_sentence = dict()
-        tuple_ig = [(x.get('attack_uid', 'error'), x.get('sentence_id', 'error'), x.get('attack_tid', 'error'))
-                    for x in ignore]
-        # Loop through each unconfirmed hit; check it's not in ignore; add to final dictionary (group by sentence)
-        for u in all_unconfirmed:
-            sen_id = u.get('sentence_id', 'error')
-            a_id, a_tid = u.get('attack_uid', 'error'), u.get('attack_tid', 'error')
-            if (a_id, sen_id, a_tid) in tuple_ig:
+            count = await self.dao.raw_select('SELECT COUNT(*) AS count FROM report_sentence_hits ' + where_unconfirmed,
+                                              parameters=tuple([report_id]))
+            return count[0]['count']
+        # Else group the unconfirmed hits by sentence (in the order the sentences appear in the report)
+        select_query = (
+            "SELECT report_sentence_hits.sentence_id, report_sentence_hits.attack_uid, report_sentence_hits.attack_tid "
+            "FROM (report_sentence_hits INNER JOIN report_sentences "
+            "ON report_sentences.uid = report_sentence_hits.sentence_id) " + where_unconfirmed + " "
+            "ORDER BY report_sentences.sen_index, report_sentence_hits.attack_tid")
+        unconfirmed_by_sentence, seen = dict(), set()
+        for hit in await self.dao.raw_select(select_query, parameters=tuple([report_id])):
+            sen_id, a_id, a_tid = hit['sentence_id'], hit['attack_uid'], hit['attack_tid']
+            if (sen_id, a_id, a_tid) in seen:
                 continue
-            current_list = unconfirmed_by_sentence.get(sen_id, [])
-            attack_info = dict(attack_uid=a_id, attack_tid=a_tid)
-            if attack_info not in current_list:
-                current_list.append(attack_info)
-                unconfirmed_by_sentence[sen_id] = current_list
+            seen.add((sen_id, a_id, a_tid))
+            unconfirmed_by_sentence.setdefault(sen_id, []).append(dict(attack_uid=a_id, attack_tid=a_tid))
         return unconfirmed_by_sentence
 
     async def get_confirmed_techniques_for_nav_export(self, report_id):
@@ -664,8 +811,9 @@ class DataService:
         # Return the list of confirmed techniques
         return techniques
 
-    async def get_active_sentence_hits(self, sentence_id=''):
-        """Function to retrieve active sentence hits (and ignoring historic ones, e.g. a model's initial prediction)."""
+    async def get_active_sentence_hits(self, sentence_id='', report_id=None):
+        """Function to retrieve active sentence hits (and ignoring historic ones, e.g. a model's initial prediction).
+        If a report ID is given, the hits for every sentence in that report are returned."""
         select_join_query = (
             # Using the temporary table with parent-technique info
             self.SQL_WITH_PAR_ATTACK_INC_INACTIVE +
@@ -678,11 +826,38 @@ class DataService:
             "FROM (" + FULL_ATTACK_INFO + " INNER JOIN report_sentence_hits ON " + FULL_ATTACK_INFO +
             ".uid = report_sentence_hits.attack_uid) "
             # Finish with the WHERE clause stating which sentence we are searching for and that the hit is active
-            "WHERE report_sentence_hits.sentence_id = %s" % self.dao.db_qparam + " "
+            "WHERE report_sentence_hits.%s = %s" % (self._hits_filter(report_id), self.dao.db_qparam) + " "
             "AND report_sentence_hits.active_hit = %s" % self.dao.db_true_val)
         # Run the above query and return its results
-        return await self.dao.raw_select(select_join_query, parameters=tuple([sentence_id]))
-    
+        return await self.dao.raw_select(select_join_query, parameters=tuple([report_id or sentence_id]))
+
+    @staticmethod
+    def _hits_filter(report_id=None):
+        """Function to return the report_sentence_hits column to filter on: the report's or the sentence's ID."""
+        return 'report_uid' if report_id else 'sentence_id'
+
+    async def get_report_hit_index(self, report_id):
+        """Function to retrieve the active hits, confirmed hits and IoC text of each sentence in a report.
+        :return: dictionary of sentence ID -> dict(techniques=[...], confirmed=[...], ioc='')"""
+        hit_index = dict()
+
+        def sentence_entry(sentence_id):
+            return hit_index.setdefault(sentence_id, dict(techniques=[], confirmed=[], ioc=''))
+
+        # Three queries for the whole report rather than three per sentence
+        for hit in await self.get_active_sentence_hits(report_id=report_id):
+            sentence_entry(hit['sentence_id'])['techniques'].append(hit)
+        for hit in await self.get_confirmed_attacks_for_sentence(report_id=report_id):
+            sentence_entry(hit['sentence_id'])['confirmed'].append(hit)
+        for ioc in await self.get_report_sentence_indicators_of_compromise(report_id):
+            sentence_entry(ioc['sentence_id'])['ioc'] = ioc['refanged_sentence_text']
+        return hit_index
+
+    async def get_sentence_hits(self, sentence_id):
+        """Function to retrieve the active and confirmed hits of a single sentence (see get_report_hit_index())."""
+        return dict(techniques=await self.get_active_sentence_hits(sentence_id=sentence_id),
+                    confirmed=await self.get_confirmed_attacks_for_sentence(sentence_id=sentence_id))
+
     async def get_report_unique_techniques_count(self, report_id) -> int:
         """Function to return the amount of unique techniques found in a report."""
         count_query = (
@@ -694,24 +869,26 @@ class DataService:
         return count_query_result[0]['count']
 
     async def remove_expired_reports(self):
-        """Function to delete expired reports."""
+        """Function to delete expired reports, returning the IDs of the deleted reports."""
         # The query below uses a timestamp function which differs across DB engines; obtain the correct one
         logging.info('DELETE EXPIRED REPORTS: START')
         time_now = self.dao.db_func(self.dao.db.FUNC_TIME_NOW) + '()'
         # Expired reports are where its timestamp is behind the current time (hence less-than)
         query = ' FROM reports WHERE expires_on < %s' % time_now
-        select_query = 'SELECT url' + query
-        expired_urls = await self.dao.raw_select(select_query, single_col=True)
-        if expired_urls:
-            for url in expired_urls:
-                logging.info('Expired URL will be deleted: `%s`' % url)
+        select_query = 'SELECT uid, url' + query
+        expired = await self.dao.raw_select(select_query)
+        for report in expired:
+            logging.info('Expired URL will be deleted: `%s`' % report['url'])
         delete_query = 'DELETE' + query
         await self.dao.run_sql_list(sql_list=[(delete_query,)])
+        self.invalidate_report_listings()
         logging.info('DELETE EXPIRED REPORTS: END')
+        return [report['uid'] for report in expired]
 
     async def remove_report_by_id(self, report_id=''):
         """Function to delete a report by its ID."""
         await self.dao.delete('reports', dict(uid=report_id))
+        self.invalidate_report_listings()
 
     async def get_report_by_id_or_title(self, by_id=False, by_title=False, report='', add_expiry_bool=True):
         """Given a report ID or title, returns matching report records."""
@@ -796,54 +973,56 @@ class DataService:
         :param title: The current title to check for duplicates in the database.
         :return: A title that will be unique in the reports table of the database.
         """
-        # Check for any duplicates of the given title
-        existing = await self.dao.get('reports', dict(title=title))
-        # If there is already a report with this title...
-        if existing:
-            # Search for duplicates in the reports table like title_1, title_2, etc
-            # Using 'like' operator means any literal %s and _s need to be escaped
-            title_escaped = title.replace('%', '\\%').replace('_', '\\_')
-            # The query with a qmark placeholder for the title and stating an escape character is used
-            query = 'SELECT * FROM reports WHERE title LIKE %s ESCAPE \'\\\';' % self.dao.db_qparam
-            # Run the query with the escaped-title as a parameter plus a _X suffix
-            underscore_hits = await self.dao.raw_select(query, parameters=(f'{title_escaped}\\_%',))
-            # If we have matches...
-            if underscore_hits:
-                # Collect all the numerical suffixes
-                suffixes = set()
-                # Collect them by iterating through each matched report...
-                for match in underscore_hits:
-                    match_title = match.get('title')
-                    if match_title:
-                        # and obtaining substring in title after last occurrence of _
-                        suffix = match_title.rpartition('_')[-1]
-                        # Add this to the suffixes list if it's a number else skip to next match
-                        try:
-                            suffixes.add(int(suffix))
-                        except ValueError:
-                            pass
-                # If we have numerical suffixes...
-                if suffixes:
-                    # Get the range from 1 to the max suffix number collected (+1 as range() doesn't include this)
-                    true_range = set(range(1, max(suffixes) + 1))
-                    # See what numbers are missing from the collected suffixes by doing a difference with the sets
-                    suffix_diff = true_range - suffixes
-                    # If there is a difference, the next number will be the minimum in this set
-                    if suffix_diff:
-                        return title + '_' + str(min(suffix_diff))
-                    # If there is no difference, all numbers in the range are found as suffixes with title
-                    # so return the next number along from suffixes
-                    else:
-                        return title + '_' + str(max(suffixes) + 1)
-                # Else there were no numerical suffixes so can return title_1
+        return (await self.get_unique_titles([title]))[0]
+
+    async def get_unique_titles(self, titles):
+        """
+        Function to retrieve unique titles for a list of titles.
+        :param titles: The list of titles to check for duplicates in the database (and in the list itself).
+        :return: A list of titles (in the same order) that will be unique in the reports table of the database.
+        """
+        return [allocated['title'] for allocated in await self.allocate_titles(titles)]
+
+    async def allocate_titles(self, titles):
+        """
+        Function to allocate unique titles for a list of titles: a title already used is given the next _X suffix.
+        :param titles: The list of titles to allocate (duplicates in the list itself are allocated different titles).
+        :return: A list (in the same order) of dictionaries with the title, base_title and title_suffix to insert.
+        """
+        distinct_titles = list(dict.fromkeys(titles))
+        if not distinct_titles:
+            return []
+        qparams = ', '.join([self.dao.db_qparam] * len(distinct_titles))
+        # The highest suffix used for each title (an indexed lookup rather than parsing every similar title)
+        query = 'SELECT base_title, MAX(title_suffix) AS max_suffix FROM reports WHERE base_title IN (%s) ' \
+                'GROUP BY base_title;' % qparams
+        max_suffixes = await self.dao.raw_select(query, parameters=tuple(distinct_titles))
+        next_suffix = {title: 0 for title in distinct_titles}
+        next_suffix.update({row['base_title']: row['max_suffix'] + 1 for row in max_suffixes})
+        allocated = []
+        for title in titles:
+            allocated.append(dict(base_title=title, title_suffix=next_suffix[title]))
+            next_suffix[title] += 1
+        # Titles submitted with a _X ending (or reports pre-dating title suffixes) could still clash: check the titles
+        pending, used = allocated, set()
+        while pending:
+            for entry in pending:
+                suffix = entry['title_suffix']
+                entry['title'] = entry['base_title'] + ('_' + str(suffix) if suffix else '')
+            qparams = ', '.join([self.dao.db_qparam] * len(pending))
+            taken = set(await self.dao.raw_select('SELECT title FROM reports WHERE title IN (%s);' % qparams,
+                                                  parameters=tuple(e['title'] for e in pending), single_col=True))
+            clashes = []
+            for entry in pending:
+                if entry['title'] in taken or entry['title'] in used:
+                    # Move onto the next suffix for this title and check again
+                    entry['title_suffix'] = next_suffix[entry['base_title']]
+                    next_suffix[entry['base_title']] += 1
+                    clashes.append(entry)
                 else:
-                    return title + '_1'
-            # Else no matches on suffix (title_X) so can return title_1
-            else:
-                return title + '_1'
-        # Else no reports currently have this title so the title can be used as is
-        else:
-            return title
+                    used.add(entry['title'])
+            pending = clashes
+        return allocated
 
     def ml_reg_split(self, techniques):
         list_of_legacy, list_of_techs = [], []
@@ -4,15 +4,25 @@
 
 import asyncio
 import logging
-import nltk
 import os
-import pandas as pd
 import pickle
 import random
+import threading
+import time
 
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
+from threadcomponents.metrics import LONG_BUCKETS, REGISTRY
+
+# Metrics of the classification models
+MODEL_LOAD_SECONDS = REGISTRY.histogram('thread_model_load_seconds', 'Time taken to load the saved models.',
+                                        buckets=LONG_BUCKETS)
+MODEL_BUILD_SECONDS = REGISTRY.histogram('thread_model_build_seconds', 'Time taken to (re)build all the models.',
+                                         buckets=LONG_BUCKETS)
+MODEL_EVALUATIONS = REGISTRY.counter('thread_model_evaluations_total',
+                                     'Technique models run against the sentences of a report.')
+MODEL_PREDICTIONS = REGISTRY.counter('thread_model_sentence_predictions_total',
+                                     'Sentences classified by a technique model.')
+MISSING_MODELS = REGISTRY.counter('thread_model_missing_total',
+                                  'Techniques skipped during analysis as they had no model.')
 
 
 class MLService:
@@ -24,9 +34,17 @@ class MLService:
         self.dir_prefix = dir_prefix
         # Specify the location of the models file
         self.dict_loc = os.path.join(self.dir_prefix, 'threadcomponents', 'models', 'model_dict.p')
+        # Whether the nltk packs have been checked (guarded by a thread-lock as reports are analysed in other threads)
+        self.nltk_packs_checked = False
+        self._nltk_packs_lock = threading.Lock()
 
     async def build_models(self, tech_id, tech_name, techniques):
         """Function to build Logistic Regression Classification models based off of the examples provided."""
+        # pandas and scikit-learn take seconds to import so only do this when models are (re)built
+        import pandas as pd
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.model_selection import train_test_split
         lst1, lst2, false_list, sampling = [], [], [], []
         len_truelabels = 0
 
@@ -75,6 +93,7 @@ class MLService:
         return (cv, logreg)
 
     async def analyze_document(self, cv, logreg, sentences):
+        import pandas as pd
         cleaned_sentences = [await self.web_svc.tokenize(i['text']) for i in sentences]
 
         df2 = pd.DataFrame({'text': cleaned_sentences})
@@ -96,6 +115,7 @@ class MLService:
                 return rebuilt, model_dict
         # Else proceed with building the models
         model_dict = {}
+        start = time.perf_counter()
         total = len(list_of_techs)
         count = 1
         logging.info('Building Classification Models.. This could take anywhere from ~30-60+ minutes. '
@@ -104,6 +124,7 @@ class MLService:
             logging.info('[#] Building.... {}/{}'.format(count, total))
             count += 1
             model_dict[tech_id] = await self.build_models(tech_id, tech_name, techniques)
+        MODEL_BUILD_SECONDS.observe(time.perf_counter() - start)
         rebuilt = True
         logging.info('[#] Saving models to pickled file: ' + os.path.basename(self.dict_loc))
         # Save the newly-built models
@@ -137,7 +158,8 @@ class MLService:
                 # Attempt to load the model file's contents
                 try:
                     # A UserWarning can appear stating the risks of using a different pickle version from sklearn
-                    loaded = pickle.load(pre_saved_dict)
+                    with MODEL_LOAD_SECONDS.time():
+                        loaded = pickle.load(pre_saved_dict)
                     logging.info('[#] Successfully loaded models from pickled file')
                     return loaded
                 # sklearn.linear_model.logistic has been required in a previous run; might be related to UserWarning
@@ -160,11 +182,14 @@ class MLService:
             try:
                 cv, logreg = model_dict[tech_id]
             except KeyError:  # Report to user if a model can't be retrieved
+                MISSING_MODELS.inc()
                 logging.warning('Technique `' + tech_id + ', ' + tech_name + '` has no model to analyse with. '
                                 + 'You can try deleting/moving models/model_dict.p to trigger re-build of models.')
                 # Skip this technique and move onto the next one
                 continue
             final_df = await self.analyze_document(cv, logreg, list_of_sentences)
+            MODEL_EVALUATIONS.inc()
+            MODEL_PREDICTIONS.inc(len(list_of_sentences))
             count = 0
             for vals in final_df['category']:
                 await asyncio.sleep(0.001)
@@ -215,16 +240,28 @@ class MLService:
         return analyzed_html
 
     async def check_nltk_packs(self):
-        try:
-            nltk.data.find('tokenizers/punkt')
-            logging.info('[*] Found punkt')
-        except LookupError:
-            logging.warning('Could not find the punkt pack, downloading now')
-            nltk.download('punkt')
-        try:
-            nltk.data.find('corpora/stopwords')
-            logging.info('[*] Found stopwords')
-        except LookupError:
-            logging.warning('Could not find the stopwords pack, downloading now')
-            nltk.download('stopwords')
-        self.web_svc.initialise_tokenizer()
+        """Function to check (once) the nltk packs are available, downloading them if not."""
+        if self.nltk_packs_checked:
+            return
+        # Importing nltk and downloading any packs blocks, so do this outside the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._check_nltk_packs)
+
+    def _check_nltk_packs(self):
+        with self._nltk_packs_lock:
+            if self.nltk_packs_checked:
+                return
+            import nltk
+            try:
+                nltk.data.find('tokenizers/punkt')
+                logging.info('[*] Found punkt')
+            except LookupError:
+                logging.warning('Could not find the punkt pack, downloading now')
+                nltk.download('punkt')
+            try:
+                nltk.data.find('corpora/stopwords')
+                logging.info('[*] Found stopwords')
+            except LookupError:
+                logging.warning('Could not find the stopwords pack, downloading now')
+                nltk.download('stopwords')
+            self.web_svc.initialise_tokenizer()
+            self.nltk_packs_checked = True
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+
+from aiohttp import web
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from threadcomponents.service.ttl_cache import TTLCache
+
+# The encodings bodies are pre-compressed with, in order of preference
+GZIP, BROTLI = 'gzip', 'br'
+
+
+def make_etag(body, weak=True, encoding=None):
+    """Function to return an ETag for a response body. A weak ETag applies to any encoding of the body; a strong ETag
+    is for one encoding (so differs per encoding)."""
+    digest = hashlib.sha1(body).hexdigest()
+    if weak:
+        return 'W/"%s"' % digest
+    return '"%s%s"' % (digest, ('-' + encoding) if encoding else '')
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """Function to check if a request's conditional headers show the client already has this version."""
+    if_none_match = request.headers.get('If-None-Match')
+    # If-None-Match takes precedence over If-Modified-Since
+    if if_none_match is not None:
+        if not etag:
+            return False
+        # Compare weakly: W/"x" matches "x"
+        client_etags = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+        return ('*' in client_etags) or (etag.replace('W/', '', 1) in client_etags)
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def validator_headers(etag=None, last_modified=None):
+    """Function to return the headers letting a client revalidate (rather than re-download) a response."""
+    headers = dict()
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+    return headers
+
+
+def compress(body):
+    """Function to return a dictionary of encoding -> the body compressed with that encoding."""
+    encoded = {GZIP: gzip.compress(body, compresslevel=9, mtime=0)}
+    try:
+        # Brotli is optional: only used if installed
+        import brotli
+    except ImportError:
+        return encoded
+    encoded[BROTLI] = brotli.compress(body)
+    return encoded
+
+
+def accepted_encoding(request, available):
+    """Function to return the preferred encoding (of those available) the client accepts, or None."""
+    accepted = set()
+    for encoding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = encoding.partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        # Skip encodings the client has explicitly refused (q=0)
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    for encoding in (BROTLI, GZIP):
+        if encoding in available and encoding in accepted:
+            return encoding
+    return None
+
+
+class CachedPage:
+    """A rendered page with its validators and pre-compressed bodies."""
+
+    def __init__(self, body, content_type='text/html', charset='utf-8', strong_etag=False, compress_body=True):
+        self.body = body
+        self.content_type = content_type
+        self.charset = charset
+        self.etag = make_etag(body)
+        # A short fingerprint of the body, e.g. to version the URL it is served from
+        self.version = hashlib.sha1(body).hexdigest()[:12]
+        # HTTP dates have no fractions of a second
+        self.last_modified = datetime.now(tz=timezone.utc).replace(microsecond=0)
+        self.encoded = compress(body) if compress_body else dict()
+        # Encoding -> strong ETag if these are used instead of the weak ETag
+        self.strong_etags = {encoding: make_etag(body, weak=False, encoding=encoding)
+                             for encoding in [None] + list(self.encoded)} if strong_etag else None
+
+    def response(self, request, cache_control='no-cache'):
+        """Function to return the response for this page: a 304 if the client's copy is current, else the body in
+        the best encoding the client accepts."""
+        encoding = accepted_encoding(request, self.encoded)
+        etag = self.strong_etags[encoding] if self.strong_etags else self.etag
+        headers = validator_headers(etag=etag, last_modified=self.last_modified)
+        headers.update({'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'})
+        if is_not_modified(request, etag=etag, last_modified=self.last_modified):
+            return web.Response(status=304, headers=headers)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=self.encoded[encoding] if encoding else self.body, headers=headers,
+                            content_type=self.content_type, charset=self.charset)
+
+
+class PageCache:
+    """A cache of rendered pages whose content only changes on deploy."""
+
+    def __init__(self, max_size=100):
+        self.pages = TTLCache(max_size=max_size, ttl=0)
+
+    def get_page(self, key, render):
+        """Function to return the cached page for a key, calling `render` (which returns the page's text) if it is
+        not cached."""
+        page = self.pages.get(key)
+        if page is None:
+            page = CachedPage(render().encode('utf-8'))
+            self.pages.set(key, page)
+        return page
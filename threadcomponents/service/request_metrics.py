@@ -0,0 +1,92 @@
+import logging
+import time
+
+from aiohttp import web
+from aiohttp.web_exceptions import HTTPException
+from threadcomponents.database.thread_db import QueryStats, query_stats
+from threadcomponents.metrics import REGISTRY
+
+# The request key a handler can set to separate its requests by an extra label (e.g. the REST API's `index`)
+# (typed request keys are only in newer versions of aiohttp)
+REQUEST_INDEX_KEY = web.RequestKey('metrics_index', str) if hasattr(web, 'RequestKey') else 'metrics_index'
+# The route label of requests which did not match a route
+UNMATCHED_ROUTE = 'unmatched'
+# The labels requests are recorded under
+REQUEST_LABELS = ('method', 'route', 'index')
+
+
+class RequestMetrics:
+    """A class to time each request and account for the database queries it ran, by route."""
+
+    def __init__(self, query_limit=None, registry=REGISTRY):
+        # The number of queries above which a request is logged (e.g. to spot a query made per row); None for no limit
+        self.query_limit = query_limit
+        self.latency = registry.histogram('thread_http_request_seconds', 'Time taken to respond to requests.',
+                                          label_names=REQUEST_LABELS)
+        self.db_latency = registry.histogram('thread_http_request_db_seconds',
+                                             'Time spent running database queries per request.',
+                                             label_names=REQUEST_LABELS)
+        self.queries = registry.counter('thread_http_request_queries_total', 'Database queries run by requests.',
+                                        label_names=REQUEST_LABELS)
+        self.over_query_limit = registry.counter('thread_http_requests_over_query_limit_total',
+                                                 'Requests which ran more database queries than the query limit.',
+                                                 label_names=REQUEST_LABELS)
+
+    @staticmethod
+    def route_labels(request):
+        """Function to return the labels (method, route and index) a request is recorded under."""
+        route = UNMATCHED_ROUTE
+        resource = request.match_info.route.resource
+        if resource is not None:
+            route = resource.canonical
+        return dict(method=request.method, route=route, index=request.get(REQUEST_INDEX_KEY, ''))
+
+    def record(self, labels, seconds, stats):
+        """Function to record a request's latency and queries; returns whether the request exceeded the query limit."""
+        self.latency.observe(seconds, **labels)
+        self.db_latency.observe(stats.seconds, **labels)
+        self.queries.inc(stats.count, **labels)
+        over_limit = (self.query_limit is not None) and (stats.count > self.query_limit)
+        if over_limit:
+            self.over_query_limit.inc(**labels)
+        return over_limit
+
+    @staticmethod
+    def server_timing(seconds, stats, over_limit=False):
+        """Function to return the Server-Timing header value of a request."""
+        query_desc = '%s queries%s' % (stats.count, ' (over limit)' if over_limit else '')
+        return 'db;desc="%s";dur=%.1f, total;dur=%.1f' % (query_desc, stats.seconds * 1000, seconds * 1000)
+
+    def finish(self, request, response, seconds, stats):
+        """Function to record a finished request and add its Server-Timing header to its response (if it has one)."""
+        labels = self.route_labels(request)
+        over_limit = self.record(labels, seconds, stats)
+        if over_limit:
+            logging.warning('%s %s%s ran %s queries (limit %s); check for a query being made per row'
+                            % (request.method, request.path, (' (%s)' % labels['index']) if labels['index'] else '',
+                               stats.count, self.query_limit))
+        # There is no response for unhandled errors and a streamed response has already sent its headers
+        if (response is None) or getattr(response, 'prepared', False):
+            return
+        try:
+            response.headers['Server-Timing'] = self.server_timing(seconds, stats, over_limit=over_limit)
+        except (AttributeError, TypeError):
+            pass
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """Function to time a request, count the queries it ran and add these to its response's headers."""
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        start, response = time.perf_counter(), None
+        try:
+            response = await handler(request)
+        except HTTPException as error_resp:
+            # Error responses (e.g. redirects and 404s) are raised: they are timed too
+            response = error_resp
+            raise
+        finally:
+            stats.closed = True
+            query_stats.reset(token)
+            self.finish(request, response, time.perf_counter() - start, stats)
+        return response
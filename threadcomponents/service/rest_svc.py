@@ -3,26 +3,32 @@
 # To see its full history, please use `git log --follow <filename>` to view previous commits and additional contributors
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
-import pandas as pd
 import re
+import uuid
 
 from aiohttp import web
 from contextlib import suppress
 from datetime import datetime, timedelta
 from enum import Enum, unique
 from functools import partial
-from htmldate import find_date
 from io import StringIO
 from ipaddress import IPv4Address, IPv4Interface, IPv6Address, IPv6Interface
+from threadcomponents.metrics import LONG_BUCKETS, REGISTRY
+from threadcomponents.service.analysis_trace import AnalysisTrace, SamplingProfiler
+from threadcomponents.service.ttl_cache import TTLCache
+from threadcomponents.service.url_fetcher import canonicalise_url
 from urllib.parse import unquote
 
 PUBLIC = 'public'
 UID = 'uid'
 URL = 'url'
 TITLE = 'title'
+# The key for a queued report's downloaded document (not a reports-table column)
+DOCUMENT = 'document'
 DATETIME_OBJ = 'datetime_obj'
 REST_IGNORED = dict(ignored=1)
 REST_SUCCESS = dict(success=1)
@@ -30,6 +36,17 @@ REST_SUCCESS = dict(success=1)
 # The minimum amount of tecniques for a report to not be discarded
 REPORT_TECHNIQUES_MINIMUM = 5
 
+# Metrics of the reports analysed
+ANALYSIS_SECONDS = REGISTRY.histogram('thread_analysis_seconds', 'Time taken to analyse a report.',
+                                      buckets=LONG_BUCKETS)
+ANALYSIS_STAGE_SECONDS = REGISTRY.histogram('thread_analysis_stage_seconds', 'Time taken by each stage of analysing '
+                                            'a report.', label_names=('stage',), buckets=LONG_BUCKETS)
+ANALYSED_REPORTS = REGISTRY.counter('thread_analysed_reports_total', 'Reports taken off the queue (by outcome).',
+                                    label_names=('outcome',))
+ANALYSED_SENTENCES = REGISTRY.counter('thread_analysed_sentences_total', 'Sentences analysed.')
+SENTENCES_PER_SECOND = REGISTRY.gauge('thread_analysis_sentences_per_second',
+                                      'Sentences analysed per second by the most recently analysed report.')
+
 
 @unique
 class ReportStatus(Enum):
@@ -54,12 +71,55 @@ class AssociationWith(Enum):
     GR = 'group'
 
 
+class UserQueue(list):
+    """A user's list of queued URLs which also indexes the canonical URLs of each queued report."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        # Canonical URL -> number of queued reports known by it; queued URL -> key-sets (one per queued report)
+        self._index, self._url_keys = dict(), dict()
+        for url in self:
+            self._add_keys(url, None)
+
+    def _add_keys(self, url, keys):
+        with suppress(ValueError):
+            keys = keys or {canonicalise_url(url)}
+            self._url_keys.setdefault(url, []).append(keys)
+            for key in keys:
+                self._index[key] = self._index.get(key, 0) + 1
+
+    def append(self, url, keys=None):
+        super().append(url)
+        self._add_keys(url, keys)
+
+    def remove(self, url):
+        super().remove(url)
+        key_sets = self._url_keys.get(url)
+        if not key_sets:
+            return
+        for key in key_sets.pop():
+            self._index[key] -= 1
+            if not self._index[key]:
+                del self._index[key]
+        if not key_sets:
+            del self._url_keys[url]
+
+    def contains_any(self, keys):
+        """Function to check if any of the given canonical URLs belongs to a queued report."""
+        return any(key in self._index for key in keys)
+
+
 class RestService:
     def __init__(self, web_svc, reg_svc, data_svc, ml_svc, dao, dir_prefix='', queue_limit=None, max_tasks=1,
-                 sentence_limit=None, attack_file_settings=None):
+                 sentence_limit=None, attack_file_settings=None, validation_concurrency=8, slow_analysis_seconds=None):
         self.MAX_TASKS = max_tasks
         self.QUEUE_LIMIT = queue_limit
         self.SENTENCE_LIMIT = sentence_limit
+        # Analyses are profiled and those taking at least this many seconds have their profile saved (None for none)
+        self.SLOW_ANALYSIS_SECONDS = slow_analysis_seconds
+        self.profile_dir = os.path.join(dir_prefix, 'profiles')
+        # The maximum number of URLs from a batch submission to verify at a time
+        self.VALIDATION_CONCURRENCY = max(1, validation_concurrency)
         self.dao = dao
         self.data_svc = data_svc
         self.web_svc = web_svc
@@ -67,6 +127,7 @@ class RestService:
         self.reg_svc = reg_svc
         self.is_local = self.web_svc.is_local
         self.queue_map = dict()  # map each user to their own queue
+        self.queue_salt = os.urandom(16)  # salts the hashes of user tokens in queue_sizes()
         try:
             self.queue = asyncio.Queue()  # task queue
         except RuntimeError as e:  # a RuntimeError may occur if there is no event loop
@@ -75,23 +136,56 @@ class RestService:
             asyncio.set_event_loop(loop)
             self.queue = asyncio.Queue()
         self.current_tasks = []  # tasks that are currently being executed
+        # A lock for allocating report titles and inserting those reports
+        self.title_lock = asyncio.Lock()
+        # Batch (CSV) submissions run in the background: keep their results for the client to collect
+        self.batch_jobs = TTLCache(max_size=1000, ttl=3600)
+        self.batch_tasks = set()  # the background tasks processing batch submissions
+        # Each report's sentence hits (see data_svc.get_report_hit_index()) so sentence clicks avoid the database
+        # Entries are dropped whenever a report's hits or IoCs are edited
+        self.report_hit_index = TTLCache(max_size=100, ttl=900)
+        # Each report's revision, bumped whenever the report is edited (so anything derived from it, e.g. a cached
+        # export, is not reused); reports not edited since startup (or since all revisions were bumped) share one
+        # Revisions are dropped when their reports are deleted (see report_revision() for their scope)
+        self.report_revisions = dict()
+        self.base_revision, self._last_revision = 0, 0
         # A dictionary to keep track of report statuses we have seen
         self.seen_report_status = dict()
         # The offline attack dictionary
         attack_file_settings = attack_file_settings or dict()
         default_attack_filepath = os.path.join(dir_prefix, 'threadcomponents', 'models', 'attack_dict.json')
         self.attack_dict_loc = attack_file_settings.get('filepath', default_attack_filepath)
-        self.json_tech, self.list_of_legacy, self.list_of_techs = {}, [], []
+        # The attack dictionary is large so is only loaded when first needed (see json_tech)
+        self._json_tech, self._list_of_legacy, self._list_of_techs = None, [], []
         self.update_attack_file = attack_file_settings.get('update', False)  # Are we updating this file periodically?
         self.attack_file_indent = attack_file_settings.get('indent', 2)
-        self.set_internal_attack_data()
+
+    def _ensure_attack_data(self):
+        """Function to load the attack dictionary if this has not been done yet."""
+        if self._json_tech is None:
+            self.set_internal_attack_data()
+
+    @property
+    def json_tech(self):
+        self._ensure_attack_data()
+        return self._json_tech
+
+    @property
+    def list_of_legacy(self):
+        self._ensure_attack_data()
+        return self._list_of_legacy
+
+    @property
+    def list_of_techs(self):
+        self._ensure_attack_data()
+        return self._list_of_techs
 
     def set_internal_attack_data(self, load_attack_dict=True):
         """Function to set the class variables holding attack data."""
-        if load_attack_dict:
+        if load_attack_dict or self._json_tech is None:
             with open(self.attack_dict_loc, 'r', encoding='utf_8') as attack_dict_f:
-                self.json_tech = json.load(attack_dict_f)
-        self.list_of_legacy, self.list_of_techs = self.data_svc.ml_reg_split(self.json_tech)
+                self._json_tech = json.load(attack_dict_f)
+        self._list_of_legacy, self._list_of_techs = self.data_svc.ml_reg_split(self._json_tech)
 
     async def fetch_and_update_attack_data(self, is_startup=False):
         """Function to fetch and update the attack data."""
@@ -99,6 +193,10 @@ class RestService:
         updates, updated_json_tech = False, False
         # The output of the attack-data-updates from data_svc
         added_attacks, inactive_attacks, name_changes = await self.data_svc.fetch_and_update_attack_data()
+        # Attack names and inactive flags are part of each report's cached sentence hits
+        if added_attacks or inactive_attacks or name_changes:
+            self.report_hit_index.clear()
+            self.report_changed()
         # If new attacks were added...
         if added_attacks:
             updates = True
@@ -149,9 +247,15 @@ class RestService:
         token = token or PUBLIC
         # Set up empty list if queue-map doesn't already have one
         if token not in self.queue_map:
-            self.queue_map[token] = []
+            self.queue_map[token] = UserQueue()
         return self.queue_map[token]
 
+    def queue_sizes(self):
+        """Function to return the number of queued reports for each user, with user tokens replaced by a short hash
+        (salted per process so these can be shown without revealing the tokens)."""
+        return {token if token == PUBLIC else hashlib.sha256(self.queue_salt + token.encode('utf-8')).hexdigest()[:12]:
+                len(queue) for token, queue in self.queue_map.items()}
+
     def remove_report_from_queue_map(self, report):
         """Function to remove given report from internal queue-map."""
         queue = self.get_queue_for_user(token=report.get('token'))
@@ -240,11 +344,13 @@ class RestService:
             self.add_report_expiry(data=update_data, days=1)
             await self.dao.update('reports', where=dict(uid=report_id), data=update_data)
             self.seen_report_status[report_id] = new_status
+            self.report_changed(report_id)
+            self.data_svc.invalidate_report_listings(r_status, new_status)
             # Before finishing, do any post-complete tasks if necessary
             if not self.is_local:
                 report_data = await self.data_svc.export_report_data(report_id=report_id)
                 await self.web_svc.on_report_complete(request, report_data)
-            return REST_SUCCESS
+            return dict(REST_SUCCESS, delta=dict(current_status=new_status))
         else:
             return default_error
 
@@ -262,7 +368,10 @@ class RestService:
             return default_error
         # Proceed with delete
         await self.dao.delete('reports', dict(uid=report_id))
-        return REST_SUCCESS
+        self.report_deleted(report_id)
+        self.data_svc.invalidate_report_listings(r_status)
+        # Return which status-column the report was in so the page can remove it without reloading
+        return dict(REST_SUCCESS, delta=dict(report_status=r_status))
 
     async def remove_sentence(self, request, criteria=None):
         default_error = dict(error='Error removing item.')
@@ -275,6 +384,8 @@ class RestService:
         await self.dao.delete('report_sentences', dict(uid=sen_id))
         # This could also be an image, so delete from original_html table too
         await self.dao.delete('original_html', dict(uid=sen_id))
+        self.report_hit_index.pop(report_id)
+        self.report_changed(report_id)
         # As a report has been edited, ensure the report's status reflects analysis has started
         await self.check_report_status(report_id=report_id, update_if_false=True)
         return REST_SUCCESS
@@ -308,6 +419,7 @@ class RestService:
                 'report_categories', dict(report_uid=report_id, category_keyname=category), return_sql=True))
         await self.dao.run_sql_list(sql_list=sql_list)
         if sql_list:
+            self.report_changed(report_id)
             success.update(dict(info='The report categories have been updated.', alert_user=1))
         return success
 
@@ -413,6 +525,7 @@ class RestService:
                         sql_list.append(await self.dao.delete(table_name, temp, return_sql=True))
         await self.dao.run_sql_list(sql_list=sql_list)
         if sql_list:
+            self.report_changed(report_id)
             success.update(dict(info='The report aggressors and victims have been updated.', alert_user=1))
         return success
 
@@ -491,7 +604,12 @@ class RestService:
                     # issues when they are later confirmed and have old/different date ranges
                     sql_list.append(await self.dao.update('report_sentence_hits', where=dict(report_uid=report_id),
                                                           data=techs_update_data, return_sql=True))
+                    # Every confirmed technique's dates may have changed: have the page reload the report's hits
+                    success['delta'] = dict(sentences_changed=True)
             await self.dao.run_sql_list(sql_list=sql_list)
+            self.report_changed(report_id)
+            if success.get('delta'):
+                self.report_hit_index.pop(report_id)
         if not success.get('info'):  # the success response hasn't already been updated with info
             success.update(dict(info='The report dates have been updated.', alert_user=1))
         return success
@@ -511,33 +629,91 @@ class RestService:
         await self.dao.update('reports', where=dict(uid=report_id), data=dict(current_status='HIDDEN'))
         # Execute the rollback
         success = await self.data_svc.rollback_report(report_id=report_id)
+        self.report_hit_index.pop(report_id)
+        self.report_changed(report_id)
         if success:
             # Finish by setting the status to 'Needs Review' and removing error (if error was added previously)
             await self.dao.update(
                 'reports', where=dict(uid=report_id),
                 data=dict(current_status=ReportStatus.NEEDS_REVIEW.value, error=self.dao.db_false_val))
             self.seen_report_status[report_id] = ReportStatus.NEEDS_REVIEW.value
-            return REST_SUCCESS
+            self.data_svc.invalidate_report_listings(r_status, ReportStatus.NEEDS_REVIEW.value)
+            return dict(REST_SUCCESS, delta=dict(report_status=r_status, new_status=ReportStatus.NEEDS_REVIEW.value))
         else:
             # If unsuccessful: log this, change report status back to what it was and add error flag
             logging.error('Report %s failed to rollback.' % report_id)
             await self.dao.update('reports', where=dict(uid=report_id),
                                   data=dict(current_status=r_status, error=self.dao.db_true_val))
+            self.data_svc.invalidate_report_listings(r_status)
             return default_error
 
     async def sentence_context(self, request, criteria=None):
-        sen_id = await self.check_and_get_sentence_id(request, request_data=criteria)
-        ioc = await self.dao.get('report_sentence_indicators_of_compromise', dict(sentence_id=sen_id))
-        ioc = '' if not ioc else ioc[0]['refanged_sentence_text']
-        techniques = await self.data_svc.get_active_sentence_hits(sentence_id=sen_id)
-        return dict(techniques=techniques, ioc=ioc)
+        sen_id, report_id = await self.check_and_get_sentence_id(request, request_data=criteria, with_report_id=True)
+        sentence_hits = (await self.get_report_hit_index(report_id)).get(sen_id, dict())
+        return dict(techniques=sentence_hits.get('techniques', []), ioc=sentence_hits.get('ioc', ''))
 
     async def confirmed_attacks(self, request, criteria=None):
-        sen_id = await self.check_and_get_sentence_id(request, request_data=criteria)
-        return await self.data_svc.get_confirmed_attacks_for_sentence(sentence_id=sen_id)
+        sen_id, report_id = await self.check_and_get_sentence_id(request, request_data=criteria, with_report_id=True)
+        return (await self.get_report_hit_index(report_id)).get(sen_id, dict()).get('confirmed', [])
 
-    async def check_and_get_sentence_id(self, request, request_data=None):
-        """Function to verify request data contains a valid sentence ID and return it."""
+    async def sentence_index(self, request, criteria=None):
+        """Function to return the active hits, confirmed hits and IoC text of each sentence in a report."""
+        report, error = await self._report_pre_check(request, criteria, 'get-sentence', [UID], None)
+        if error:
+            return dict(error='Error retrieving report sentences.')
+        return dict(sentences=await self.get_report_hit_index(report[UID]))
+
+    async def get_report_hit_index(self, report_id):
+        """Function to return a report's sentence hits, querying the database only if they are not cached."""
+        hit_index = self.report_hit_index.get(report_id)
+        if hit_index is None:
+            hit_index = await self.data_svc.get_report_hit_index(report_id)
+            self.report_hit_index.set(report_id, hit_index)
+        return hit_index
+
+    def report_revision(self, report_id):
+        """Function to return a report's current revision. Revisions are only kept in this process (edits made by
+        another process are not seen) so anything cached by revision, e.g. exports, is only valid for one process."""
+        return self.report_revisions.get(report_id, self.base_revision)
+
+    def report_changed(self, report_id=None):
+        """Function to bump a report's revision after it has been edited (or every report's if no report is given)."""
+        # Revisions are never reused so an old revision cannot match a report's current one
+        self._last_revision += 1
+        if report_id is None:
+            self.report_revisions.clear()
+            self.base_revision = self._last_revision
+        else:
+            self.report_revisions[report_id] = self._last_revision
+
+    def report_deleted(self, report_id):
+        """Function to forget what is kept about a deleted report (its revision and cached sentence hits)."""
+        self.report_revisions.pop(report_id, None)
+        self.report_hit_index.pop(report_id)
+
+    async def remove_expired_reports(self):
+        """Function to delete expired reports (and forget their revisions)."""
+        for report_id in await self.data_svc.remove_expired_reports():
+            self.report_deleted(report_id)
+
+    async def refresh_indexed_sentence(self, report_id, sen_id):
+        """Function to re-query a sentence's hits, updating them in the report's cached sentence hits (if cached)."""
+        sentence_hits = await self.data_svc.get_sentence_hits(sen_id)
+        hit_index = self.report_hit_index.get(report_id, count=False)
+        if hit_index is not None:
+            # Patch this sentence's entry rather than dropping (and later re-querying) the whole report's hits
+            hit_index[sen_id] = dict(hit_index.get(sen_id, dict(ioc='')), **sentence_hits)
+        return sentence_hits
+
+    async def _sentence_delta(self, report_id, sen_id):
+        """Function to return a success response with what changed for a sentence so the page can update in place."""
+        sentence_hits = await self.refresh_indexed_sentence(report_id, sen_id)
+        unchecked = await self.data_svc.get_unconfirmed_undated_attack_count(report_id=report_id)
+        return dict(REST_SUCCESS, delta=dict(sentence_id=sen_id, sentence=sentence_hits, unchecked=unchecked,
+                                             found_status=bool(sentence_hits['techniques'])))
+
+    async def check_and_get_sentence_id(self, request, request_data=None, with_report_id=False):
+        """Function to verify request data contains a valid sentence ID and return it (and its report ID if set)."""
         try:
             # Check for malformed request parameters (KeyError) or request_data being None (TypeError)
             sen_id = request_data['sentence_id']
@@ -547,11 +723,10 @@ class RestService:
         if not report_id:
             raise web.HTTPBadRequest()
         # No further checks if local
-        if self.is_local:
-            return sen_id
-        # Check permissions
-        await self.check_report_permission(request, report_id=report_id, action='get-sentence')
-        return sen_id
+        if not self.is_local:
+            # Check permissions
+            await self.check_report_permission(request, report_id=report_id, action='get-sentence')
+        return (sen_id, report_id) if with_report_id else sen_id
 
     async def insert_report(self, request, criteria=None):
         # Check for errors whilst updating request data with token (if applicable)
@@ -581,7 +756,42 @@ class RestService:
             df = self.verify_csv(criteria['file'])
         except (TypeError, ValueError) as e:  # Any errors occurring from the csv-checks
             return dict(error=str(e), alert_user=1)
-        return await self._insert_batch_reports(request, df, df.shape[0], token=criteria.get('token'))
+        # Checks needing the request are done now: the rest of the batch is processed after the response is sent
+        prepared = await self._prepare_batch_reports(request, df, df.shape[0], token=criteria.get('token'))
+        if prepared.get('error'):
+            return prepared
+        # Process the batch in the background and return a job ID for the client to check the outcome with
+        job_id = str(uuid.uuid4())
+        self.batch_jobs.set(job_id, None)
+        # Keep a reference to the task so it is not garbage-collected before it finishes
+        task = asyncio.create_task(self._run_batch_job(job_id, prepared, df.shape[0], token=criteria.get('token')))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+        return dict(success=1, job_id=job_id)
+
+    async def _run_batch_job(self, job_id, prepared, row_count, token=None):
+        """Function to queue a prepared batch of reports and save the outcome against the batch's job ID."""
+        try:
+            result = await self._queue_batch_reports(prepared, row_count, token=token)
+        except Exception as e:
+            logging.error('Batch submission failed: ' + str(e))
+            result = dict(error='Error inserting report(s).')
+        self.batch_jobs.set(job_id, result)
+
+    async def batch_job_status(self, request, criteria=None):
+        """Function to return the outcome of a batch submission (or that it is still pending)."""
+        try:
+            job_id = criteria['job_id']
+        except (KeyError, TypeError):
+            return dict(error='Error retrieving submission status.')
+        # Job IDs are random UUIDs only known by the submitter so these act as the permission for this request
+        if job_id not in self.batch_jobs:
+            return dict(error='This submission could not be found; please refresh the page.', alert_user=1)
+        result = self.batch_jobs.get(job_id)
+        if result is None:
+            return dict(pending=1)
+        self.batch_jobs.pop(job_id)
+        return result
 
     async def pre_insert_add_token(self, request, request_data=None, key=None):
         """Function to check sent request data before inserting reports and return an error if there was an issue."""
@@ -614,18 +824,43 @@ class RestService:
         else:
             request_data.update(token=None)
 
+    async def _check_batch_url_allowed(self, request, url, semaphore):
+        """Function to check a URL is allowed to be submitted and return an error message if it is not."""
+        async with semaphore:
+            try:
+                await self.web_svc.url_allowed(request, url)
+            # Raised if url_allowed() fails
+            except ValueError as ve:
+                return str(ve)
+
+    async def _verify_batch_url(self, url, document, semaphore):
+        """Function to verify a URL (whilst downloading its document) and return an error message if it failed."""
+        async with semaphore:
+            try:
+                # Whether the URL is allowed was checked whilst the batch was prepared
+                await self.web_svc.verify_url(None, url=url, document=document, check_allowed=False)
+            # Raised if verify_url() fails
+            except ValueError as ve:
+                return str(ve)
+
     async def _insert_batch_reports(self, request, batch, row_count, token=None):
-        # Possible responses to the request
-        default_error, success = dict(error='Error inserting report(s).'), REST_SUCCESS.copy()
+        """Function to insert a batch of reports into the queue."""
+        prepared = await self._prepare_batch_reports(request, batch, row_count, token=token)
+        if prepared.get('error'):
+            return prepared
+        return await self._queue_batch_reports(prepared, row_count, token=token)
+
+    async def _prepare_batch_reports(self, request, batch, row_count, token=None):
+        """Function to return the rows of a batch which can be queued (and the number skipped for each reason). The
+        checks not needing a request are done first so only the rows which can still be queued are checked further."""
+        default_error = dict(error='Error inserting report(s).')
         # Different counts for different reasons why reports are not queued
-        limit_exceeded, duplicate_urls, malformed_urls, long_titles, long_urls = 0, 0, 0, 0, 0
+        skipped = dict(limit_exceeded=0, duplicate_urls=0, malformed_urls=0, long_titles=0, long_urls=0)
         # Get the relevant queue for this user
         queue = self.get_queue_for_user(token=token)
+        # Canonical URLs of rows from this batch (so duplicates within the batch are also caught)
+        rows, batch_keys = [], set()
         for row in range(row_count):
-            # If a new report will exceed the queue limit, stop iterating through further reports
-            if self.QUEUE_LIMIT and len(queue) + 1 > self.QUEUE_LIMIT:
-                limit_exceeded = row_count - row
-                break
             try:
                 title, url = batch['title'][row].strip(), batch[URL][row].strip()
                 automatically_generated = batch['automatically_generated'][row] \
@@ -633,63 +868,113 @@ class RestService:
             # Check for malformed request parameters; AttributeError thrown if not strings
             except (AttributeError, KeyError):
                 return default_error
-            try:
-                # Enforce http on urls that do not begin with http(s)
-                prefix_check = re.match('^https?://', url, re.IGNORECASE)
-                url = 'http://' + url if prefix_check is None else url
-                # Drop fragments
-                if '#' in url:
-                    url = url[:url.index('#')]
-                await self.web_svc.verify_url(request, url=url)
-            # Raised if verify_url() fails
-            except ValueError as ve:
-                return dict(error=str(ve), alert_user=1)
-            # Ensure the report has a unique title
-            title = await self.data_svc.get_unique_title(title)
-            # Set up a temporary dictionary to represent db object
-            temp_dict = dict(
-                title=title,
-                url=url,
-                current_status=ReportStatus.QUEUE.value,
-                automatically_generated=automatically_generated,
-                token=token
-            )
-            self.add_report_expiry(data=temp_dict, weeks=1)
-            # Are we skipping this report?
-            skip_report = False
-            if len(title) > 200:
-                long_titles += 1
-                skip_report = True
+            # Enforce http on urls that do not begin with http(s)
+            prefix_check = re.match('^https?://', url, re.IGNORECASE)
+            url = 'http://' + url if prefix_check is None else url
+            # Drop fragments
+            if '#' in url:
+                url = url[:url.index('#')]
             if len(url) > 500:
-                long_urls += 1
-                skip_report = True
-            if not skip_report:
-                # Before adding to the db, check that this submitted URL isn't already in the queue; if so, skip it
-                for queued_url in queue:
-                    try:
-                        if self.web_svc.urls_match(testing_url=url, matches_with=queued_url):
-                            skip_report = True
-                            duplicate_urls += 1
-                            break
-                    except ValueError:
-                        skip_report = True
-                        malformed_urls += 1
-                        break
-            # Proceed to add to queue if report is not being skipped
-            if not skip_report:
-                # Insert report into db and update temp_dict with inserted ID from db
-                temp_dict[UID] = await self.dao.insert_generate_uid('reports', temp_dict)
+                skipped['long_urls'] += 1
+                continue
+            # Titles are only made longer when made unique so a title already too long can be skipped now
+            if len(title) > 200:
+                skipped['long_titles'] += 1
+                continue
+            # Before downloading anything, check that this submitted URL isn't already in the queue; if so, skip it
+            try:
+                url_keys = self.web_svc.get_url_keys(url)
+            except ValueError:
+                skipped['malformed_urls'] += 1
+                continue
+            if queue.contains_any(url_keys) or not batch_keys.isdisjoint(url_keys):
+                skipped['duplicate_urls'] += 1
+                continue
+            # If a new report will exceed the queue limit, don't queue it
+            if self.QUEUE_LIMIT and len(queue) + len(rows) + 1 > self.QUEUE_LIMIT:
+                skipped['limit_exceeded'] += 1
+                continue
+            batch_keys.update(url_keys)
+            rows.append(dict(title=title, url=url, automatically_generated=automatically_generated))
+        # Check the URLs are allowed (bounded so a large batch does not flood the app's URL-checker)
+        semaphore = asyncio.Semaphore(self.VALIDATION_CONCURRENCY)
+        url_errors = await asyncio.gather(*[self._check_batch_url_allowed(request, r[URL], semaphore) for r in rows])
+        for url_error in url_errors:
+            if url_error:
+                return dict(error=url_error, alert_user=1)
+        return dict(rows=rows, skipped=skipped)
+
+    async def _queue_batch_reports(self, prepared, row_count, token=None):
+        """Function to download and verify the prepared rows of a batch and then insert and queue these."""
+        # Possible responses to the request
+        default_error, success = dict(error='Error inserting report(s).'), REST_SUCCESS.copy()
+        rows, skipped = prepared['rows'], prepared['skipped']
+        queue = self.get_queue_for_user(token=token)
+        for r in rows:
+            # The page is downloaded once (when verified) and its document is kept with the queued report for analysis
+            r[DOCUMENT] = self.web_svc.get_document(r[URL])
+        # Verify the URLs concurrently (bounded so a large batch does not flood the network)
+        semaphore = asyncio.Semaphore(self.VALIDATION_CONCURRENCY)
+        url_errors = await asyncio.gather(*[self._verify_batch_url(r[URL], r[DOCUMENT], semaphore) for r in rows])
+        candidates, batch_keys = [], set()
+        for r, url_error in zip(rows, url_errors):
+            if url_error:
+                return dict(error=url_error, alert_user=1)
+            # Check again now where each URL redirects to is known (or whilst verifying, another batch queued it)
+            try:
+                r['url_keys'] = self.web_svc.get_url_keys(r[URL], document=r[DOCUMENT])
+            except ValueError:
+                skipped['malformed_urls'] += 1
+                continue
+            if queue.contains_any(r['url_keys']) or not batch_keys.isdisjoint(r['url_keys']):
+                skipped['duplicate_urls'] += 1
+                continue
+            batch_keys.update(r['url_keys'])
+            candidates.append(r)
+        # Titles are allocated and inserted under a lock so concurrent batches cannot be given the same title
+        async with self.title_lock:
+            # Ensure the reports have unique titles (resolved for the whole batch at once)
+            allocated_titles = await self.data_svc.allocate_titles([r[TITLE] for r in candidates])
+            accepted, sql_list = [], []
+            for r, allocated in zip(candidates, allocated_titles):
+                title = allocated[TITLE]
+                # If a new report will exceed the queue limit (e.g. other reports were queued since), don't queue it
+                if self.QUEUE_LIMIT and len(queue) + len(accepted) + 1 > self.QUEUE_LIMIT:
+                    skipped['limit_exceeded'] += 1
+                    continue
+                if len(title) > 200:
+                    skipped['long_titles'] += 1
+                    continue
+                # Set up a temporary dictionary to represent db object
+                temp_dict = dict(
+                    title=title,
+                    url=r[URL],
+                    current_status=ReportStatus.QUEUE.value,
+                    automatically_generated=r['automatically_generated'],
+                    token=token,
+                    base_title=allocated['base_title'],
+                    title_suffix=allocated['title_suffix']
+                )
+                self.add_report_expiry(data=temp_dict, weeks=1)
+                # Build the insert-statement (which sets the report's ID in temp_dict)
+                sql_list.append(await self.dao.insert_generate_uid('reports', temp_dict, return_sql=True))
+                accepted.append((temp_dict, r))
+            # Insert all accepted reports into the db in one transaction
+            if sql_list and not await self.dao.run_sql_list(sql_list=sql_list):
+                return default_error
+            self.data_svc.invalidate_report_listings(ReportStatus.QUEUE.value)
+            for temp_dict, r in accepted:
+                temp_dict[DOCUMENT] = r[DOCUMENT]
                 # Finally, update queue and check queue when batch is finished
                 await self.queue.put(temp_dict)
-                queue.append(url)
-        if limit_exceeded or duplicate_urls or malformed_urls or long_titles or long_urls:
-            total_skipped = sum([limit_exceeded, duplicate_urls, malformed_urls, long_titles, long_urls])
-            message = '%s of %s ' % (total_skipped, row_count) + 'report(s) not added to the queue.' + \
-                      '\n- %s exceeded queue limit.' % limit_exceeded + \
-                      '\n- %s already in the queue/duplicate URL(s).' % duplicate_urls + \
-                      '\n- %s malformed URL(s).' % malformed_urls + \
-                      '\n- %s report-title(s) exceeded 200-character limit.' % long_titles + \
-                      '\n- %s URL(s) exceeded 500-character limit.' % long_urls
+                queue.append(r[URL], keys=r['url_keys'])
+        if any(skipped.values()):
+            message = '%s of %s ' % (sum(skipped.values()), row_count) + 'report(s) not added to the queue.' + \
+                      '\n- %s exceeded queue limit.' % skipped['limit_exceeded'] + \
+                      '\n- %s already in the queue/duplicate URL(s).' % skipped['duplicate_urls'] + \
+                      '\n- %s malformed URL(s).' % skipped['malformed_urls'] + \
+                      '\n- %s report-title(s) exceeded 200-character limit.' % skipped['long_titles'] + \
+                      '\n- %s URL(s) exceeded 500-character limit.' % skipped['long_urls']
             success.update(dict(info=message, alert_user=1))
         asyncio.create_task(self.check_queue())
         return success
@@ -697,6 +982,7 @@ class RestService:
     @staticmethod
     def verify_csv(file_param):
         """Function to return a dataframe from csv-like text."""
+        import pandas as pd
         # Check if the text can be converted into a file and then converted into a dataframe (df)
         try:
             file = StringIO(file_param)
@@ -769,40 +1055,83 @@ class RestService:
             asyncio.set_event_loop(loop)
             return loop.run_until_complete(coroutine)
         finally:
+            # Close any URL-fetching session opened on this loop before closing the loop itself
+            loop.run_until_complete(self.web_svc.close_url_sessions())
             loop.close()
 
     async def error_report(self, report):
         """Function to error a given report."""
         report_id = report[UID]
+        ANALYSED_REPORTS.inc(outcome='error')
         await self.dao.update('reports', where=dict(uid=report_id), data=dict(error=self.dao.db_true_val))
+        self.data_svc.invalidate_report_listings(ReportStatus.QUEUE.value)
         self.remove_report_from_queue_map(report)
         await self.remove_report_if_automatically_generated(report_id)
 
     async def start_analysis(self, criteria=None):
         report_id = criteria[UID]
         logging.info('Beginning analysis for ' + report_id)
+        trace = AnalysisTrace(report_id, stage_histogram=ANALYSIS_STAGE_SECONDS)
+        # If profiling slow analyses, sample this (the analysing) thread and keep the profile if the analysis is slow
+        profiler = SamplingProfiler() if self.SLOW_ANALYSIS_SECONDS else None
+        if profiler:
+            profiler.start()
+        try:
+            await self.analyse_report(criteria, trace)
+        finally:
+            seconds = trace.elapsed()
+            trace.log(logging.INFO, 'Analysis trace', total='%.3fs' % seconds, stages='"%s"' % trace.summary())
+            if profiler:
+                profiler.stop()
+                if seconds >= self.SLOW_ANALYSIS_SECONDS:
+                    self.save_analysis_profile(profiler, trace, criteria[URL], seconds)
+
+    def save_analysis_profile(self, profiler, trace, url, seconds):
+        """Function to save the profile of a slow analysis (to study its report after the fact)."""
+        header = ['Profile of analysing report %s (%s): %.3fs' % (trace.report_id, url, seconds),
+                  'Stages: %s' % trace.summary()]
+        try:
+            path = profiler.save(self.profile_dir, trace.report_id, header_lines=header)
+        except OSError as e:
+            trace.log(logging.ERROR, 'Could not save analysis profile', error='"%s"' % e)
+            return
+        trace.log(logging.WARNING, 'Slow analysis profiled', seconds='%.3f' % seconds, profile=path)
 
-        original_html, newspaper_article = await self.web_svc.map_all_html(criteria[URL],
-                                                                           sentence_limit=self.SENTENCE_LIMIT)
+    async def analyse_report(self, criteria, trace):
+        """Function to analyse a queued report, timing each stage with the given AnalysisTrace."""
+        report_id = criteria[UID]
+        with trace.span('map_all_html'):
+            # Use the document downloaded on submission (reports queued from a previous session download it here)
+            document = criteria.get(DOCUMENT) or self.web_svc.get_document(criteria[URL])
+            original_html, newspaper_article = await self.web_svc.map_all_html(criteria[URL], document=document,
+                                                                               sentence_limit=self.SENTENCE_LIMIT,
+                                                                               trace=trace)
         if original_html is None and newspaper_article is None:
-            logging.error('Skipping report; could not download url ' + criteria[URL])
+            trace.log(logging.ERROR, 'Skipping report; could not download url', url=criteria[URL])
             await self.error_report(criteria)
             return
 
         html_data = newspaper_article.text.replace('\n', '<br>')
         article = dict(title=criteria[TITLE], html_text=html_data)
-        # Obtain the article date if possible
+        # Obtain the article date if possible (from the downloaded page rather than downloading it again)
         article_date = None
-        with suppress(ValueError):
-            article_date = find_date(criteria[URL])
+        if document.text:
+            with trace.span('find_date'):
+                from htmldate import find_date
+                with suppress(ValueError):
+                    article_date = find_date(document.text, url=criteria[URL])
+        # The page's body is no longer needed
+        document.release()
         # Check any obtained date is a sensible value to store in the database
         with suppress(TypeError, ValueError):
             self.check_input_date(article_date)
 
-        # Here we build the sentence dictionary
-        html_sentences = self.web_svc.tokenize_sentence(article['html_text'], sentence_limit=self.SENTENCE_LIMIT)
+        # Here we build the sentence dictionary (the nltk packs are checked once, after the app has started)
+        with trace.span('tokenize'):
+            await self.ml_svc.check_nltk_packs()
+            html_sentences = self.web_svc.tokenize_sentence(article['html_text'], sentence_limit=self.SENTENCE_LIMIT)
         if not html_sentences:
-            logging.error('Skipping report; could not retrieve sentences from url ' + criteria[URL])
+            trace.log(logging.ERROR, 'Skipping report; could not retrieve sentences from url', url=criteria[URL])
             await self.error_report(criteria)
             return
 
@@ -810,32 +1139,37 @@ class RestService:
         await self.dao.insert_generate_uid('report_sentence_queue_progress',
                                            dict(report_uid=report_id, sentence_count=len(html_sentences)))
 
-        rebuilt, model_dict = await self.ml_svc.build_pickle_file(self.list_of_techs, self.json_tech)
+        with trace.span('load_models'):
+            rebuilt, model_dict = await self.ml_svc.build_pickle_file(self.list_of_techs, self.json_tech)
 
-        ml_analyzed_html = await self.ml_svc.analyze_html(self.list_of_techs, model_dict, html_sentences)
-        regex_patterns = await self.dao.get('regex_patterns')
-        reg_analyzed_html = self.reg_svc.analyze_html(regex_patterns, html_sentences)
+        with trace.span('ml_analysis'):
+            ml_analyzed_html = await self.ml_svc.analyze_html(self.list_of_techs, model_dict, html_sentences)
+        with trace.span('regex_analysis'):
+            regex_patterns = await self.dao.get('regex_patterns')
+            reg_analyzed_html = self.reg_svc.analyze_html(regex_patterns, html_sentences)
 
         # Merge ML and Reg hits
         analyzed_html = await self.ml_svc.combine_ml_reg(ml_analyzed_html, reg_analyzed_html)
 
-        for s_idx, sentence in enumerate(analyzed_html):
-            sentence['text'] = self.dao.truncate_str(sentence['text'], 800)
-            sentence['html'] = self.dao.truncate_str(sentence['html'], 900)
-            if sentence['ml_techniques_found']:
-                await self.ml_svc.ml_techniques_found(report_id, sentence, s_idx, tech_start_date=article_date)
-            elif sentence['reg_techniques_found']:
-                await self.reg_svc.reg_techniques_found(report_id, sentence, s_idx, tech_start_date=article_date)
-            else:
-                data = dict(report_uid=report_id, text=sentence['text'], html=sentence['html'], sen_index=s_idx,
-                            found_status=self.dao.db_false_val)
-                await self.dao.insert_with_backup('report_sentences', data)
-
-        for e_idx, element in enumerate(original_html):
-            element['text'] = self.dao.truncate_str(element['text'], 800)
-            html_element = dict(report_uid=report_id, text=element['text'], tag=element['tag'], elem_index=e_idx,
+        with trace.span('save_sentences', sentences=len(analyzed_html)):
+            for s_idx, sentence in enumerate(analyzed_html):
+                sentence['text'] = self.dao.truncate_str(sentence['text'], 800)
+                sentence['html'] = self.dao.truncate_str(sentence['html'], 900)
+                if sentence['ml_techniques_found']:
+                    await self.ml_svc.ml_techniques_found(report_id, sentence, s_idx, tech_start_date=article_date)
+                elif sentence['reg_techniques_found']:
+                    await self.reg_svc.reg_techniques_found(report_id, sentence, s_idx, tech_start_date=article_date)
+                else:
+                    data = dict(report_uid=report_id, text=sentence['text'], html=sentence['html'], sen_index=s_idx,
                                 found_status=self.dao.db_false_val)
-            await self.dao.insert_with_backup('original_html', html_element)
+                    await self.dao.insert_with_backup('report_sentences', data)
+
+        with trace.span('save_html', elements=len(original_html)):
+            for e_idx, element in enumerate(original_html):
+                element['text'] = self.dao.truncate_str(element['text'], 800)
+                html_element = dict(report_uid=report_id, text=element['text'], tag=element['tag'], elem_index=e_idx,
+                                    found_status=self.dao.db_false_val)
+                await self.dao.insert_with_backup('original_html', html_element)
 
         # The report is about to be moved out of the queue
         update_data = dict(current_status=ReportStatus.NEEDS_REVIEW.value)
@@ -846,9 +1180,16 @@ class RestService:
         self.add_report_expiry(data=update_data, weeks=1)
         # Update card to reflect the end of queue
         await self.dao.update('reports', where=dict(uid=report_id), data=update_data)
+        self.data_svc.invalidate_report_listings(ReportStatus.QUEUE.value, ReportStatus.NEEDS_REVIEW.value)
         # Update the relevant queue for this user
         self.remove_report_from_queue_map(criteria)
         logging.info('Finished analysing report ' + report_id)
+        seconds = trace.elapsed()
+        ANALYSIS_SECONDS.observe(seconds)
+        ANALYSED_REPORTS.inc(outcome='analysed')
+        ANALYSED_SENTENCES.inc(len(analyzed_html))
+        if seconds:
+            SENTENCES_PER_SECOND.set(round(len(analyzed_html) / seconds, 3))
         # DB tidy-up including removing report if low quality
         await self.dao.delete('report_sentence_queue_progress', dict(report_uid=report_id))
         await self.remove_report_if_low_quality(report_id)
@@ -868,6 +1209,7 @@ class RestService:
         # Remove report if amount of unique techniques found doesn't reach the minimum
         if unique_techniques_count < REPORT_TECHNIQUES_MINIMUM:
             await self.data_svc.remove_report_by_id(report_id=report_id)
+            self.report_deleted(report_id)
             logging.info('Deleted report with ' + str(unique_techniques_count) + ' technique(s) found: ' + report[URL])
             return
 
@@ -884,6 +1226,7 @@ class RestService:
             return
 
         await self.data_svc.remove_report_by_id(report_id=report_id)
+        self.report_deleted(report_id)
         logging.info('Deleted skipped report: ' + report[URL])
 
     async def add_attack(self, request, criteria=None):
@@ -959,10 +1302,11 @@ class RestService:
                 data=dict(found_status=self.dao.db_true_val), return_sql=True))
         # Run the updates, deletions and insertions for this method altogether
         await self.dao.run_sql_list(sql_list=sql_commands)
+        self.report_changed(sentence_dict[0]['report_uid'])
         # As a technique has been added, ensure the report's status reflects analysis has started
         await self.check_report_status(report_id=sentence_dict[0]['report_uid'], update_if_false=True)
-        # Return status message
-        return REST_SUCCESS
+        # Return status message with the sentence's updated hits
+        return await self._sentence_delta(sentence_dict[0]['report_uid'], sen_id)
 
     async def reject_attack(self, request, criteria=None):
         try:
@@ -1019,9 +1363,10 @@ class RestService:
                 data=dict(found_status=self.dao.db_false_val), return_sql=True))
         # Run the updates, deletions and insertions for this method altogether
         await self.dao.run_sql_list(sql_list=sql_commands)
+        self.report_changed(sentence_dict[0]['report_uid'])
         # As a technique has been rejected, ensure the report's status reflects analysis has started
         await self.check_report_status(report_id=sentence_dict[0]['report_uid'], update_if_false=True)
-        return REST_SUCCESS
+        return await self._sentence_delta(sentence_dict[0]['report_uid'], sen_id)
 
     async def update_attack_time(self, request, criteria=None):
         default_error, success = dict(error='Error updating technique times.'), REST_SUCCESS.copy()
@@ -1049,6 +1394,7 @@ class RestService:
             return checks
         start_date_conv, end_date_conv = start_dict.get(DATETIME_OBJ), end_dict.get(DATETIME_OBJ)
         updates = []  # what database updates will be carried out
+        updated_sentences = set()  # which sentences have techniques being updated
         for mapping in mapping_list:
             entries = await self.dao.get('report_sentence_hits', dict(uid=mapping))
             # Check if a suitable entry to update or update_data is not already subset of entry (no updates needed)
@@ -1066,11 +1412,12 @@ class RestService:
                 continue
             updates.append(await self.dao.update('report_sentence_hits', where=dict(uid=mapping),
                                                  data=update_data, return_sql=True))
+            updated_sentences.add(entries[0]['sentence_id'])
         # If there are updates, check if the report start/end dates should be updated
         info = '%s of %s technique(s) updated.' % (len(updates), len(mapping_list))
         if len(updates) != len(mapping_list):
             info += ' This could be because of report status; unconfirmed technique(s) and/or existing start/end dates.'
-        report_info, refresh_page = '', False
+        report_info, delta = '', dict(sentences=dict())
         if updates:
             r_update_data = dict()
             if start_date_conv and r_start_date and (start_date_conv < r_start_date.replace(tzinfo=None)):
@@ -1081,11 +1428,15 @@ class RestService:
                 updates.append(await self.dao.update('reports', where=dict(uid=report_id),
                                                      data=r_update_data, return_sql=True))
                 report_info = ' Report start/end dates have also been updated.'
-                refresh_page = True
+                delta['report_dates'] = r_update_data
             await self.dao.run_sql_list(sql_list=updates)
+            self.report_changed(report_id)
+            # Send back the updated techniques of the affected sentences rather than have the page reload them
+            for sen_id in updated_sentences:
+                delta['sentences'][sen_id] = await self.refresh_indexed_sentence(report_id, sen_id)
         current_info = success.pop('info', '')
         info += report_info + (('\n\n' + current_info) if current_info else '')
-        success.update(dict(info=info, alert_user=1, refresh_page=refresh_page, updated_attacks=bool(updates)))
+        success.update(dict(info=info, alert_user=1, delta=delta))
         return success
 
     def __refang(self, ioc_text):
@@ -1202,6 +1553,8 @@ class RestService:
 
         if deleting:
             await self.dao.delete(table, db_query)
+            self.report_hit_index.pop(report_id)
+            self.report_changed(report_id)
             success.update(dict(info='The selected sentence is no longer flagged as an IoC.', alert_user=1))
             return success
 
@@ -1221,9 +1574,13 @@ class RestService:
             if existing[0]['refanged_sentence_text'] == text:
                 return REST_IGNORED
             await self.dao.update(table, where=db_query, data=dict(refanged_sentence_text=text))
+            self.report_hit_index.pop(report_id)
+            self.report_changed(report_id)
             success.update(dict(info='This sentence-IoC text has been updated.', alert_user=1))
         else:
             await self.dao.insert_generate_uid(table, dict(**db_query, refanged_sentence_text=text))
+            self.report_hit_index.pop(report_id)
+            self.report_changed(report_id)
             success.update(dict(info='The selected sentence has been flagged as an IoC.', alert_user=1))
         return success
 
@@ -1354,6 +1711,8 @@ class RestService:
             # Update the report status in the db and the dictionary variable for future checks
             await self.dao.update('reports', where=dict(uid=report_id), data=dict(current_status=status))
             self.seen_report_status[report_id] = status
+            self.report_changed(report_id)
+            self.data_svc.invalidate_report_listings(db_status, status)
             return True
         else:
             return False  # Report status does not match and we are not updating the db
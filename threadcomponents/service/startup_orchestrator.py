@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+
+from threadcomponents.service.startup_profiler import StartupProfiler
+
+# The states a startup step can be in
+PENDING, RUNNING, DONE, FAILED, SKIPPED = 'pending', 'running', 'done', 'failed', 'skipped'
+FINISHED_STATES = {DONE, FAILED, SKIPPED}
+
+
+class StartupOrchestrator:
+    """A class to run startup steps concurrently, each one starting once the steps it depends on have finished."""
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler or StartupProfiler()
+        # Step name -> dict(func=..., after=[...], needed_for_ready=bool, state=..., seconds=...)
+        self.steps = dict()
+        self._tasks = dict()
+        # The task running the steps if these are run in the background (kept so it is not garbage-collected)
+        self.task = None
+        self._ready = asyncio.Event()
+        self.ready = False
+
+    def add_step(self, name, func, after=None, needed_for_ready=True):
+        """Function to add a startup step: an async function to run after the (already added) steps in `after`."""
+        if name in self.steps:
+            raise ValueError('Startup step %s has already been added' % name)
+        # Requiring dependencies to be added first means there cannot be a cycle
+        after = [dependency for dependency in (after or []) if dependency]
+        unknown = [dependency for dependency in after if dependency not in self.steps]
+        if unknown:
+            raise ValueError('Startup step %s depends on unknown step(s): %s' % (name, ', '.join(unknown)))
+        self.steps[name] = dict(func=func, after=after, needed_for_ready=needed_for_ready, state=PENDING,
+                                seconds=None)
+        return name
+
+    async def _run_step(self, name):
+        step = self.steps[name]
+        # Wait for the steps this one depends on; if any of them did not complete, this step cannot run
+        if step['after']:
+            await asyncio.gather(*(self._tasks[dependency] for dependency in step['after']))
+        if any(self.steps[dependency]['state'] != DONE for dependency in step['after']):
+            step['state'] = SKIPPED
+            logging.error('Startup step %s skipped as a step it depends on did not complete' % name)
+            self._check_ready()
+            return
+        step['state'] = RUNNING
+        start = time.perf_counter()
+        try:
+            with self.profiler.step(name):
+                await step['func']()
+        except Exception as e:
+            step['state'] = FAILED
+            logging.exception('Startup step %s failed: %s' % (name, e))
+        else:
+            step['state'] = DONE
+        finally:
+            step['seconds'] = round(time.perf_counter() - start, 3)
+        self._check_ready()
+
+    def _check_ready(self):
+        """Function to flag the app as ready once the steps it needs have finished."""
+        # A failed step does not stop the app being ready (as before, the app serves what it can); it is reported
+        if not self.ready and all(step['state'] in FINISHED_STATES for step in self.steps.values()
+                                  if step['needed_for_ready']):
+            self.ready = True
+            self._ready.set()
+            logging.info('Startup steps needed by the app have finished')
+
+    async def run(self):
+        """Function to run all startup steps, returning once every step has finished."""
+        self._check_ready()
+        self._tasks = {name: asyncio.ensure_future(self._run_step(name)) for name in self.steps}
+        await asyncio.gather(*self._tasks.values())
+        failed = [name for name, step in self.steps.items() if step['state'] != DONE]
+        if failed:
+            logging.critical('Startup step(s) did not complete: %s' % ', '.join(failed))
+        return not failed
+
+    async def wait_until_ready(self):
+        """Function to wait for the steps needed by the app to finish."""
+        await self._ready.wait()
+
+    def status(self):
+        """Function to return the readiness of the app and the state and time taken of each step."""
+        steps = {name: dict(state=step['state'], seconds=step['seconds'], needed_for_ready=step['needed_for_ready'])
+                 for name, step in self.steps.items()}
+        failed = [name for name, step in self.steps.items() if step['state'] in (FAILED, SKIPPED)]
+        return dict(ready=self.ready, failed=failed, steps=steps)
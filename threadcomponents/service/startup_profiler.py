@@ -0,0 +1,48 @@
+import logging
+import sys
+import time
+
+from contextlib import contextmanager
+
+# Libraries which are slow to import and so should not be loaded before the app is listening
+HEAVY_MODULES = ['htmldate', 'newspaper', 'nltk', 'pandas', 'sklearn']
+
+
+class StartupProfiler:
+    """A class to time each startup step and, when enabled, note which modules each step imported."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        # (step name, seconds taken, top-level modules first imported during the step)
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        """Context manager to record how long a startup step takes."""
+        modules_before = set(sys.modules) if self.enabled else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            imported = []
+            if self.enabled:
+                imported = sorted({m.split('.')[0] for m in set(sys.modules) - modules_before})
+            self.steps.append((name, elapsed, imported))
+            logging.debug('Startup step %s took %.3fs' % (name, elapsed))
+
+    def report(self):
+        """Function to log the time taken by each startup step (if profiling is enabled)."""
+        if not self.enabled:
+            return
+        lines = ['Startup profile (%.3fs since start):' % (time.perf_counter() - self.started)]
+        for name, elapsed, imported in self.steps:
+            line = '  %-32s %8.3fs' % (name, elapsed)
+            if imported:
+                line += '  imported: %s' % ', '.join(imported)
+            lines.append(line)
+        loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+        lines.append('  Heavy libraries loaded so far: %s' % (', '.join(loaded) or 'none'))
+        lines.append('  (For per-module import times, run with `python -X importtime main.py --profile-startup`)')
+        logging.info('\n'.join(lines))
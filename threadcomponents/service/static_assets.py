@@ -0,0 +1,98 @@
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+
+from aiohttp import web
+from threadcomponents.service.page_cache import CachedPage
+
+# A hashed URL only ever serves the same content so browsers can keep it
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# File types worth compressing (images and web fonts such as woff/woff2 are already compressed)
+COMPRESSIBLE_EXTENSIONS = {'.css', '.eot', '.js', '.json', '.map', '.svg', '.ttf', '.txt'}
+# The url(...) references in stylesheets
+CSS_URL_REGEX = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def hashed_path(path, version):
+    """Function to return a path with a version added before its extension, e.g. scripts/basics.<version>.js."""
+    root, extension = posixpath.splitext(path)
+    return '%s.%s%s' % (root, version, extension)
+
+
+class StaticAssets:
+    """The files of a static directory, served under content-hashed URLs with pre-compressed bodies."""
+
+    def __init__(self, directory, url_prefix):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        # Path (relative to the directory) -> its hashed path
+        self.hashed_paths = dict()
+        # Path or hashed path -> CachedPage of the file
+        self.assets = dict()
+
+    def build(self):
+        """Function to read, fingerprint and compress every file in the directory."""
+        paths = []
+        for dir_path, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                full_path = os.path.join(dir_path, file_name)
+                paths.append(os.path.relpath(full_path, self.directory).replace(os.sep, '/'))
+        # Stylesheets refer to other files (e.g. fonts): fingerprint those files first to refer to their hashed paths
+        paths.sort(key=lambda asset_path: asset_path.endswith('.css'))
+        for path in paths:
+            with open(os.path.join(self.directory, *path.split('/')), 'rb') as asset_file:
+                body = asset_file.read()
+            if path.endswith('.css'):
+                body = self._rewrite_css_urls(path, body)
+            self._add_asset(path, body)
+        logging.info('Fingerprinted %s static files' % len(paths))
+
+    def _add_asset(self, path, body):
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        is_text = content_type.startswith('text/') or content_type in ('application/javascript', 'application/json')
+        extension = posixpath.splitext(path)[1].lower()
+        asset = CachedPage(body, content_type=content_type, charset='utf-8' if is_text else None,
+                           compress_body=extension in COMPRESSIBLE_EXTENSIONS)
+        self.hashed_paths[path] = hashed_path(path, asset.version)
+        # The original path is still served (e.g. for files referred to by scripts) but has to be revalidated
+        self.assets[path] = asset
+        self.assets[self.hashed_paths[path]] = asset
+
+    def _rewrite_css_urls(self, css_path, body):
+        """Function to point a stylesheet's relative url(...) references to the hashed paths of those files."""
+        css_dir = posixpath.dirname(css_path)
+
+        def replace_url(match):
+            quote, reference = match.group(1), match.group(2).strip()
+            if reference.startswith(('data:', 'http:', 'https:', '//', '#', '/')):
+                return match.group(0)
+            # Keep any query or fragment (e.g. font.eot?#iefix) after the replaced path
+            split_at = min([index for index in (reference.find('?'), reference.find('#')) if index != -1],
+                           default=len(reference))
+            path, suffix = reference[:split_at], reference[split_at:]
+            target = self.hashed_paths.get(posixpath.normpath(posixpath.join(css_dir, path)))
+            if not target:
+                return match.group(0)
+            return 'url(%s%s%s%s)' % (quote, posixpath.relpath(target, css_dir or '.'), suffix, quote)
+
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return body
+        return CSS_URL_REGEX.sub(replace_url, text).encode('utf-8')
+
+    def url(self, path):
+        """Function to return the URL of a static file: its hashed URL if it has been fingerprinted."""
+        return self.url_prefix + self.hashed_paths.get(path, path)
+
+    async def handler(self, request):
+        """Function to serve a static file; hashed URLs can be cached indefinitely."""
+        path = request.match_info.get('path', '')
+        asset = self.assets.get(path)
+        if asset is None:
+            raise web.HTTPNotFound()
+        cache_control = 'no-cache' if path in self.hashed_paths else IMMUTABLE_CACHE_CONTROL
+        return asset.response(request, cache_control=cache_control)
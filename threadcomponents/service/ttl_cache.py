@@ -0,0 +1,68 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+# Marker for a missing entry (so None can still be cached)
+_MISSING = object()
+
+
+class TTLCache:
+    """A size-bounded cache whose entries expire after a time-to-live (in seconds)."""
+
+    def __init__(self, max_size=1000, ttl=3600):
+        # A max_size or ttl below 1 means no limit for that setting
+        self.max_size = max_size if max_size and max_size > 0 else None
+        self.ttl = ttl if ttl and ttl > 0 else None
+        # Entries are (expiry-time, value) ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, default=_MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        """Function to return a cached value for a key (or default if it is missing or expired)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                # The entry has expired: remove it and treat this as a miss
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += count
+                return default
+            self._entries.move_to_end(key)
+            self.hits += count
+            return entry[1]
+
+    def set(self, key, value):
+        """Function to cache a value for a key, evicting the least recently used entries if the cache is full."""
+        expires = (time.monotonic() + self.ttl) if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while self.max_size and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Function to remove and return a cached value for a key."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Function to return a dictionary of this cache's usage."""
+        lookups = self.hits + self.misses
+        return dict(size=len(self._entries), max_size=self.max_size, ttl=self.ttl, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=round(self.hits / lookups, 4) if lookups else None)
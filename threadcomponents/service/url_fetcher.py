@@ -0,0 +1,166 @@
+import aiohttp
+import asyncio
+import logging
+import time
+
+from lxml import html
+from threadcomponents.metrics import REGISTRY
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Errors raised by aiohttp when a URL cannot be reached (the equivalent of requests' ConnectionError)
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+# Status codes which are worth retrying (other error codes are unlikely to change on a retry)
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# The status code to use when a URL could not be retrieved at all
+FAILED_STATUS = 418
+# Query parameters which only track where a link was clicked from (they do not change the page)
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', '_hsenc', '_hsmi', 'ref_src'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# The time taken to fetch URLs (including retries) and how fetches failed
+FETCH_SECONDS = REGISTRY.histogram('thread_url_fetch_seconds', 'Time taken to fetch URLs (including any retries).')
+FETCH_FAILURES = REGISTRY.counter('thread_url_fetch_errors_total', 'URL fetches which failed (by connection failure '
+                                  'or error status code).', label_names=('reason',))
+FETCH_RETRIES = REGISTRY.counter('thread_url_fetch_retries_total', 'URL fetch attempts which were retried.')
+
+
+def canonicalise_url(url):
+    """Function to return a normalised version of a URL for comparing two URLs refer to the same page."""
+    parsed = urlsplit(url.strip())
+    if not parsed.scheme or not parsed.hostname:
+        raise ValueError('A URL has not been specified')
+    # http and https versions of a page are treated as the same page
+    scheme = parsed.scheme.lower()
+    scheme = 'https' if scheme in DEFAULT_PORTS else scheme
+    # hostname is already lower-case and excludes any user-info and port
+    host = parsed.hostname
+    if parsed.port and parsed.port not in DEFAULT_PORTS.values():
+        host += ':%s' % parsed.port
+    # Ignore any trailing slash and drop tracking parameters (sorting the rest so their order does not matter)
+    path = parsed.path.rstrip('/') or '/'
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                   if not (k.lower().startswith('utm_') or k.lower() in TRACKING_PARAMS))
+    return urlunsplit((scheme, host, path, urlencode(query), ''))
+
+
+class FetchedResponse:
+    """A lightweight representation of a response retrieved from a URL."""
+
+    def __init__(self, url, status, headers=None, text=None):
+        # The URL after any redirects
+        self.url = url
+        self.status_code = status
+        self.headers = headers or dict()
+        self.text = text
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    def without_body(self):
+        """Function to return a copy of this response with only what is needed for URL checks (no body)."""
+        etag = self.headers.get('ETag')
+        return FetchedResponse(self.url, self.status_code, headers=dict(ETag=etag) if etag else None)
+
+
+class FetchedDocument:
+    """A submitted URL's document: downloaded at most once and reused by every stage needing its contents."""
+
+    def __init__(self, url, fetcher):
+        self.url = url
+        self.fetcher = fetcher
+        self.response = None
+        self._canonical_url = None
+
+    @property
+    def text(self):
+        return self.response.text if self.response else None
+
+    @property
+    def final_url(self):
+        return self.response.url if self.response else self.url
+
+    async def fetch(self, log_errors=True, allow_error=True):
+        """Function to download this document (if not done so already) and return its FetchedResponse."""
+        if self.response is None:
+            self.response = await self.fetcher.fetch(self.url, read_body=True, log_errors=log_errors,
+                                                     allow_error=allow_error)
+        return self.response
+
+    def canonical_url(self):
+        """Function to return the page's declared canonical URL (falling back to the URL after redirects)."""
+        if self._canonical_url is None:
+            self._canonical_url = self.final_url
+            if self.text:
+                try:
+                    links = html.fromstring(self.text).xpath('//link[@rel="canonical"]/@href')
+                except (ValueError, html.etree.ParserError):
+                    links = []
+                if links and links[0].strip():
+                    self._canonical_url = links[0].strip()
+        return self._canonical_url
+
+    def release(self):
+        """Function to drop the downloaded body once it is no longer needed."""
+        if self.response is not None:
+            self.response = self.response.without_body()
+
+
+class URLFetcher:
+    """A class to retrieve URLs asynchronously using pooled connections."""
+
+    def __init__(self, timeout=30, connect_timeout=10, limit=100, limit_per_host=4, retries=2, backoff=0.5):
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        # Sessions are bound to an event loop: report analysis runs in separate loops so keep a session per loop
+        self._sessions = dict()
+
+    def _get_session(self):
+        """Function to return the session for the running event loop, creating it if needed."""
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        """Function to close the session for the running event loop."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def fetch(self, url, read_body=False, log_errors=True, allow_error=True):
+        """Function to return a FetchedResponse from a given URL, retrying with a backoff on failure."""
+        session = self._get_session()
+        response, start = None, time.perf_counter()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                FETCH_RETRIES.inc()
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+            try:
+                async with session.get(url) as r:
+                    text = await r.text(errors='replace') if read_body else None
+                    response = FetchedResponse(str(r.url), r.status, headers=dict(r.headers), text=text)
+            except FETCH_ERRORS as conn_error:
+                # Only raise or give up on a connection error once there are no retries left
+                if attempt < self.retries:
+                    continue
+                FETCH_SECONDS.observe(time.perf_counter() - start)
+                FETCH_FAILURES.inc(reason='connection')
+                if log_errors:
+                    logging.error('URL connection failure: ' + str(conn_error))
+                if not allow_error:
+                    raise conn_error
+                return FetchedResponse(url, FAILED_STATUS)
+            if response.ok or response.status_code not in RETRY_STATUSES:
+                break
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+        if not response.ok:
+            FETCH_FAILURES.inc(reason='status')
+            if log_errors:
+                logging.error('URL retrieval failed with code ' + str(response.status_code))
+        return response
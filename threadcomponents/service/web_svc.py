@@ -4,21 +4,16 @@
 
 import asyncio
 import logging
-import newspaper
-import nltk
 import re
-import requests
 
 from aiohttp import web
-from bs4 import BeautifulSoup
-from contextlib import suppress
+from contextlib import nullcontext, suppress
 from html2text import html2text
 from ipaddress import ip_address
 from lxml import etree, html
-from newspaper.article import ArticleDownloadState
-from nltk.corpus import stopwords
-from nltk.stem import SnowballStemmer
-from urllib.parse import urlparse
+from threadcomponents.service.ttl_cache import TTLCache
+from threadcomponents.service.url_fetcher import canonicalise_url, FETCH_ERRORS, FetchedDocument, URLFetcher
+from urllib.parse import urlparse, urlsplit, urlunsplit
 
 # Abbreviated words for sentence-splitting
 ABBREVIATIONS = {'dr', 'vs', 'mr', 'mrs', 'ms', 'prof', 'inc', 'fig', 'e.g', 'i.e', 'u.s'}
@@ -44,13 +39,16 @@ IPV4_REGEX = re.compile(r"""
         (?:(?=[^\d\.])|$)
     """, re.VERBOSE)
 IPV6_REGEX = re.compile(r"\b((?:[a-f0-9]{1,4}:|:){2,7}(?:[a-f0-9]{1,4}|:))\b", re.IGNORECASE | re.VERBOSE)
+# The characters which start/end tags and quotes, or a run of any other characters
+MARKUP_TOKEN_REGEX = re.compile(r'[<>"\']|[^<>"\']+')
 
 
 class WebService:
     # Static class variables for the keys in app_routes
     HOME_KEY, COOKIE_KEY, EDIT_KEY, ABOUT_KEY, REST_KEY = 'home', 'cookies', 'edit', 'about', 'rest'
     EXPORT_PDF_KEY, EXPORT_NAV_KEY, STATIC_KEY = 'export_pdf', 'export_nav', 'static'
-    HOW_IT_WORKS_KEY, WHAT_TO_SUBMIT_KEY = 'how_it_works', 'what_to_submit'
+    HOW_IT_WORKS_KEY, WHAT_TO_SUBMIT_KEY, READY_KEY = 'how_it_works', 'what_to_submit', 'ready'
+    CATALOGUE_KEY, EXPORT_BULK_KEY, METRICS_KEY = 'catalogue', 'export_bulk', 'metrics'
     REPORT_PARAM = 'file'
     # Variations of punctuation we want to note
     HYPHENS = ['-', u'\u058A', u'\u05BE', u'\u2010', u'\u2011', u'\u2012', u'\u2013', u'\u2014', u'\u2015', u'\u2E3A',
@@ -60,10 +58,14 @@ class WebService:
               u'\u201F', u'\u2033', u'\u2036', u'\u3003', u'\uFF02', u'\u275D', u'\u275E']
     BULLET_POINTS = [u'\u2022', u'\u2023', u'\u2043', u'\u2219', u'\u25CB', u'\u25CF', u'\u25E6', u'\u30fb']
 
-    def __init__(self, route_prefix=None, is_local=True):
+    def __init__(self, route_prefix=None, is_local=True, url_cache_size=1000, url_cache_ttl=3600):
         self.is_local = is_local
-        self.tokenizer_sen = None
-        self.cached_responses = dict()
+        # The sentence tokenizer is loaded on first use (loading nltk is slow so this is kept out of startup)
+        self._tokenizer_sen = None
+        # Responses (final URL, status and ETag only) of URLs checked on submission; bounded by size and age
+        self.cached_responses = TTLCache(max_size=url_cache_size, ttl=url_cache_ttl)
+        # Shared fetcher (pooled connections) for all outgoing requests to submitted URLs
+        self.url_fetcher = URLFetcher()
         # A dictionary keeping track of the possible report categories
         self.categories_dict = dict()
         # Initialise app route info
@@ -83,8 +85,11 @@ class WebService:
             self.ABOUT_KEY: route_prefix + '/using-thread', self.REST_KEY: route_prefix + '/rest',
             self.EXPORT_PDF_KEY: route_prefix + '/export/pdf/{%s}' % self.REPORT_PARAM,
             self.EXPORT_NAV_KEY: route_prefix + '/export/nav/{%s}' % self.REPORT_PARAM,
-            self.HOW_IT_WORKS_KEY: route_prefix + '/how-thread-works',
-            self.STATIC_KEY: route_prefix + '/theme/'
+            self.EXPORT_BULK_KEY: route_prefix + '/export/bulk',
+            self.HOW_IT_WORKS_KEY: route_prefix + '/how-thread-works', self.READY_KEY: route_prefix + '/ready',
+            self.METRICS_KEY: route_prefix + '/metrics',
+            self.STATIC_KEY: route_prefix + '/theme/',
+            self.CATALOGUE_KEY: route_prefix + '/catalogue/{%s}' % self.REPORT_PARAM
         }
         if not self.is_local:
             routes.update({self.WHAT_TO_SUBMIT_KEY: route_prefix + '/what-to-submit'})
@@ -101,15 +106,28 @@ class WebService:
         except KeyError:
             return None
 
+    @property
+    def tokenizer_sen(self):
+        if self._tokenizer_sen is None:
+            self.initialise_tokenizer()
+        return self._tokenizer_sen
+
     def initialise_tokenizer(self):
-        self.tokenizer_sen = nltk.data.load('tokenizers/punkt/english.pickle')
+        import nltk
+        tokenizer_sen = nltk.data.load('tokenizers/punkt/english.pickle')
         try:
-            self.tokenizer_sen._params.abbrev_types.update(ABBREVIATIONS)
+            tokenizer_sen._params.abbrev_types.update(ABBREVIATIONS)
         except AttributeError:
             pass
+        self._tokenizer_sen = tokenizer_sen
+
+    def clear_cached_responses(self):
+        logging.info('Clearing URL-response cache: %s' % self.cached_responses.stats())
+        self.cached_responses.clear()
 
-    def clear_cached_responses(self):  # TODO consider how often to call this
-        self.cached_responses = dict()
+    async def close_url_sessions(self, *_):
+        """Function to close any open URL-fetching sessions for the running event loop."""
+        await self.url_fetcher.close()
 
     async def action_allowed(self, request, action, context=None):
         """Function to check an action is permitted given a request."""
@@ -169,10 +187,25 @@ class WebService:
             logging.error('Misconfigured app: auto_gen_data_is_valid() error: ' + str(e))
         return False
 
-    async def map_all_html(self, url_input, sentence_limit=None):
+    def get_document(self, url):
+        """Function to return a (not yet downloaded) document for a URL, to be shared by each stage needing it."""
+        return FetchedDocument(url, self.url_fetcher)
+
+    async def map_all_html(self, url_input, sentence_limit=None, document=None, trace=None):
+        # Import here as newspaper (and BeautifulSoup) are only needed once a report is analysed
+        import newspaper
+        from bs4 import BeautifulSoup
+        from newspaper.article import ArticleDownloadState
         a = newspaper.Article(url_input, keep_article_html=True)
         a.config.MAX_TEXT = None
-        a.download()
+        # Use the report's document (downloading it if needed) rather than newspaper downloading the page again
+        document = document or self.get_document(url_input)
+        # Time the download separately from processing the page (if the report's analysis is being traced)
+        with trace.span('download') if trace else nullcontext():
+            r = await document.fetch()
+        if not r.ok or not r.text:
+            return None, None
+        a.download(input_html=r.text)
         if a.download_state != ArticleDownloadState.SUCCESS:
             return None, None
         a.parse()
@@ -375,6 +408,8 @@ class WebService:
     @staticmethod
     async def tokenize(s):
         """Function to remove stopwords from a sentence and return a list of words to match"""
+        from nltk.corpus import stopwords
+        from nltk.stem import SnowballStemmer
         word_list = re.findall(r'\w+', s.lower())
         filtered_words = [word for word in word_list if word not in stopwords.words('english')]
         """Perform NLP Lemmatization and Stemming methods"""
@@ -387,77 +422,58 @@ class WebService:
 
     @staticmethod
     async def remove_html_markup_and_found(s):
+        """Function to return text without its HTML tags and without anything after a '!FOUND:' marker."""
         tag = False
         quote = False
-        out = ""
-        for c in s:
-            if c == '<' and not quote:
+        # Collect the text outside tags then join it once (rather than building a new string per character)
+        out = []
+        # Runs of characters which are not tag or quote characters are handled together
+        for token in MARKUP_TOKEN_REGEX.findall(s):
+            if token == '<' and not quote:
                 tag = True
-            elif c == '>' and not quote:
+            elif token == '>' and not quote:
                 tag = False
-            elif (c == '"' or c == "'") and tag:
+            elif (token == '"' or token == "'") and tag:
                 quote = not quote
             elif not tag:
-                out = out + c
+                out.append(token)
         sep = '!FOUND:'
-        out = out.split(sep, 1)[0]
+        out = ''.join(out).split(sep, 1)[0]
         return out.strip().replace('\n', ' ')
 
     async def get_url(self, url, returned_format=None):
         if returned_format == 'html':
             logging.info('[!] HTML support is being refactored. Currently data is being returned plaintext')
-        r = self.get_response_from_url(url)
+        import newspaper
+        r = await self.url_fetcher.fetch(url, read_body=True)
         # Use the response text to get contents for this url
-        b = newspaper.fulltext(r.text)
+        b = newspaper.fulltext(r.text) if r.text else None
         return str(b).replace('\n', '<br>') if b else None
 
-    def get_response_from_url(self, url, log_errors=True, allow_error=True):
-        """Function to return a request Response object from a given URL."""
+    async def get_response_from_url(self, url, log_errors=True, allow_error=True, document=None):
+        """Function to return a FetchedResponse object (without its body) from a given URL. If a document for the URL
+        is given, it is downloaded so its body can be reused later."""
         # Retrieve a cached response for this URL
         cached = self.cached_responses.get(url)
         if cached is not None:
             return cached
-        # Specify if we retry retrieving a response on failure
-        retry_on_fail = True
-        # Flag if we can close the connection once we are finished
-        close_conn = True
-        try:
-            r = requests.get(url)
-        except requests.exceptions.ConnectionError as conn_error:
-            # Log error if requested
-            if log_errors:
-                logging.error('URL connection failure: ' + str(conn_error))
-            # Raise the error if requested
-            if not allow_error:
-                raise conn_error
-            # If the URL could not be retrieved due to a raised Error, build a new Response object and skip retrying
-            r = requests.models.Response()
-            r.status_code = 418
-            retry_on_fail = False
-            close_conn = False
-        if retry_on_fail and not r.ok:
-            # If the request response is not good, close the current connection and replace with a prepared request
-            r.close()
-            sess = requests.Session()
-            r = requests.Request('GET', url)
-            prep = r.prepare()
-            r = sess.send(prep)
-        if not r.ok and log_errors:
-            logging.error('URL retrieval failed with code ' + str(r.status_code))
-        if close_conn:
-            r.close()
+        if document is not None:
+            r = await document.fetch(log_errors=log_errors, allow_error=allow_error)
+        else:
+            r = await self.url_fetcher.fetch(url, log_errors=log_errors, allow_error=allow_error)
+        r = r.without_body()
         # Cache the response object for this URL
-        self.cached_responses[url] = r
+        self.cached_responses.set(url, r)
         return r
 
-    def urls_match(self, testing_url='', matches_with=''):
+    async def urls_match(self, testing_url='', matches_with=''):
         """Function to check if two URLs are the same."""
         # Quick initial check that both strings are identical
         if testing_url == matches_with:
             return True
         # Handle any redirects (e.g. https redirects; added '/'s at the end of a url)
-        req1 = self.get_response_from_url(testing_url, log_errors=False)
-        req2 = self.get_response_from_url(matches_with, log_errors=False)
+        req1, req2 = await asyncio.gather(self.get_response_from_url(testing_url, log_errors=False),
+                                          self.get_response_from_url(matches_with, log_errors=False))
         if not req1.url:
             raise ValueError('A URL has not been specified')
         if req1.url == req2.url:
@@ -466,8 +482,28 @@ class WebService:
         # but leaving as this for now
         return False
 
-    async def verify_url(self, request, url=''):
-        """Function to check a URL can be parsed. Returns None if successful."""
+    def get_url_keys(self, url, document=None):
+        """Function to return the set of canonical URLs a URL is known by (for duplicate checks without requests)."""
+        keys = {canonicalise_url(url)}
+        # Include where the URL redirected to (if we have already retrieved it)
+        cached = self.cached_responses.get(url, count=False)
+        if cached is not None and cached.ok:
+            keys.add(canonicalise_url(cached.url))
+        if document is not None and document.response is not None and document.response.ok:
+            final_url = canonicalise_url(document.final_url)
+            keys.add(final_url)
+            # A canonical link declared by the page is only used if it is a valid URL on the same site (a page can
+            # declare any URL, e.g. its site's home page, which would make different pages look like duplicates)
+            with suppress(ValueError):
+                canonical = urlsplit(canonicalise_url(document.canonical_url()))
+                final = urlsplit(final_url)
+                if (canonical.netloc == final.netloc) and ((canonical.path != '/') or (final.path == '/')):
+                    keys.add(urlunsplit(canonical))
+        return keys
+
+    async def verify_url(self, request, url='', document=None, check_allowed=True):
+        """Function to check a URL can be parsed. Returns None if successful. If given, the URL's document is
+        downloaded as part of the check. The request is only needed to check the URL is allowed (if check_allowed)."""
         url_error = 'Unable to parse URL %s' % url
         # Check the url can be parsed by the urllib module
         try:
@@ -480,10 +516,11 @@ class WebService:
             raise ValueError(url_error)
         try:
             # Check the URL is allowed
-            await self.url_allowed(request, url)
+            if check_allowed:
+                await self.url_allowed(request, url)
             # Check a request-response can be retrieved from this url
-            self.get_response_from_url(url, log_errors=False, allow_error=False)
-        except requests.exceptions.ConnectionError:
+            await self.get_response_from_url(url, log_errors=False, allow_error=False, document=document)
+        except FETCH_ERRORS:
             raise ValueError(url_error)
         # Check the url does not contain an IP address
         created_ip = None
@@ -25,6 +25,13 @@ var restUrl = $("script#basicsScript").data("rest-url");
 var isLocal = $("script#basicsScript").data("run-local");
 // Is this report completed?
 var isCompleted = false;
+// The report being edited and its sentences' hits (sentence ID -> techniques, confirmed techniques & IoC text)
+var reportTitle = undefined;
+var sentenceIndex = null;
+// The dropdown catalogues requested by this page (URL -> request) and the country data from these
+var catalogues = {};
+var countries = {};
+var countryRegions = {};
 // External-font-loading: pdfMake-config and boolean to represent if we loaded the font
 var exoConfig = {
   normal: "Exo-Light.ttf",
@@ -148,6 +155,9 @@ function remove_sentence() {
     restRequest("POST", {"index": "remove_sentence", "sentence_id": sentence_id}, function() {
       // Remove the element itself and any related elements (e.g. buffering <br>s, the to-review list)
       selected.remove();
+      if (sentenceIndex) {
+        delete sentenceIndex[sentence_id];
+      }
       $(`.elmtRelated${sentence_id}`).remove();
       removeSentenceFromReviewList(sentence_id, true);
       // Nothing is currently selected after this removal
@@ -182,24 +192,83 @@ function acceptReject(sentence_id, attack_uid, accepting=false, rejecting=false)
     throw new Error("Sentence-attack: accepting or rejecting not specified.");
   }
   var action = accepting ? "add_attack" : "reject_attack";
-  restRequest("POST", {"index": action, "sentence_id": sentence_id, "attack_uid": attack_uid}, function() {
+  restRequest("POST", {"index": action, "sentence_id": sentence_id, "attack_uid": attack_uid}, function(resp) {
     // Update the to-review list
     $(`a#outstanding-tech-${sentence_id}-${attack_uid}`).remove();
     removeSentenceFromReviewList(sentence_id);
-    // Retrieve and display the list of attacks
-    sentenceContext(sentence_id);
+    // Display the sentence's updated list of attacks sent back (else nothing changed, e.g. already confirmed)
+    if (resp?.delta) {
+      applySentenceDelta(resp.delta);
+    } else {
+      sentenceContext(sentence_id);
+    }
   });
 }
 
+function applySentenceDelta(delta) {
+  // Patch a sentence's hits, highlighting and the to-review list in place with the changes sent back
+  var sentenceId = delta.sentence_id;
+  if (sentenceIndex) {
+    sentenceIndex[sentenceId] = Object.assign(sentenceIndex[sentenceId] || {"ioc": ""}, delta.sentence);
+  }
+  if (sentenceId === sentence_id) {
+    var iocText = sentenceIndex?.[sentenceId]?.ioc || $("#" + iocSavedBoxId).val();
+    updateSentenceContext({"techniques": delta.sentence.techniques, "ioc": iocText});
+    updateConfirmedContext(delta.sentence.confirmed);
+  }
+  if (delta.found_status) {
+    $("#elmt" + sentenceId).addClass(highlightClass);
+  }
+  // Nothing left to review for this report
+  if (delta.unchecked === 0) {
+    $("ul#outstandingTechsList").remove();
+    $("span#techsNoMoreConfNote").prop("hidden", false);
+  }
+}
+
+function moveReportCard(reportTitle, fromStatus, toStatus=null) {
+  // Remove a report's card from its status-column (or move it to another one) rather than reloading the index page
+  var card = document.getElementById(`${fromStatus}-${reportTitle}`);
+  var column = toStatus ? document.getElementById(toStatus) : null;
+  if (!card || (toStatus && !column)) {
+    page_refresh();
+    return;
+  }
+  if (!toStatus) {
+    card.remove();
+    return;
+  }
+  // Only mid-review reports can be rollbacked
+  $(card).find(".report-rollback").remove();
+  card.id = `${toStatus}-${reportTitle}`;
+  // Keep the column's reports in title-order
+  var title = $(card).find(".card-text").text();
+  var columnCards = $(column).children(".report-card");
+  var nextCard = columnCards.filter(function() {
+    return $(this).find(".card-text").text() > title;
+  }).first();
+  if (nextCard.length) {
+    nextCard.before(card);
+  } else if (columnCards.length) {
+    columnCards.last().after(card);
+  } else {
+    $(column).children(".card-title").after(card);
+  }
+}
+
 function deleteReport(reportTitle) {
   if (confirm("Are you sure you want to delete this report?")) {
-    restRequest("POST", {"index": "delete_report", "report_title": reportTitle}, page_refresh);
+    restRequest("POST", {"index": "delete_report", "report_title": reportTitle}, function(resp) {
+      moveReportCard(reportTitle, resp?.delta?.report_status);
+    });
   }
 }
 
 function rollbackReport(reportTitle) {
   if (confirm("Are you sure you want to rollback this report to NEEDS REVIEW?")) {
-    restRequest("POST", {"index": "rollback_report", "report_title": reportTitle}, page_refresh);
+    restRequest("POST", {"index": "rollback_report", "report_title": reportTitle}, function(resp) {
+      moveReportCard(reportTitle, resp?.delta?.report_status, resp?.delta?.new_status);
+    });
   }
 }
 
@@ -209,10 +278,26 @@ function finish_analysis(reportTitle) {
     msg += "\n\nOnce this report is finalised, it will be deleted from Thread after 24 hours.";
   }
   if (confirm(msg)) {
-    restRequest("POST", {"index":"set_status", "set_status": "completed", "report_title": reportTitle}, page_refresh);
+    restRequest("POST", {"index":"set_status", "set_status": "completed", "report_title": reportTitle}, function(resp) {
+      if (resp?.delta?.current_status === "completed") {
+        markReportCompleted();
+      } else {
+        page_refresh();
+      }
+    });
   }
 }
 
+function markReportCompleted() {
+  // Switch the page to its read-only view of a completed report
+  isCompleted = true;
+  $(".review-only").remove();
+  $("#completedHelpText").prop("hidden", false);
+  $("#reportInfoForm input[type=date], #iocSavedBox").prop("readonly", true);
+  $("#reportInfoForm input[type=checkbox], .confirmed-technique").prop("disabled", true);
+  $("#reportInfoForm select").prop("disabled", true).selectpicker("refresh");
+}
+
 function updateReportDates(reportTitle) {
   if(!document.getElementById("reportDatesForm").reportValidity()) {
     return;
@@ -224,7 +309,20 @@ function updateReportDates(reportTitle) {
   var sameDates = $("#dateRange").prop("checked");
   var applyToAll = $("#applyToAllDates").prop("checked");
   restRequest("POST", {"index": "update_report_dates", "report_title": reportTitle, "same_dates": sameDates,
-                       "apply_to_all": applyToAll, "date_of": dateOf, "start_date": startDate, "end_date": endDate});
+                       "apply_to_all": applyToAll, "date_of": dateOf, "start_date": startDate, "end_date": endDate},
+    function(resp) {
+      // If the dates were applied to all confirmed techniques, reload the report's hits to display their new dates
+      if (resp?.delta?.sentences_changed) {
+        refreshSentenceIndex(function() {
+          if (sentenceIndex && sentence_id) {
+            updateConfirmedContext(sentenceIndex[sentence_id]?.confirmed || []);
+          } else if (sentence_id) {
+            restRequest("POST", {"index":"confirmed_attacks", "sentence_id": sentence_id}, updateConfirmedContext);
+          }
+        });
+      }
+    }
+  );
 }
 
 function submit(data, submitButton) {
@@ -242,7 +340,24 @@ function submit(data, submitButton) {
     // Update request-data with private-report boolean
     data.private = $(privateSwitchID).is(":checked");
   }
-  restRequest("POST", data, page_refresh);
+  restRequest("POST", data, function(response) {
+    // Batch submissions are processed in the background: wait for their outcome before refreshing
+    if (response?.job_id) {
+      checkBatchJob(response.job_id);
+    } else {
+      page_refresh();
+    }
+  });
+}
+
+function checkBatchJob(jobID) {
+  restRequest("POST", {"index": "batch_job_status", "job_id": jobID}, function(response) {
+    if (response?.pending) {
+      setTimeout(function() { checkBatchJob(jobID); }, 1000);
+    } else {
+      page_refresh();
+    }
+  }, restUrl, page_refresh);
 }
 
 function submit_report(submitButton) {
@@ -308,14 +423,47 @@ function savedAlert() {
   }
 }
 
+function refreshSentenceIndex(callback=null) {
+  var onLoaded = (callback instanceof Function) ? callback : function() {};
+  // Retrieve the hits for every sentence in this report in one request
+  if (!reportTitle) {
+    onLoaded();
+    return;
+  }
+  restRequest("POST", {"index": "sentence_index", "report_title": reportTitle}, function(data) {
+    sentenceIndex = data?.sentences || null;
+    onLoaded();
+  }, restUrl, onError=function() {
+    // Fall back to requesting each sentence's info when it is clicked
+    sentenceIndex = null;
+    onLoaded();
+  });
+}
+
 function sentenceContext(data) {
   // Update selected sentence global variable
   sentence_id = data;
-  // Fire off requests to get info on this sentence
+  // Display this sentence's info from the report's sentence index if we have it
+  if (sentenceIndex) {
+    var sentenceHits = sentenceIndex[data] || {};
+    updateSentenceContext({"techniques": sentenceHits.techniques || [], "ioc": sentenceHits.ioc || ""});
+    updateConfirmedContext(sentenceHits.confirmed || []);
+    return;
+  }
+  // Else fire off requests to get info on this sentence
   restRequest("POST", {"index":"sentence_context", "sentence_id": data}, updateSentenceContext);
   restRequest("POST", {"index":"confirmed_attacks", "sentence_id": data}, updateConfirmedContext);
 }
 
+function setIndexedIoc(sentenceId, iocText) {
+  // Keep the sentence index in line with an IoC change for a sentence
+  if (sentenceIndex) {
+    var sentenceHits = sentenceIndex[sentenceId] || {"techniques": [], "confirmed": []};
+    sentenceHits.ioc = iocText;
+    sentenceIndex[sentenceId] = sentenceHits;
+  }
+}
+
 function updateSentenceContext(responseData) {
   // If we previously highlighted a sentence before and this is a new sentence, remove the previous highlighting
   if (tempHighlighted !== undefined && tempHighlighted !== sentence_id) {
@@ -427,14 +575,25 @@ function updateAttackTime(reportTitle) {
   }
   restRequest("POST", {"index": "update_attack_time", "start_date": startDate, "end_date": endDate,
                        "mapping_list": mappingList, "report_title": reportTitle},
-    // Either refresh the whole page or just the techniques list to display recently-saved dates
+    // Display the recently-saved dates of the updated techniques (and of the report if these changed)
     function success(resp) {
-      if (resp.refresh_page) {
-        page_refresh();
-        return;
+      var delta = resp?.delta || {};
+      if (delta.report_dates?.start_date) {
+        document.getElementById("startDate").value = delta.report_dates.start_date;
+      }
+      if (delta.report_dates?.end_date) {
+        document.getElementById("endDate").value = delta.report_dates.end_date;
       }
-      if (resp.updated_attacks) {
-        restRequest("POST", {"index":"confirmed_attacks", "sentence_id": sentence_id}, updateConfirmedContext);
+      var updatedSentences = delta.sentences || {};
+      if (Object.keys(updatedSentences).length) {
+        $.each(updatedSentences, function(sentenceId, sentenceHits) {
+          if (sentenceIndex) {
+            sentenceIndex[sentenceId] = Object.assign(sentenceIndex[sentenceId] || {"ioc": ""}, sentenceHits);
+          }
+          if (sentenceId === sentence_id) {
+            updateConfirmedContext(sentenceHits.confirmed);
+          }
+        });
         document.getElementById("ttpStartDate").value = null;
         document.getElementById("ttpEndDate").value = null;
       }
@@ -614,6 +773,72 @@ function updateMultiSelectList(dropdown, selOptClass, ulID, liClass, useSelToLoo
   }
 }
 
+function getCatalogue(url) {
+  // Request each catalogue once (its URL is versioned so the browser can keep it until it changes)
+  if (!catalogues[url]) {
+    catalogues[url] = $.ajax({url: url, dataType: "json", cache: true});
+  }
+  return catalogues[url];
+}
+
+function catalogueOptions(name, catalogue) {
+  // Return a catalogue as dropdown options of {value, text, subtext}
+  switch (name) {
+    case "attacks":
+      return catalogue.map(function(attack) {
+        // Sub-techniques display their parent-technique with their own name as the subtext
+        return attack.parent_name ? {"value": attack.uid, "text": attack.parent_name, "subtext": attack.name}
+                                  : {"value": attack.uid, "text": attack.name};
+      });
+    case "keywords":
+      return catalogue.map(function(keyword) { return {"value": keyword, "text": keyword}; });
+    case "categories":
+      return catalogue.map(function(category) { return {"value": category.keyname, "text": category.display_name}; });
+    case "regions":
+      return catalogue.regions.map(function(region) { return {"value": region[0], "text": region[1]}; });
+    case "countries":
+      return catalogue.countries.map(function(country) { return {"value": country[0], "text": country[1]}; });
+  }
+  return [];
+}
+
+function fillSelect(select, options, optionClass) {
+  // Replace a dropdown's options with the given ones, keeping what is currently selected
+  var selected = $(select).val() || [];
+  var optionElements = options.map(function(option) {
+    var optionElement = $("<option>", {"class": optionClass, "value": option.value, "text": option.text,
+                                       "selected": selected.includes(option.value)});
+    if (option.subtext) {
+      optionElement.attr("data-subtext", option.subtext);
+    }
+    return optionElement;
+  });
+  $(select).empty().append(optionElements).selectpicker("refresh");
+}
+
+function loadCatalogues() {
+  // The page only includes the selected dropdown options: add the rest from the dropdown catalogues
+  var countriesUrl = undefined;
+  $("select[data-catalogue-url]").each(function() {
+    var select = this;
+    var catalogueUrl = $(select).data("catalogue-url");
+    if (["regions", "countries"].includes($(select).data("catalogue"))) {
+      countriesUrl = catalogueUrl;
+    }
+    getCatalogue(catalogueUrl).done(function(catalogue) {
+      fillSelect(select, catalogueOptions($(select).data("catalogue"), catalogue), $(select).data("option-class"));
+    });
+  });
+  // Once the region and country dropdowns are filled, limit the countries to any selected regions
+  if (countriesUrl) {
+    getCatalogue(countriesUrl).done(function(catalogue) {
+      countries = Object.fromEntries(catalogue.countries);
+      countryRegions = catalogue.country_regions;
+      initialiseCountrySelects();
+    });
+  }
+}
+
 function initialiseCountrySelects() {
   for (let assocType of ["aggressor", "victim"]) {
     let selectedRegionIds = $(`#${assocType}RegionSelect`).val();
@@ -676,7 +901,7 @@ function downloadPDF(data) {
 
 function downloadLayer(data) {
   // Create the name of the JSON download file from the name of the report
-  var json = JSON.parse(data)
+  var json = data;
   var filename = json["filename"] + ".json";
   // We don't need to include the filename property within the file
   delete json["filename"];
@@ -803,6 +1028,7 @@ function suggestSaveIoC() {
     restRequest("POST", {"index": "suggest_and_save_ioc", "sentence_id": sentence_id}, function(data) {
       if (data?.ioc_text) {
         $("#" + iocSavedBoxId).val(data.ioc_text);
+        setIndexedIoc(sentence_id, data.ioc_text);
         $(`#elmt${sentence_id}`).attr("data-ioc", "true");
         $(`#ioc-icon-${sentence_id}`).show();
       }
@@ -816,6 +1042,7 @@ function addIoC(updating=false) {
     restRequest("POST",
       {"index": endpoint, "sentence_id": sentence_id, "ioc_text": $("#" + iocSavedBoxId).val()},
       function() {
+        setIndexedIoc(sentence_id, $("#" + iocSavedBoxId).val());
         $(`#elmt${sentence_id}`).attr("data-ioc", "true");
         $(`#ioc-icon-${sentence_id}`).show();
         $(iocSuggestionBoxSelector).val("");
@@ -830,6 +1057,7 @@ function toggleIoc() {
   if (sentence_id) {
     if ($(`#elmt${sentence_id}`).attr("data-ioc") === "true") {
       restRequest("POST", {"index": "remove_indicator_of_compromise", "sentence_id": sentence_id}, function() {
+        setIndexedIoc(sentence_id, "");
         $(`#elmt${sentence_id}`).attr("data-ioc", "false");
         $(`#ioc-icon-${sentence_id}`).hide();
         $(iocSuggestionBoxSelector).val("");
@@ -851,6 +1079,9 @@ $(document).ready(function() {
   });
   // addDeleteListener(); inputs are now interacted with when a sentence is selected
   isCompleted = $("script#reportDetails").data("completed");
+  // Load the report's sentence hits once so clicking on sentences does not need a request each time
+  reportTitle = $("script#reportDetails").data("report-title");
+  refreshSentenceIndex();
   importFont();
-  initialiseCountrySelects();
+  loadCatalogues();
 });